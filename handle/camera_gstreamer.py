@@ -1,6 +1,6 @@
 # Thesis/handle/camera_gstreamer.py
 import cv2
-from flask import Flask, Response, render_template, jsonify
+from flask import Flask, Response, render_template, jsonify, request
 import os
 import signal
 import threading
@@ -16,6 +16,9 @@ import numpy as np
 import random
 from iot.firebase.push_image import upload_images_and_generate_html
 from handle.record_handle import RecordHandler
+from handle.video_buffer_handle import EncodedFrameRing
+from handle.stream_encoder_handle import StreamEncoder
+from sensors.backend import get_backend
 import smtplib
 from email.message import EmailMessage
 from handle.email_config import SMTP_SERVER, SMTP_PORT, SENDER_EMAIL, SENDER_PASSWORD, RECIPIENT_EMAIL
@@ -108,12 +111,18 @@ class AccidentDetector:
 
 class CameraStream:
     def __init__(self, mqtt_client, record_handler, sensor_handler):
-        self.cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
-        if not self.cap.isOpened():
-            raise RuntimeError("Failed to open camera")
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-        self.cap.set(cv2.CAP_PROP_FPS, 20)
+        # BLACKBOX_CAMERA_ENGINE=gstreamer moves capture and encoding into a GStreamer pipeline,
+        # BLACKBOX_CAMERA_SOURCE=videotestsrc runs it without a camera
+        self.engine_name = os.environ.get('BLACKBOX_CAMERA_ENGINE', 'opencv')
+        self.engine = None
+        self.cap = None
+        if self.engine_name != 'gstreamer':
+            self.cap = get_backend().video_capture(lambda: cv2.VideoCapture(0, cv2.CAP_V4L2))
+            if not self.cap.isOpened():
+                raise RuntimeError("Failed to open camera")
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+            self.cap.set(cv2.CAP_PROP_FPS, 20)
         self.count = 0
         self.link_local_streaming = "http://127.0.0.1:5001"
         self.accident_signal = 0
@@ -125,13 +134,18 @@ class CameraStream:
         
         # Buffer setup
         self.fps = 20
-        self.buffer_size = self.fps * 20  # 20 seconds buffer
-        self.frame_buffer = deque(maxlen=self.buffer_size)
+        self.pre_trigger_duration = 20  # seconds before trigger
+        self.jpeg_quality = 80
+        # Pre-trigger ring of JPEG frames, bounded by bytes rather than frame count
+        self.frame_buffer = EncodedFrameRing(max_bytes=32 * 1024 * 1024, max_age=self.pre_trigger_duration)
         self.frame_buffer_jpg = None  # Initialize frame buffer for JPEG
+        # Live stream JPEGs, encoded only for the profiles viewers ask for
+        self.stream_encoder = StreamEncoder(base_quality=self.jpeg_quality)
 
         # Recording state
         self.recording_triggered = False
         self.recording_start_time = None
+        self.recording_trigger_time = None
         
         # self.frame_buffer = None
         self.stream_active = True
@@ -155,11 +169,6 @@ class CameraStream:
         
         print(f"Images will be saved to: {self.save_dir}")  # Debug print
         
-        # Start threads for capturing video and simulating velocity
-        self.thread = threading.Thread(target=self._capture_loop)
-        self.thread.daemon = True
-        self.thread.start()
-        
         # Add recording queue
         self.recording_queue = deque()
         
@@ -168,9 +177,17 @@ class CameraStream:
         self.recording_start_time = None
         self.post_trigger_duration = 20  # seconds after trigger
         
-        self.thread = threading.Thread(target=self._recording_loop)
-        self.thread.daemon = True
-        self.thread.start()
+        if self.engine_name == 'gstreamer':
+            self._start_gstreamer()
+        else:
+            # Start threads for capturing video and simulating velocity
+            self.thread = threading.Thread(target=self._capture_loop)
+            self.thread.daemon = True
+            self.thread.start()
+            
+            self.thread = threading.Thread(target=self._recording_loop)
+            self.thread.daemon = True
+            self.thread.start()
         
         # self.simulate_velocity_thread = threading.Thread(target=self._simulate_velocity)
         # self.simulate_velocity_thread.daemon = True
@@ -248,26 +265,57 @@ class CameraStream:
         # except Exception as e:
         #     print(f"Error capturing image: {str(e)}")
 
+    def _start_gstreamer(self):
+        """Capture, overlay, JPEG and H.264 in GStreamer, Python only gets finished frames."""
+        from handle.gst_capture_handle import GstCaptureEngine, CAMERA_SOURCE, TEST_SOURCE
+        source = os.environ.get('BLACKBOX_CAMERA_SOURCE', 'camera')
+        source = {'camera': CAMERA_SOURCE, 'videotestsrc': TEST_SOURCE}.get(source, source)
+        self.latest_frame = None
+        self.last_overlay_update = 0
+        self.engine = GstCaptureEngine(self.record_handler.output_dir, source=source, fps=self.fps,
+                                       jpeg_quality=self.jpeg_quality, pre_trigger=self.pre_trigger_duration,
+                                       on_jpeg=self._on_gst_jpeg, on_frame=self._on_gst_frame)
+        self.engine.start()
+
+    def _on_gst_jpeg(self, jpeg, timestamp):
+        with frame_lock:
+            self.frame_buffer_jpg = jpeg
+        self.stream_encoder.publish(self.latest_frame, jpeg)
+
+    def _on_gst_frame(self, frame, timestamp):
+        self.latest_frame = frame
+        # The overlay is drawn by the pipeline, only its text comes from here
+        if timestamp - self.last_overlay_update >= 1.0:
+            self.last_overlay_update = timestamp
+            warning = "  SPEED WARNING!" if self.current_velocity > self.thresold_speed else ""
+            self.engine.set_overlay(f"Speed: {self.current_velocity:.1f} km/h{warning}\n"
+                                    f"GPS: {self.latitude} N, {self.longitude} W")
+
     def _capture_loop(self):
         """Capture frames and manage the pre-trigger buffer."""
         while self.stream_active:
             if self.cap.isOpened():
                 ret, frame = self.cap.read()
                 if ret:
+                    start_cpu = time.thread_time()
                     # Add timestamp to frame
                     frame_with_timestamp = self.add_timestamp_to_frame(frame)
                     
-                    # Store frame in the pre-trigger circular buffer
-                    self.frame_buffer.append(frame_with_timestamp.copy())
+                    # Encode once, the same JPEG feeds the pre-trigger ring, the stream and the recording
+                    _, buffer = cv2.imencode('.jpg', frame_with_timestamp, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                    jpeg = buffer.tobytes()
+                    self.frame_buffer.append(jpeg)
                     
-                    # Update JPEG buffer for live streaming
                     with frame_lock:
-                        _, buffer = cv2.imencode('.jpg', frame_with_timestamp)
-                        self.frame_buffer_jpg = buffer.tobytes()
+                        self.frame_buffer_jpg = jpeg
+                    
+                    # Live streaming, no extra work unless someone is watching
+                    served = self.stream_encoder.publish(frame_with_timestamp, jpeg)
                     
                     # If recording is triggered, add frame to the recording queue
                     if self.recording_triggered:
-                        self.recording_queue.append(frame_with_timestamp)
+                        self.recording_queue.append(jpeg)
+                    self.stream_encoder.record_cpu(time.thread_time() - start_cpu, served)
             time.sleep(1/self.fps)
 
     def _recording_loop(self):
@@ -277,30 +325,32 @@ class CameraStream:
                 print("Starting recording with pre-trigger buffer...")
                 self.recording_start_time = time.time()
 
-                # Write pre-trigger frames to the recording
-                pre_trigger_frames = list(self.frame_buffer)  # Get all frames from buffer (20 seconds)
-                if pre_trigger_frames:
-                    self.record_handler.start_recording(pre_trigger_frames[0])  # Start with the first frame
-                    for frame in pre_trigger_frames:
-                        self.record_handler.add_frame_to_record(frame)
+                # Write pre-trigger frames to the recording, copied into the MJPEG file as they are.
+                # Frames from the trigger on are already in the recording queue
+                pre_trigger_frames = [jpeg for timestamp, jpeg in self.frame_buffer.snapshot()
+                                      if timestamp < self.recording_trigger_time]
+                # Size the clip from the first frame that decodes
+                if any(self.record_handler.start_recording(jpeg) for jpeg in pre_trigger_frames):
+                    for jpeg in pre_trigger_frames:
+                        self.record_handler.add_jpeg_to_record(jpeg)
 
-            # Write frames from the recording queue
+            # Hand queued frames to the writer process, it waits only when the writer is full
             while self.recording_queue and self.record_handler.is_recording():
-                frame = self.recording_queue.popleft()
-                self.record_handler.add_frame_to_record(frame)
-                
-                # Add a delay to maintain FPS consistency
-                time.sleep(1 / self.fps)  # Sleep to match frame rate
+                jpeg = self.recording_queue.popleft()
+                self.record_handler.add_jpeg_to_record(jpeg)
 
             # Check if post-trigger duration has elapsed
             if self.recording_triggered and self.recording_start_time:
                 elapsed_time = time.time() - self.recording_start_time
-                if elapsed_time >= 20.0:  # 20 seconds post-trigger
+                if elapsed_time >= self.post_trigger_duration:
                     print("Stopping recording after post-trigger duration...")
                     self.recording_triggered = False
                     self.recording_start_time = None
+                    # Flush what was captured up to now, then finalise within the writer's bound
+                    while self.recording_queue:
+                        self.record_handler.add_jpeg_to_record(self.recording_queue.popleft())
                     self.record_handler.stop_recording()
-                    self.recording_queue.clear()
+                    print(f"Accident clip finalised {time.time() - self.recording_trigger_time:.1f}s after trigger")
 
             time.sleep(0.01)
         
@@ -438,57 +488,63 @@ class CameraStream:
     
     def trigger_recording(self):
         """Trigger recording with buffer"""
+        if self.engine is not None:
+            # The pipeline already holds the pre-trigger video as H.264 fragments
+            if not self.engine.is_recording():
+                self.engine.trigger(self.post_trigger_duration)
+            return
         if not self.recording_triggered:
+            self.recording_trigger_time = time.time()
             self.recording_triggered = True
             print("Recording triggered with buffer...")
             
     def fetch_accelerometer_data(self):
+        """Feed every IMU sample from the full-rate ring buffer to the accident detector."""
+        ring = self.sensor_handler.bno055.ring
+        next_seq = ring.count
         while self.stream_active:
             try:
-                with threading.Lock():
-                    self.acclerometer_detect = self.sensor_handler.acc_detect_accident
-                    print(f"acclerometer_detect from camera_gstreamer.py is {self.acclerometer_detect}")
-                    timestamp = time.time()
-                    
-                    # Process acceleration data through accident detector
-                    status = self.accident_detector.process_acceleration(self.acclerometer_detect, timestamp)
-                    
-                    if status == "POTENTIAL_ACCIDENT":
-                        print("Potential accident detected from acceleration!")
-                        # Don't trigger recording yet, wait for speed confirmation
-                        
-                # self.acclerometer_detect = self.sensor_handler.acc_detect_accident
-                # print(f"acclerometer_detect from camera_gstreamer.py is {self.acclerometer_detect}")
+                timestamps, data, next_seq = ring.since(next_seq)
+                if len(timestamps):
+                    # Vectorised magnitude over the whole batch, views of the ring, no copies
+                    magnitudes = np.linalg.norm(ring.channel(data, 'accel'), axis=1)
+                    self.acclerometer_detect = float(magnitudes[-1])
+                    for acc_value, timestamp in zip(magnitudes, timestamps):
+                        # Process acceleration data through accident detector
+                        status = self.accident_detector.process_acceleration(acc_value, timestamp)
+                        if status == "POTENTIAL_ACCIDENT":
+                            print("Potential accident detected from acceleration!")
+                            # Don't trigger recording yet, wait for speed confirmation
             except Exception as e:
                 print(f"Error fetching acc data: {e}")  
                   
-            # threading.Event().wait(0.015)  # Short delay (~66Hz loop)
-            threading.Event().wait(1)
+            threading.Event().wait(0.2)
     
     def fetch_gps_speed_data(self):
-        while self.stream_active:
+        """Check speed on every GPS fix as it arrives, or every second when no fix comes."""
+        for fix in self.sensor_handler.gps.fixes(timeout=1):
+            if not self.stream_active:
+                break
             try:
-                with threading.Lock():
-                    self.latitude = self.sensor_handler.latitude
-                    self.longitude = self.sensor_handler.longitude
-                    self.address_no_accent = self.sensor_handler.address_no_accent
-                    current_speed = self.sensor_handler.velocity
-                    timestamp = time.time()
-                    
-                    # Update current velocity
-                    self.current_velocity = current_speed
-                    print(f"address_no_accent in camera_gstreamer.py is {self.address_no_accent}")
-                    
-                    # Process speed through accident detector
-                    status = self.accident_detector.process_speed(current_speed, timestamp)
-                    
-                    if status == "ACCIDENT":
-                        print("Accident confirmed! Triggering emergency response...")
-                        self.handle_accident()
+                if fix is not None:
+                    self.latitude = fix.latitude
+                    self.longitude = fix.longitude
+                self.address_no_accent = getattr(self.sensor_handler, 'address_no_accent', "Unknown")
+                current_speed = self.sensor_handler.velocity
+                timestamp = fix.timestamp if fix is not None else time.time()
+                
+                # Update current velocity
+                self.current_velocity = current_speed
+                print(f"address_no_accent in camera_gstreamer.py is {self.address_no_accent}")
+                
+                # Process speed through accident detector
+                status = self.accident_detector.process_speed(current_speed, timestamp)
+                
+                if status == "ACCIDENT":
+                    print("Accident confirmed! Triggering emergency response...")
+                    self.handle_accident()
             except Exception as e:
                 print(f"Error fetching gps & speed data: {e}")  
-                  
-            threading.Event().wait(1)
     
     def handle_accident(self):
         """Handle confirmed accident detection"""
@@ -508,14 +564,13 @@ class CameraStream:
             # Send MQTT alert
             self.accident_signal = 1
             payload = self.mqtt_client.create_payload_accident_signal(self.accident_signal)
-            ret = self.mqtt_client.publish(payload)
-            
-            if ret.rc == paho.MQTT_ERR_SUCCESS:
-                print("Accident signal published successfully")
-                # Reset accident signal after short delay
-                threading.Timer(2.0, self.reset_accident_signal).start()
+            # Logged to the critical lane before it is sent, so it is never lost offline
+            if self.sensor_handler.publish_event(payload, "accident"):
+                print("Accident signal queued for publishing")
             else:
-                print(f"Failed to publish accident signal, error code: {ret.rc}")
+                print("Accident signal buffered until the connection is back")
+            # Reset accident signal after short delay
+            threading.Timer(2.0, self.reset_accident_signal).start()
                 
         except Exception as e:
             print(f"Error handling accident: {e}")
@@ -524,7 +579,7 @@ class CameraStream:
         """Reset accident signal after alert"""
         self.accident_signal = 0
         payload = self.mqtt_client.create_payload_accident_signal(self.accident_signal)
-        self.mqtt_client.publish(payload)
+        self.sensor_handler.publish_event(payload, "accident")
         print("Accident signal reset")
                         
     def _keyboard_control(self):
@@ -548,15 +603,15 @@ class CameraStream:
                 
                 self.accident_signal = 1
                 payload = self.mqtt_client.create_payload_accident_signal(self.accident_signal)
-                ret = self.mqtt_client.publish(payload)
-                if ret.rc == paho.MQTT_ERR_SUCCESS:
-                    print(f"Accident signal published successfully. Its value is {self.accident_signal}")
-                    self.accident_signal = 0
-                    payload = self.mqtt_client.create_payload_accident_signal(self.accident_signal) # send 0 to turn off accident signal
-                    ret = self.mqtt_client.publish(payload)
-                    print(f"Accident signal down published successfully. Its value is {self.accident_signal}")
+                if self.sensor_handler.publish_event(payload, "accident"):
+                    print(f"Accident signal queued for publishing. Its value is {self.accident_signal}")
                 else:
-                    print(f"Failed to publish accident signal, error code: {ret.rc}")
+                    print("Accident signal buffered until the connection is back")
+                # Buffered signals are sent in order, so the reset always follows
+                self.accident_signal = 0
+                payload = self.mqtt_client.create_payload_accident_signal(self.accident_signal) # send 0 to turn off accident signal
+                self.sensor_handler.publish_event(payload, "accident")
+                print(f"Accident signal down queued for publishing. Its value is {self.accident_signal}")
                 
             elif key == 'exit':
                 print("Exiting keyboard control")
@@ -569,6 +624,9 @@ class CameraStream:
 
     def stop(self):
         self.stream_active = False
+        self.stream_encoder.close()
+        if self.engine is not None:
+            self.engine.stop()
         if hasattr(self, 'thread'):
             self.thread.join()
         if self.cap:
@@ -577,45 +635,54 @@ class CameraStream:
     def start_cloudflared_tunnel(self):
         """Starts cloudflared tunnel with additional parameters and retrieves the URL for ThingsBoard."""
         def run_tunnel():
-            print("Calling command cloudflare...", flush=True)
-            process = subprocess.Popen(
-                [
-                    "cloudflared", "tunnel", "--url", "http://localhost:5000",
-                    "--http2-origin", "--no-chunked-encoding",
-                    "--proxy-keepalive-timeout", "120s", "--proxy-connection-timeout", "120s"
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,  # Merge stderr into stdout
-                universal_newlines=True,
-                bufsize=1
-            )
-            print("Done call command cloudflare!", flush=True)
+            # The device may boot offline: a quick tunnel that cannot reach Cloudflare exits, so start it again
+            delay = 5
+            while self.stream_active:
+                started = time.time()
+                self.count = 0  # Every run gets a new URL, publish it
+                print("Calling command cloudflare...", flush=True)
+                process = subprocess.Popen(
+                    [
+                        "cloudflared", "tunnel", "--url", "http://localhost:5000",
+                        "--http2-origin", "--no-chunked-encoding",
+                        "--proxy-keepalive-timeout", "120s", "--proxy-connection-timeout", "120s"
+                    ],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,  # Merge stderr into stdout
+                    universal_newlines=True,
+                    bufsize=1
+                )
+                print("Done call command cloudflare!", flush=True)
             
-            try:
-                for line in iter(process.stdout.readline, ''):
-                    line = line.strip()
-                    print(line, flush=True)  # Print each line of output
-
-                    # Check for the line with the URL
-                    if "https://" in line:
-                        url_match = re.search(r"https://[\w-]+\.trycloudflare\.com", line)
-                        if url_match:
-                            tunnel_url = url_match.group(0)
-                            print(f"Tunnel URL: {tunnel_url}")
-                            # Push Serveo URL to MQTT
-                            if self.count == 0:
-                                payload = self.mqtt_client.create_payload_URL_camera(tunnel_url, self.link_local_streaming)
-                                ret = self.mqtt_client.publish(payload)
-                                if ret.rc == paho.MQTT_ERR_SUCCESS:
-                                    print("URL published successfully")
-                                    self.count = 1
-                                else:
-                                    print(f"Failed to publish URL, error code: {ret.rc}")
-            except Exception as e:
-                print(f"Error reading output: {e}", flush=True)
-            finally:
-                process.stdout.close()
-                process.wait()
+                try:
+                    for line in iter(process.stdout.readline, ''):
+                        line = line.strip()
+                        print(line, flush=True)  # Print each line of output
+
+                        # Check for the line with the URL
+                        if "https://" in line:
+                            url_match = re.search(r"https://[\w-]+\.trycloudflare\.com", line)
+                            if url_match:
+                                tunnel_url = url_match.group(0)
+                                print(f"Tunnel URL: {tunnel_url}")
+                                # Push Serveo URL to MQTT
+                                if self.count == 0:
+                                    payload = self.mqtt_client.create_payload_URL_camera(tunnel_url, self.link_local_streaming)
+                                    if self.mqtt_client.publish(payload, "camera_url"):
+                                        print("URL queued for publishing")
+                                        self.count = 1
+                                    else:
+                                        print("Failed to queue URL")
+                except Exception as e:
+                    print(f"Error reading output: {e}", flush=True)
+                finally:
+                    process.stdout.close()
+                    process.wait()
+                if time.time() - started > 60:
+                    delay = 5  # It ran for a while, the link was up
+                print(f"cloudflared exited, restarting in {delay}s", flush=True)
+                time.sleep(delay)
+                delay = min(delay * 2, 120)
 
         tunnel_thread = threading.Thread(target=run_tunnel)
         tunnel_thread.daemon = True
@@ -635,24 +702,32 @@ def initialize_camera(mqtt_client, record_handler, sensor_handler):
     camera = CameraStream(mqtt_client, record_handler, sensor_handler)
     return camera
 
-def generate_frames():
+def generate_frames(profile):
     viewer_id = threading.get_ident()
     active_viewers.add(viewer_id)
+    stream_encoder = camera.stream_encoder
+    viewer = stream_encoder.add_viewer(viewer_id, profile)
+    last_sequence = 0
     
     try:
         while True:
             if not camera or not camera.stream_active:
                 break
             try:
-                frame = camera.get_frame()
-                if frame is not None:
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-                time.sleep(1/30)
+                # Sleeps until the capture loop publishes a newer frame, never resends one
+                latest = stream_encoder.wait(profile, last_sequence)
+                if latest is None:
+                    continue
+                sequence, frame, published = latest
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+                stream_encoder.delivered(viewer, sequence, last_sequence, published)
+                last_sequence = sequence
             except Exception as e:
                 print(f"Error generating frame: {e}")
                 break
     finally:
+        stream_encoder.remove_viewer(viewer_id)
         active_viewers.discard(viewer_id)
 
 @app.route('/')
@@ -661,7 +736,14 @@ def index():
 
 @app.route('/video_feed')
 def video_feed():
-    return Response(generate_frames(),
+    """MJPEG stream, optionally /video_feed?quality=50&scale=0.5 for a lighter one."""
+    if not camera:
+        return jsonify({"error": "No active video stream"}), 500
+    try:
+        profile = camera.stream_encoder.profile(request.args.get('quality'), request.args.get('scale'))
+    except ValueError:
+        return jsonify({"error": "quality must be an integer and scale a number"}), 400
+    return Response(generate_frames(profile),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/restart_stream', methods=['POST'])
@@ -679,10 +761,31 @@ def restart_stream():
 def get_viewer_count():
     return jsonify({"count": len(active_viewers)})
 
+@app.route('/stream_stats')
+def stream_stats():
+    if not camera:
+        return jsonify({"error": "No active video stream"}), 500
+    stats = {"encoder": camera.stream_encoder.stats(), "viewers": camera.stream_encoder.viewer_stats()}
+    if camera.engine is not None:
+        stats["capture"] = camera.engine.stats()
+    else:
+        stats["pre_trigger"] = camera.frame_buffer.stats()
+        stats["recording"] = camera.record_handler.stats()
+    return jsonify(stats)
+
 def cleanup():
     global camera
     if camera:
         camera.stop()
+        # The signal handler ends with os._exit, so main's shutdown path never runs: shut everything down here
+        for name, shutdown in (("recording", camera.record_handler.close),  # Finalise the clip
+                               ("MQTT", camera.mqtt_client.stop),  # Undelivered messages go back to the buffer
+                               ("sensors", camera.sensor_handler.cleanup)):  # Save the address cache, close the logs
+            try:
+                shutdown()
+            except Exception as e:
+                print(f"Error shutting down {name}: {e}")
+    get_backend().flush()  # Keep the sensor recording up to the shutdown
 
 def signal_handler(signum, frame):
     cleanup()
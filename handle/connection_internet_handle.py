@@ -1,35 +1,159 @@
 # connection_internet_handle.py
+import errno
+import select
+import socket
 import threading
 import time
-import subprocess
+from collections import deque
 
-PING_HOST = "8.8.8.8"  # Host to ping for connection check
-connection_status = False  # Global variable to store connection status
+from iot.mqtt.publish import BROKER, PORT
 
-def check_internet_connection():
-    """Ping a reliable host to check for an internet connection."""
-    try:
-        subprocess.check_call(['ping', '-c', '1', PING_HOST], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return True
-    except subprocess.CalledProcessError:
-        return False
+PROBE_HOST = BROKER  # Probe the MQTT broker itself, that is the link that matters
+PROBE_PORT = PORT
+
+
+class ConnectionMonitor:
+    """
+    Tracks connectivity with non-blocking TCP connects to the broker.
+    RTT and loss are kept over a moving window of probes. Paho connect and
+    disconnect events feed in immediately, and subscribers are called only
+    when the link goes up or down.
+    """
+
+    def __init__(self, host=PROBE_HOST, port=PROBE_PORT, timeout=2.0, interval_up=10.0,
+                 interval_down=2.0, window=20, down_after=2):
+        """
+        Parameters:
+            timeout (float): Seconds to wait for a probe connect.
+            interval_up, interval_down (float): Seconds between probes while the link is up / down.
+            window (int): Number of probes kept for RTT and loss.
+            down_after (int): Consecutive failed probes before the link is declared down.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.interval_up = interval_up
+        self.interval_down = interval_down
+        self.down_after = down_after
+        self.probes = deque(maxlen=window)  # (ok, rtt in seconds)
+        self.consecutive_failures = 0
+        self.is_up = False
+        self.up_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.running = False
+
+    def probe(self):
+        """One non-blocking TCP connect. Returns the RTT in seconds, or None on failure."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            start = time.perf_counter()
+            rc = sock.connect_ex((self.host, self.port))
+            if rc not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                return None
+            _, writable, _ = select.select([], [sock], [], self.timeout)
+            if not writable or sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                return None
+            return time.perf_counter() - start
+        except OSError:
+            return None
+        finally:
+            sock.close()
+
+    def record_probe(self, rtt):
+        with self.lock:
+            self.probes.append((rtt is not None, rtt))
+            self.consecutive_failures = 0 if rtt is not None else self.consecutive_failures + 1
+        if rtt is not None:
+            self._set_status(True)
+        elif self.consecutive_failures >= self.down_after:
+            self._set_status(False)
+
+    def _set_status(self, is_up):
+        with self.lock:
+            changed = is_up != self.is_up
+            self.is_up = is_up
+        if is_up:
+            self.up_event.set()
+        else:
+            self.up_event.clear()
+        if not changed:
+            return
+        print("Connected to the internet." if is_up else "No internet connection.")
+        for callback in list(self.subscribers):
+            try:
+                callback(is_up)
+            except Exception as e:
+                print(f"Error in connection status subscriber: {e}")
+
+    def subscribe(self, callback):
+        """Register callback(is_up) for link up/down changes."""
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def report_broker_connected(self):
+        """Paho on_connect: the link is evidently up."""
+        with self.lock:
+            self.consecutive_failures = 0
+        self._set_status(True)
+
+    def report_broker_disconnected(self):
+        """Paho on_disconnect: probe right away instead of waiting for the next interval."""
+        self.wake_event.set()
+
+    def stats(self):
+        """Return status, average/last RTT (ms) and loss ratio over the probe window."""
+        with self.lock:
+            probes = list(self.probes)
+        rtts = [rtt for ok, rtt in probes if ok]
+        return {
+            'up': self.is_up,
+            'probes': len(probes),
+            'loss': (len(probes) - len(rtts)) / len(probes) if probes else None,
+            'rtt_avg_ms': 1000 * sum(rtts) / len(rtts) if rtts else None,
+            'rtt_last_ms': 1000 * rtts[-1] if rtts else None,
+        }
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.record_probe(self.probe())
+            self.wake_event.wait(self.interval_up if self.is_up else self.interval_down)
+            self.wake_event.clear()
+
+    def stop(self):
+        self.running = False
+        self.wake_event.set()
+
+
+monitor = ConnectionMonitor()  # Shared monitor used through the module functions below
 
 def monitor_connection():
     """Continuously monitor internet connection in a separate thread."""
-    global connection_status
-    while True:
-        connection_status = check_internet_connection()
-        if connection_status:
-            print("Connected to the internet.")
-        else:
-            print("No internet connection.")
-        time.sleep(5) 
+    monitor.run()
 
 def get_connection_status():
     """Return the current connection status."""
-    print(f"Connection status is {connection_status}")
-    return connection_status
+    return monitor.is_up
+
+def wait_for_connection(timeout=None):
+    """Block until the link is up. Returns False on timeout."""
+    return monitor.up_event.wait(timeout)
+
+def subscribe(callback):
+    """Register callback(is_up) for link up/down changes."""
+    monitor.subscribe(callback)
+
+def report_broker_connected():
+    monitor.report_broker_connected()
+
+def report_broker_disconnected():
+    monitor.report_broker_disconnected()
 
-# Start the connection monitor thread when the module is imported
-# monitor_thread = threading.Thread(target=monitor_connection, daemon=True)
-# monitor_thread.start()
+def get_link_stats():
+    return monitor.stats()
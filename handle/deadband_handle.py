@@ -0,0 +1,76 @@
+# Thesis/handle/deadband_handle.py
+import json
+import time
+import threading
+
+
+class DeadbandFilter:
+    """Report-by-exception filter for telemetry payloads.
+
+    A key is only sent again when its value moved more than its deadband since
+    it was last sent, or when it has been silent for `max_silence` seconds
+    (heartbeat). Payloads with no key left are suppressed entirely. ThingsBoard
+    keeps the latest value of every key, so partial payloads are safe.
+    """
+
+    # Per-key deadbands in the payload units, keys not listed use default_threshold
+    DEFAULT_THRESHOLDS = {
+        'Temperature': 0.25,        # °C
+        'Longitude': 0.00002,       # ~2 m
+        'Latitude': 0.00002,
+        'Speed': 0.5,               # km/h
+        'Accelerometer X': 0.2,     # m/s²
+        'Accelerometer Y': 0.2,
+        'Accelerometer Z': 0.2,
+        'AccLinearX': 0.2,
+    }
+
+    def __init__(self, thresholds=None, default_threshold=0.0, max_silence=60.0):
+        """
+        Parameters:
+            thresholds (dict): Deadband per payload key, merged over DEFAULT_THRESHOLDS.
+            default_threshold (float): Deadband for numeric keys without their own entry.
+            max_silence (float): Seconds after which a key is re-sent even if unchanged.
+        """
+        self.thresholds = dict(self.DEFAULT_THRESHOLDS, **(thresholds or {}))
+        self.default_threshold = default_threshold
+        self.max_silence = max_silence
+        self.last_sent = {}  # (sensor_type, key) -> (value, time sent)
+        self.lock = threading.Lock()
+        self.stats = {'payloads': 0, 'suppressed': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    def _changed(self, key, value, last_value):
+        numeric = (int, float)
+        if isinstance(value, numeric) and isinstance(last_value, numeric) and not isinstance(value, bool):
+            return abs(value - last_value) > self.thresholds.get(key, self.default_threshold)
+        return value != last_value
+
+    def filter(self, sensor_type, payload):
+        """Return the payload reduced to keys worth sending, or None if nothing changed."""
+        values = json.loads(payload)
+        now = time.time()
+        report = {}
+        with self.lock:
+            for key, value in values.items():
+                last = self.last_sent.get((sensor_type, key))
+                if last is None or now - last[1] >= self.max_silence or self._changed(key, value, last[0]):
+                    report[key] = value
+                    self.last_sent[(sensor_type, key)] = (value, now)
+
+            filtered = json.dumps(report) if report else None
+            self.stats['payloads'] += 1
+            self.stats['bytes_in'] += len(payload)
+            if filtered is None:
+                self.stats['suppressed'] += 1
+            else:
+                self.stats['bytes_out'] += len(filtered)
+        return filtered
+
+    def reset(self, sensor_type=None):
+        """Forget last sent values so the next payload goes out in full."""
+        with self.lock:
+            if sensor_type is None:
+                self.last_sent.clear()
+            else:
+                for key in [k for k in self.last_sent if k[0] == sensor_type]:
+                    del self.last_sent[key]
@@ -0,0 +1,218 @@
+# Thesis/handle/geocode_handle.py
+import os
+import json
+import math
+import time
+import threading
+from collections import OrderedDict
+
+from unidecode import unidecode
+
+from sensors.GPS.GPS_lib import haversine
+
+CACHE_FILE = os.path.join(os.path.dirname(__file__), 'geocode_cache.json')
+METERS_PER_DEGREE = 111320.0
+
+
+class GeocodeTileCache:
+    """
+    LRU cache of addresses keyed by square map tiles of about `tile_size` meters.
+    Every position inside a tile shares its address, so a parked or slow car
+    keeps hitting the same entry. Persisted as JSON so tiles survive a reboot.
+    """
+
+    def __init__(self, path=CACHE_FILE, tile_size=100.0, max_entries=5000):
+        self.path = path
+        self.tile_size = tile_size
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # tile key -> address, least recently used first
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.load()
+
+    def tile_key(self, latitude, longitude):
+        lat_step = self.tile_size / METERS_PER_DEGREE
+        row = math.floor(latitude / lat_step)
+        # Longitude step for the row, so tiles stay roughly square away from the equator
+        lon_step = lat_step / max(math.cos(math.radians((row + 0.5) * lat_step)), 1e-6)
+        return f"{row},{math.floor(longitude / lon_step)}"
+
+    def get(self, latitude, longitude):
+        key = self.tile_key(latitude, longitude)
+        with self.lock:
+            address = self.entries.get(key)
+            if address is not None:
+                self.entries.move_to_end(key)
+            return address
+
+    def put(self, latitude, longitude, address):
+        key = self.tile_key(latitude, longitude)
+        with self.lock:
+            self.entries[key] = address
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                cache = json.load(f)
+            if cache.get('tile_size') == self.tile_size:
+                self.entries = OrderedDict(cache.get('entries', []))
+                print(f"Loaded {len(self.entries)} cached addresses")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Error loading geocode cache: {e}")
+
+    def save(self):
+        """Write the cache to disk if it changed since the last save."""
+        with self.lock:
+            if not self.dirty:
+                return
+            cache = {'tile_size': self.tile_size, 'entries': list(self.entries.items())}
+            self.dirty = False
+        try:
+            tmp_file = self.path + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            print(f"Error saving geocode cache: {e}")
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ReverseGeocoder:
+    """
+    Non-blocking reverse geocoding for the GPS loop.
+    update() returns immediately: positions within `min_distance` meters of
+    the last lookup are skipped, cached tiles answer at once, and anything
+    else goes to a single worker thread that calls the network geocoder. Only
+    the newest pending position is looked up, older ones are dropped.
+
+    With an offline index, a cache miss is answered at once from the local
+    dataset: in 'fallback' mode that address stands until the network lookup
+    replaces it (and keeps standing if the network is down), in 'primary' mode
+    the network is only asked where the index has nothing nearby.
+    """
+
+    def __init__(self, lookup=None, cache=None, min_distance=50.0, save_interval=60.0,
+                 offline=None, offline_mode='fallback'):
+        """
+        Parameters:
+            lookup (callable): (latitude, longitude) -> address string, blocking.
+                Defaults to Nominatim.
+            cache (GeocodeTileCache): Tile cache, a persisted default one if None.
+            min_distance (float): Meters the car must move before looking up again.
+            save_interval (float): Seconds between cache saves by the worker.
+            offline (OfflineGeocoder): Local index, or None for network only.
+            offline_mode (str): 'fallback' or 'primary', see above.
+        """
+        if offline_mode not in ('fallback', 'primary'):
+            raise ValueError(f"Unknown offline_mode {offline_mode!r}")
+        self.lookup = lookup or self._nominatim_lookup
+        self.cache = cache or GeocodeTileCache()
+        self.offline = offline
+        self.offline_mode = offline_mode
+        self.min_distance = min_distance
+        self.save_interval = save_interval
+        self.address = "Unknown"
+        self.last_position = None  # Position the current address was obtained for
+        self.pending = None  # Newest position waiting for the worker
+        self.condition = threading.Condition()
+        self.running = True
+        self.last_save = time.time()
+        self.geolocator = None
+        self.metrics = {'updates': 0, 'skipped': 0, 'hits': 0, 'misses': 0, 'lookups': 0, 'errors': 0,
+                        'lookup_time': 0.0, 'offline': 0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _nominatim_lookup(self, latitude, longitude):
+        if self.geolocator is None:
+            from geopy.geocoders import Nominatim
+            self.geolocator = Nominatim(user_agent="geoapi", timeout=10)
+        location = self.geolocator.reverse((latitude, longitude), language="en")
+        return location.address if location else None
+
+    def update(self, latitude, longitude):
+        """Feed a new position. Returns the current best address without waiting."""
+        self.metrics['updates'] += 1
+        if self.last_position is not None and \
+                haversine(longitude, latitude, self.last_position[1], self.last_position[0]) < self.min_distance:
+            self.metrics['skipped'] += 1
+            return self.address
+
+        address = self.cache.get(latitude, longitude)
+        if address is not None:
+            self.metrics['hits'] += 1
+            self.address = address
+            self.last_position = (latitude, longitude)
+            return address
+        self.metrics['misses'] += 1
+        # Offline answers are not cached, so a later network lookup can still improve the tile
+        address = self.offline.lookup(latitude, longitude) if self.offline is not None else None
+        if address is not None:
+            self.metrics['offline'] += 1
+            self.address = unidecode(address)
+            self.last_position = (latitude, longitude)
+            if self.offline_mode == 'primary':
+                return self.address
+        with self.condition:
+            self.pending = (latitude, longitude)
+            self.condition.notify()
+        return self.address
+
+    def get_address(self):
+        return self.address
+
+    def _run(self):
+        while self.running:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or not self.running, self.save_interval)
+                position, self.pending = self.pending, None
+            if position is not None:
+                self._resolve(*position)
+            if time.time() - self.last_save >= self.save_interval:
+                self.cache.save()
+                self.last_save = time.time()
+
+    def _resolve(self, latitude, longitude):
+        start = time.time()
+        self.metrics['lookups'] += 1
+        try:
+            address = self.lookup(latitude, longitude)
+        except Exception as e:
+            self.metrics['errors'] += 1
+            print(f"Reverse geocoding failed: {e}")
+            return
+        finally:
+            self.metrics['lookup_time'] += time.time() - start
+        if address:
+            address = unidecode(address)
+            self.cache.put(latitude, longitude, address)
+            self.address = address
+            # Only a resolved position stops nearby updates, a failed one is retried on the next update
+            self.last_position = (latitude, longitude)
+
+    def stats(self):
+        """Return counters plus the cache hit rate over positions that needed an address."""
+        metrics = dict(self.metrics)
+        answered = metrics['hits'] + metrics['misses']
+        metrics['hit_rate'] = metrics['hits'] / answered if answered else None
+        # Stationary skips are answered without any lookup as well
+        metrics['network_free_rate'] = 1 - metrics['lookups'] / metrics['updates'] if metrics['updates'] else None
+        metrics['avg_lookup_time'] = metrics['lookup_time'] / metrics['lookups'] if metrics['lookups'] else None
+        metrics['offline_rate'] = metrics['offline'] / metrics['misses'] if metrics['misses'] else None
+        metrics['cached_tiles'] = len(self.cache)
+        return metrics
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout=1)
+        self.cache.save()
@@ -0,0 +1,312 @@
+# Thesis/handle/gst_capture_handle.py
+# GStreamer capture engine: one pipeline captures, overlays and encodes, Python only
+# receives finished JPEGs, analytics frames and closed H.264 fragments.
+#
+#                                       +-> queue -> jpegenc -> appsink 'jpeg'         (live stream)
+#   source -> overlays -> tee ---------+-> queue -> H.264 -> splitmuxsink 'preroll'   (fragment ring)
+#                                       +-> queue -> BGR -> appsink 'analytics'        (frames for Python)
+#
+# Try it without a camera:
+#   python -m handle.gst_capture_handle --source videotestsrc --seconds 40 --trigger-at 25
+import os
+import time
+import shutil
+import threading
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+Gst.init(None)
+
+CAMERA_SOURCE = 'v4l2src device=/dev/video0'
+TEST_SOURCE = 'videotestsrc is-live=true pattern=ball'
+# Hardware encoder on the Pi, x264 elsewhere; {gop} is frames between keyframes
+H264_ENCODERS = {
+    'v4l2h264enc': 'v4l2h264enc extra-controls="controls,repeat_sequence_header=1,h264_i_frame_period={gop}" '
+                   '! video/x-h264,level=(string)4',
+    'x264enc': 'x264enc tune=zerolatency speed-preset=ultrafast bitrate={bitrate} key-int-max={gop}',
+}
+
+
+def pick_h264_encoder():
+    for name in H264_ENCODERS:
+        if Gst.ElementFactory.find(name) is not None:
+            return name
+    raise RuntimeError("No H.264 encoder available, install gstreamer1.0-plugins-ugly for x264enc")
+
+
+def default_preroll_dir():
+    """Fragments are rewritten constantly, keep them in RAM when /dev/shm exists."""
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm/blackbox_preroll'
+    return os.path.join(os.path.dirname(__file__), 'record_video', 'preroll')
+
+
+class GstCaptureEngine:
+    """
+    Capture, overlay, JPEG and H.264 encoding in one GStreamer pipeline.
+    The H.264 branch writes fixed-length MP4 fragments through splitmuxsink,
+    keeping only the newest `max-files`, which makes the pre-trigger buffer a
+    ring on disk (tmpfs) instead of frames in Python memory. trigger() moves the
+    closed fragments covering the pre-trigger window into a clip directory and
+    keeps collecting fragments until the post-trigger window ends.
+    """
+
+    def __init__(self, clip_dir, source=CAMERA_SOURCE, width=640, height=480, fps=20, jpeg_quality=80,
+                 pre_trigger=20.0, fragment_duration=5.0, bitrate=2000, encoder=None, preroll_dir=None,
+                 on_jpeg=None, on_frame=None):
+        """
+        Parameters:
+            clip_dir (str): Directory accident clips are stored under.
+            source (str): Source element description, e.g. TEST_SOURCE.
+            pre_trigger (float): Seconds of video kept before a trigger.
+            fragment_duration (float): Seconds per MP4 fragment, the granularity of a clip.
+            bitrate (int): x264enc bitrate in kbit/s.
+            encoder (str): Key of H264_ENCODERS, picked automatically if None.
+            on_jpeg (callable): (jpeg bytes, timestamp) for every encoded stream frame.
+            on_frame (callable): (BGR ndarray, timestamp) for analytics.
+        """
+        self.clip_dir = clip_dir
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.fragment_duration = fragment_duration
+        self.preroll_dir = preroll_dir or default_preroll_dir()
+        self.on_jpeg = on_jpeg
+        self.on_frame = on_frame
+        os.makedirs(self.preroll_dir, exist_ok=True)
+        os.makedirs(self.clip_dir, exist_ok=True)
+        # Enough fragments for the pre-trigger window plus the one being written
+        self.max_files = int(np.ceil(pre_trigger / fragment_duration)) + 2
+        self.encoder = encoder or pick_h264_encoder()
+
+        self.pipeline_description = (
+            f'{source} ! video/x-raw,width={width},height={height},framerate={fps}/1 ! videoconvert ! '
+            f'clockoverlay text="DASHCAM PRO" time-format="%Y-%m-%d %H:%M:%S" '
+            f'halignment=left valignment=top shaded-background=true ! '
+            f'textoverlay name=overlay text="" halignment=left valignment=bottom shaded-background=true ! '
+            f'tee name=t '
+            f't. ! queue leaky=downstream max-size-buffers=2 ! jpegenc quality={jpeg_quality} ! '
+            f'appsink name=jpeg max-buffers=2 drop=true sync=false '
+            f't. ! queue max-size-buffers=0 max-size-bytes=0 max-size-time=2000000000 ! '
+            f'videoconvert ! video/x-raw,format=I420 ! '
+            f'{H264_ENCODERS[self.encoder].format(gop=fps, bitrate=bitrate)} ! h264parse ! '
+            f'splitmuxsink name=preroll location={os.path.join(self.preroll_dir, "fragment%05d.mp4")} '
+            f'max-size-time={int(fragment_duration * Gst.SECOND)} max-files={self.max_files} '
+            f'send-keyframe-requests=true '
+            f't. ! queue leaky=downstream max-size-buffers=2 ! videoconvert ! video/x-raw,format=BGR ! '
+            f'appsink name=analytics max-buffers=1 drop=true sync=false'
+        )
+        self.pipeline = None
+        self.running = False
+        self.threads = []
+        self.lock = threading.Lock()
+        # (closed at, path), oldest first. splitmuxsink reuses file names modulo max-files, so the
+        # fragment being written has the name of the one closed max_files fragments ago: never keep it
+        self.closed_fragments = deque(maxlen=self.max_files - 1)
+        self.clip = None  # Active clip: dir, trigger time, end time, fragments
+        self.error = None
+        self.eos = threading.Event()
+        # Counters are written from the appsink and bus threads. A lock of their own, because self.lock
+        # is held while trigger() moves fragments and the frame path must not wait for that
+        self.metrics_lock = threading.Lock()
+        self.metrics = {'jpeg_frames': 0, 'jpeg_bytes': 0, 'analytics_frames': 0, 'fragments': 0,
+                        'clips': 0, 'last_clip_finalize_time': None, 'errors': 0}
+        self.started_at = None
+
+    def start(self):
+        self.pipeline = Gst.parse_launch(self.pipeline_description)
+        self.overlay = self.pipeline.get_by_name('overlay')
+        self.splitmux = self.pipeline.get_by_name('preroll')
+        self.running = True
+        self.started_at = time.time()
+        self.threads = [threading.Thread(target=self._bus_loop, daemon=True),
+                        threading.Thread(target=self._pull_loop, args=('jpeg', self._handle_jpeg), daemon=True),
+                        threading.Thread(target=self._pull_loop, args=('analytics', self._handle_frame), daemon=True)]
+        if self.pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+            self.running = False
+            raise RuntimeError("Failed to start the GStreamer pipeline")
+        for thread in self.threads:
+            thread.start()
+        print(f"GStreamer capture running, H.264 via {self.encoder}, pre-roll in {self.preroll_dir}")
+
+    def _pull_loop(self, name, handler):
+        sink = self.pipeline.get_by_name(name)
+        while self.running:
+            sample = sink.emit('try-pull-sample', 100 * Gst.MSECOND)
+            if sample is None:
+                continue
+            buf = sample.get_buffer()
+            try:
+                handler(buf.extract_dup(0, buf.get_size()), time.time())
+            except Exception as e:
+                print(f"Error handling {name} frame: {e}")
+
+    def _count(self, **increments):
+        with self.metrics_lock:
+            for key, value in increments.items():
+                self.metrics[key] += value
+
+    def _handle_jpeg(self, data, timestamp):
+        self._count(jpeg_frames=1, jpeg_bytes=len(data))
+        if self.on_jpeg:
+            self.on_jpeg(data, timestamp)
+
+    def _handle_frame(self, data, timestamp):
+        self._count(analytics_frames=1)
+        if self.on_frame:
+            self.on_frame(np.frombuffer(data, dtype=np.uint8).reshape(self.height, self.width, 3), timestamp)
+
+    def _bus_loop(self):
+        bus = self.pipeline.get_bus()
+        types = Gst.MessageType.ELEMENT | Gst.MessageType.ERROR | Gst.MessageType.EOS
+        while self.running:
+            message = bus.timed_pop_filtered(200 * Gst.MSECOND, types)
+            if message is not None:
+                if message.type == Gst.MessageType.ERROR:
+                    error, debug = message.parse_error()
+                    self.error = error.message
+                    self._count(errors=1)
+                    print(f"GStreamer error: {error.message} ({debug})")
+                elif message.type == Gst.MessageType.EOS:
+                    self.eos.set()
+                elif message.type == Gst.MessageType.ELEMENT:
+                    structure = message.get_structure()
+                    if structure is not None and structure.get_name() == 'splitmuxsink-fragment-closed':
+                        self._fragment_closed(structure.get_string('location'))
+            self._check_clip()
+
+    def _fragment_closed(self, location):
+        self._count(fragments=1)
+        with self.lock:
+            if self.clip is not None:
+                self._keep(location)
+            else:
+                self.closed_fragments.append((time.time(), location))
+
+    def _keep(self, location):
+        """Move a closed fragment into the active clip before splitmuxsink reuses its name."""
+        target = os.path.join(self.clip['dir'], f"part{len(self.clip['fragments']):03d}.mp4")
+        try:
+            shutil.move(location, target)
+            self.clip['fragments'].append(target)
+        except OSError as e:
+            print(f"Error keeping fragment {location}: {e}")
+
+    def _check_clip(self):
+        with self.lock:
+            clip = self.clip
+            if clip is None or time.time() < clip['until']:
+                return
+            if not clip['split_requested']:
+                # Close the fragment holding the end of the window now instead of at its full length
+                clip['split_requested'] = True
+                self.splitmux.emit('split-now')
+                return
+            if time.time() - clip['until'] < self.fragment_duration + 2.0 and \
+                    (not clip['fragments'] or os.path.getmtime(clip['fragments'][-1]) < clip['until']):
+                return
+            self.clip = None
+        self._finalize(clip)
+
+    def _finalize(self, clip):
+        with open(os.path.join(clip['dir'], 'playlist.txt'), 'w') as f:
+            f.writelines(f"file '{os.path.basename(path)}'\n" for path in clip['fragments'])
+        elapsed = time.time() - clip['until']
+        with self.metrics_lock:
+            self.metrics['clips'] += 1
+            self.metrics['last_clip_finalize_time'] = elapsed
+        print(f"Accident clip finalised {elapsed:.1f}s after the post-trigger window: "
+              f"{len(clip['fragments'])} fragments in {clip['dir']}")
+
+    def trigger(self, post_trigger=20.0):
+        """
+        Start an accident clip: the pre-trigger fragments now, more until `post_trigger` seconds from now.
+        Returns:
+            str: Clip directory.
+        """
+        with self.lock:
+            if self.clip is not None:
+                return self.clip['dir']
+            now = time.time()
+            clip_dir = os.path.join(self.clip_dir, f"accident_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+            os.makedirs(clip_dir, exist_ok=True)
+            self.clip = {'dir': clip_dir, 'triggered': now, 'until': now + post_trigger,
+                         'fragments': [], 'split_requested': False}
+            while self.closed_fragments:
+                self._keep(self.closed_fragments.popleft()[1])
+        print(f"Accident clip started in {clip_dir}")
+        return clip_dir
+
+    def is_recording(self):
+        with self.lock:
+            return self.clip is not None
+
+    def set_overlay(self, text):
+        if self.pipeline is not None:
+            self.overlay.set_property('text', text)
+
+    def stats(self):
+        with self.metrics_lock:
+            metrics = dict(self.metrics)
+        elapsed = time.time() - self.started_at if self.started_at else 0
+        metrics['jpeg_fps'] = metrics['jpeg_frames'] / elapsed if elapsed else None
+        metrics['analytics_fps'] = metrics['analytics_frames'] / elapsed if elapsed else None
+        metrics['avg_jpeg_bytes'] = metrics['jpeg_bytes'] / metrics['jpeg_frames'] if metrics['jpeg_frames'] else None
+        metrics['encoder'] = self.encoder
+        metrics['recording'] = self.is_recording()
+        metrics['error'] = self.error
+        return metrics
+
+    def stop(self):
+        if self.pipeline is None:
+            return
+        # EOS lets splitmuxsink close the open fragment cleanly
+        self.pipeline.send_event(Gst.Event.new_eos())
+        self.eos.wait(timeout=2)
+        self.running = False
+        for thread in self.threads:
+            thread.join(timeout=1)
+        self.pipeline.set_state(Gst.State.NULL)
+        with self.lock:
+            clip, self.clip = self.clip, None
+        if clip is not None:
+            self._finalize(clip)
+        self.pipeline = None
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the GStreamer capture engine and record a test clip")
+    parser.add_argument('--source', default='videotestsrc', help="'videotestsrc', 'camera' or a source description")
+    parser.add_argument('--seconds', type=float, default=40)
+    parser.add_argument('--trigger-at', type=float, default=25, help="Seconds after start to trigger a clip")
+    parser.add_argument('--pre', type=float, default=20)
+    parser.add_argument('--post', type=float, default=10)
+    parser.add_argument('--clip-dir', default=os.path.join(os.path.dirname(__file__), 'record_video'))
+    args = parser.parse_args()
+
+    source = {'videotestsrc': TEST_SOURCE, 'camera': CAMERA_SOURCE}.get(args.source, args.source)
+    engine = GstCaptureEngine(args.clip_dir, source=source, pre_trigger=args.pre)
+    engine.start()
+    start = time.time()
+    triggered = False
+    try:
+        while time.time() - start < args.seconds:
+            time.sleep(1)
+            engine.set_overlay(f"Test run {time.time() - start:.0f}s")
+            if not triggered and time.time() - start >= args.trigger_at:
+                engine.trigger(args.post)
+                triggered = True
+            print(engine.stats())
+    finally:
+        engine.stop()
+    print(engine.stats())
+
+
+if __name__ == '__main__':
+    main()
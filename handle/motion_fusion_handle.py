@@ -0,0 +1,284 @@
+# Thesis/handle/motion_fusion_handle.py
+import math
+import time
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from sensors.BNO055.imu_buffer import CHANNELS
+
+EARTH_RADIUS = 6371000.0  # m
+
+# Fused motion: speed in m/s, heading in degrees clockwise from north, with 1-sigma uncertainties
+MotionEstimate = namedtuple('MotionEstimate', ['timestamp', 'speed', 'heading', 'speed_std', 'heading_std',
+                                               'gps_fixes'])
+
+
+def wrap_angle(angle):
+    """Wrap an angle in radians to [-pi, pi)."""
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+
+class VelocityEKF:
+    """
+    Extended Kalman filter for planar vehicle motion.
+
+    State: north, east position (m, local plane around the first fix), speed along
+    the heading (m/s), heading (rad, clockwise from north) and the bias of the
+    forward accelerometer axis (m/s²). IMU samples drive the prediction at full
+    rate (forward linear acceleration and yaw rate), GPS position, speed and
+    course correct it whenever a fix arrives.
+    """
+
+    PN, PE, V, PSI, BIAS = range(5)
+
+    def __init__(self, accel_noise=0.5, gyro_noise=0.02, bias_walk=0.01, position_noise=5.0,
+                 speed_noise=0.5, course_noise=math.radians(5), min_course_speed=2.0, gate=16.0):
+        """
+        Parameters:
+            accel_noise (float): Forward acceleration noise, m/s².
+            gyro_noise (float): Yaw rate noise, rad/s.
+            bias_walk (float): Accelerometer bias random walk, m/s² per sqrt(s).
+            position_noise, speed_noise, course_noise (float): GPS measurement sigmas (m, m/s, rad).
+            min_course_speed (float): Below this speed (m/s) GPS course is ignored.
+            gate (float): Chi-square gate, GPS measurements further out are rejected as outliers.
+        """
+        self.accel_noise = accel_noise
+        self.gyro_noise = gyro_noise
+        self.bias_walk = bias_walk
+        self.position_noise = position_noise
+        self.speed_noise = speed_noise
+        self.course_noise = course_noise
+        self.min_course_speed = min_course_speed
+        self.gate = gate
+
+        self.x = np.zeros(5)
+        self.P = np.diag([1e6, 1e6, 1.0, math.pi ** 2, 0.25])  # Position and heading unknown at start
+        self.origin = None  # (lat, lon) of the local plane
+        self.timestamp = None
+        self.metrics = {'imu_samples': 0, 'gps_updates': 0, 'gps_rejected': 0}
+
+    def to_local(self, latitude, longitude):
+        """Project a fix onto the local plane (equirectangular, fine for a few km)."""
+        if self.origin is None:
+            self.origin = (latitude, longitude)
+        lat0, lon0 = self.origin
+        north = math.radians(latitude - lat0) * EARTH_RADIUS
+        east = math.radians(longitude - lon0) * EARTH_RADIUS * math.cos(math.radians(lat0))
+        return north, east
+
+    def predict(self, timestamp, forward_accel, yaw_rate):
+        """Propagate to `timestamp` with one IMU sample (m/s², rad/s clockwise)."""
+        if self.timestamp is None:
+            self.timestamp = timestamp
+            return
+        dt = timestamp - self.timestamp
+        if dt <= 0:
+            return
+        self.timestamp = timestamp
+        _, _, v, psi, bias = self.x
+        cos_psi, sin_psi = math.cos(psi), math.sin(psi)
+
+        self.x[self.PN] += v * cos_psi * dt
+        self.x[self.PE] += v * sin_psi * dt
+        self.x[self.V] += (forward_accel - bias) * dt
+        self.x[self.PSI] = wrap_angle(psi + yaw_rate * dt)
+
+        F = np.eye(5)
+        F[self.PN, self.V] = cos_psi * dt
+        F[self.PN, self.PSI] = -v * sin_psi * dt
+        F[self.PE, self.V] = sin_psi * dt
+        F[self.PE, self.PSI] = v * cos_psi * dt
+        F[self.V, self.BIAS] = -dt
+        Q = np.diag([0.01 * dt, 0.01 * dt, self.accel_noise ** 2 * dt,
+                     self.gyro_noise ** 2 * dt, self.bias_walk ** 2 * dt])
+        self.P = F @ self.P @ F.T + Q
+        self.metrics['imu_samples'] += 1
+
+    def _update(self, innovation, H, R):
+        S = H @ self.P @ H.T + R
+        S_inv = np.linalg.inv(S)
+        if innovation @ S_inv @ innovation > self.gate:
+            self.metrics['gps_rejected'] += 1
+            return False
+        K = self.P @ H.T @ S_inv
+        self.x += K @ innovation
+        self.x[self.PSI] = wrap_angle(self.x[self.PSI])
+        I_KH = np.eye(5) - K @ H
+        self.P = I_KH @ self.P @ I_KH.T + K @ R @ K.T  # Joseph form keeps P symmetric
+        return True
+
+    def update_gps(self, latitude, longitude, speed=None, course=None):
+        """Correct with a GPS fix. speed in m/s, course in degrees, either may be None."""
+        north, east = self.to_local(latitude, longitude)
+        if self.metrics['gps_updates'] == 0:
+            # First fix places the vehicle, nothing to gate against yet
+            self.x[self.PN], self.x[self.PE] = north, east
+            self.P[self.PN, self.PN] = self.P[self.PE, self.PE] = self.position_noise ** 2
+        else:
+            H = np.zeros((2, 5))
+            H[0, self.PN] = H[1, self.PE] = 1
+            self._update(np.array([north - self.x[self.PN], east - self.x[self.PE]]), H,
+                         np.eye(2) * self.position_noise ** 2)
+        if speed is not None:
+            H = np.zeros((1, 5))
+            H[0, self.V] = 1
+            self._update(np.array([speed - self.x[self.V]]), H, np.array([[self.speed_noise ** 2]]))
+        if course is not None and speed is not None and speed >= self.min_course_speed:
+            H = np.zeros((1, 5))
+            H[0, self.PSI] = 1
+            self._update(np.array([wrap_angle(math.radians(course) - self.x[self.PSI])]), H,
+                         np.array([[self.course_noise ** 2]]))
+        self.metrics['gps_updates'] += 1
+
+    def estimate(self):
+        speed = self.x[self.V]
+        heading = self.x[self.PSI]
+        if speed < 0:  # Reported as speed, a negative value means the heading is flipped
+            speed, heading = -speed, wrap_angle(heading + math.pi)
+        return MotionEstimate(
+            timestamp=self.timestamp,
+            speed=float(speed),
+            heading=math.degrees(heading) % 360,
+            speed_std=math.sqrt(self.P[self.V, self.V]),
+            heading_std=math.degrees(math.sqrt(self.P[self.PSI, self.PSI])),
+            gps_fixes=self.metrics['gps_updates'],
+        )
+
+
+class MotionFusion:
+    """
+    Runs VelocityEKF on the BNO055 ring buffer and the GPS fixes.
+    Sole writer of the fused estimate: consumers call get_estimate() (or
+    SensorHandler.get_velocity) instead of reading per-sensor velocities.
+    """
+
+    def __init__(self, imu, gps, ekf=None, forward_axis=0, yaw_axis=2, yaw_sign=-1.0, period=0.05):
+        """
+        Parameters:
+            imu (BNO055Sensor): Source of the full-rate ring buffer.
+            gps (GPSModule): Source of fixes through get_fix().
+            forward_axis (int): Sensor axis pointing to the front of the car.
+            yaw_axis (int), yaw_sign (float): Gyro axis and sign giving clockwise yaw rate
+                (BNO055 z is up, so counter-clockwise is positive).
+            period (float): Seconds between batches taken from the ring buffer.
+        """
+        self.imu = imu
+        self.gps = gps
+        self.ekf = ekf or VelocityEKF()
+        self.forward_axis = CHANNELS['linear_accel'].start + forward_axis
+        self.yaw_axis = CHANNELS['gyro'].start + yaw_axis
+        self.yaw_scale = yaw_sign * math.pi / 180  # BNO055 gyro is in dps
+        self.period = period
+        self.latest = MotionEstimate(None, 0.0, 0.0, float('inf'), float('inf'), 0)
+        self.last_fix_time = None
+        self.running = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def get_estimate(self):
+        """Latest MotionEstimate, replaced as a whole so readers need no lock."""
+        return self.latest
+
+    def process(self, timestamps, data, fix=None):
+        """
+        Run a batch of IMU rows in time order, applying `fix` where it falls
+        between the samples. Returns the new estimate.
+        """
+        split = len(timestamps) if fix is None else int(np.searchsorted(timestamps, fix.timestamp, side='right'))
+        accel = data[:, self.forward_axis]
+        yaw_rate = data[:, self.yaw_axis] * self.yaw_scale
+        for i in range(split):
+            self.ekf.predict(timestamps[i], accel[i], yaw_rate[i])
+        if fix is not None:
+            self.ekf.update_gps(fix.latitude, fix.longitude, fix.speed, fix.course)
+        for i in range(split, len(timestamps)):
+            self.ekf.predict(timestamps[i], accel[i], yaw_rate[i])
+        self.latest = self.ekf.estimate()
+        return self.latest
+
+    def _run(self):
+        ring = self.imu.ring
+        next_seq = ring.count
+        while self.running:
+            try:
+                timestamps, data, next_seq = ring.since(next_seq)
+                fix = self.gps.get_fix()
+                if fix is not None and fix.timestamp == self.last_fix_time:
+                    fix = None
+                elif fix is not None:
+                    self.last_fix_time = fix.timestamp
+                if len(timestamps) or fix is not None:
+                    self.process(timestamps, data, fix)
+            except Exception as e:
+                print(f"Error in motion fusion: {e}")
+            time.sleep(self.period)
+
+
+def replay_log(path, ekf=None):
+    """
+    Run the fusion over a recorded sensor log as fast as possible.
+    Returns (fix, estimate predicted just before it) pairs, the run time in seconds
+    and the number of IMU samples.
+    """
+    from sensors.backend import SensorLogReader
+    from sensors.BNO055.BNO055_lib import BNO055Sensor
+    from sensors.GPS.GPS_lib import GPSFix
+    from sensors.GPS.nmea_parser import NMEAParser, RMC
+
+    reader = SensorLogReader(path)
+    try:
+        imu_index = reader.index['imu']
+        timestamps = np.array([entry[0] for entry in imu_index])
+        raw = b''.join(reader.payload('imu', i) for i in range(len(imu_index)))
+        data = np.frombuffer(raw, dtype='<i2').reshape(-1, 22) * BNO055Sensor.DATA_BLOCK_SCALES
+        fixes = []
+        parser = NMEAParser()
+        for i, (timestamp, _, _) in enumerate(reader.index['gps']):
+            for sentence in parser.feed(reader.payload('gps', i)):
+                if isinstance(sentence, RMC) and sentence.valid and sentence.latitude is not None:
+                    fixes.append(GPSFix(timestamp, sentence.latitude, sentence.longitude,
+                                        sentence.speed, sentence.course))
+    finally:
+        reader.close()
+
+    fusion = MotionFusion(imu=None, gps=None, ekf=ekf)
+    results = []
+    start = time.perf_counter()
+    lo = 0
+    for fix in fixes:
+        hi = int(np.searchsorted(timestamps, fix.timestamp, side='right'))
+        # Prediction right before the fix, so the comparison is not against data already fused
+        predicted = fusion.process(timestamps[lo:hi], data[lo:hi])
+        fusion.ekf.update_gps(fix.latitude, fix.longitude, fix.speed, fix.course)
+        results.append((fix, predicted))
+        lo = hi
+    fusion.process(timestamps[lo:], data[lo:])
+    return results, time.perf_counter() - start, len(timestamps)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run GPS/IMU velocity fusion over a recorded sensor log")
+    parser.add_argument('log', help="Sensor log written with BLACKBOX_SENSOR_MODE=record")
+    args = parser.parse_args()
+
+    estimates, elapsed, samples = replay_log(args.log)
+    print(f"{samples} IMU samples, {len(estimates)} GPS fixes in {elapsed:.2f}s ({samples / elapsed:.0f} samples/s)")
+    errors = [estimate.speed - fix.speed for fix, estimate in estimates if fix.speed is not None]
+    if errors:
+        print(f"Predicted vs GPS speed: mean {np.mean(errors):+.2f} m/s, RMS {math.sqrt(np.mean(np.square(errors))):.2f} m/s")
+    if estimates:
+        last = estimates[-1][1]
+        print(f"Final: {last.speed * 3.6:.1f} km/h, heading {last.heading:.0f}° (±{last.heading_std:.0f}°)")
+
+
+if __name__ == '__main__':
+    main()
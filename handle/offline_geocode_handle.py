@@ -0,0 +1,222 @@
+# Thesis/handle/offline_geocode_handle.py
+# Offline reverse geocoding from a prepared place/road dataset.
+#
+# Build the index once from a CSV with latitude, longitude and name columns
+# (e.g. named roads and places exported from OpenStreetMap for the service area):
+#   python -m handle.offline_geocode_handle build places.csv handle/offline_geocode.idx
+# Query or benchmark it:
+#   python -m handle.offline_geocode_handle query handle/offline_geocode.idx 10.7718 106.6583
+import os
+import csv
+import math
+import mmap
+import time
+import struct
+
+import numpy as np
+
+INDEX_FILE = os.path.join(os.path.dirname(__file__), 'offline_geocode.idx')
+MAGIC = b'BBXGEO1\0'
+# magic, point count, cell count, name bytes, cell size in degrees
+HEADER = struct.Struct('<8sIIId')
+METERS_PER_DEGREE = 111320.0
+CELL_OFFSET = 1 << 20  # Keeps row/col non-negative in the cell id
+CELL_STRIDE = 1 << 22  # Cell id = row * CELL_STRIDE + col, so a row of cells is one id range
+
+
+def _cell_ids(rows, cols):
+    return (rows.astype(np.int64) + CELL_OFFSET) * CELL_STRIDE + (cols.astype(np.int64) + CELL_OFFSET)
+
+
+def _aligned(offset):
+    return (offset + 7) & ~7
+
+
+def build_index(latitudes, longitudes, names, path=INDEX_FILE, cell_size=0.005):
+    """
+    Write a grid index: points sorted by cell, a sorted table of non-empty
+    cells with their first point, and the names as one UTF-8 blob.
+
+    Parameters:
+        cell_size (float): Grid cell size in degrees (0.005 is about 550 m).
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    ids = _cell_ids(np.floor(latitudes / cell_size), np.floor(longitudes / cell_size))
+    order = np.argsort(ids, kind='stable')
+    ids = ids[order]
+    cell_ids, cell_starts = np.unique(ids, return_index=True)
+    cell_starts = np.append(cell_starts, len(ids)).astype(np.uint32)
+
+    encoded = [names[i].encode('utf-8') for i in order]
+    name_offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+    np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+    blob = b''.join(encoded)
+
+    arrays = [cell_ids.astype(np.int64), cell_starts, latitudes[order].astype(np.float32),
+              longitudes[order].astype(np.float32), name_offsets]
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(encoded), len(cell_ids), len(blob), cell_size))
+        for array in arrays + [blob]:
+            f.write(b'\0' * (_aligned(f.tell()) - f.tell()))
+            f.write(array.tobytes() if isinstance(array, np.ndarray) else array)
+    os.replace(tmp_file, path)
+    return len(encoded), len(cell_ids)
+
+
+def build_index_from_csv(csv_path, path=INDEX_FILE, cell_size=0.005):
+    """Build from a CSV with 'lat', 'lon' and 'name' columns, rows without a name are skipped."""
+    latitudes, longitudes, names = [], [], []
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            try:
+                if row['name']:
+                    latitudes.append(float(row['lat']))
+                    longitudes.append(float(row['lon']))
+                    names.append(row['name'])
+            except (KeyError, ValueError):
+                continue
+    return build_index(latitudes, longitudes, names, path, cell_size)
+
+
+class OfflineGeocoder:
+    """
+    Nearest named place lookup on a memory-mapped grid index.
+    The file is mapped read-only and every array is a NumPy view of the map, so
+    startup does not parse or copy the dataset and pages load on first use.
+    A query scans only the cells around the position.
+    """
+
+    def __init__(self, path=INDEX_FILE, max_distance=2000.0):
+        """
+        Parameters:
+            path (str): Index written by build_index.
+            max_distance (float): Meters beyond which no address is returned.
+        """
+        self.path = path
+        self.max_distance = max_distance
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, points, cells, name_bytes, self.cell_size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an offline geocoding index")
+
+        offset = HEADER.size
+        views = []
+        for dtype, count in [(np.int64, cells), (np.uint32, cells + 1), (np.float32, points),
+                             (np.float32, points), (np.uint32, points + 1)]:
+            offset = _aligned(offset)
+            views.append(np.frombuffer(self.map, dtype=dtype, count=count, offset=offset))
+            offset += count * np.dtype(dtype).itemsize
+        self.cell_ids, self.cell_starts, self.latitudes, self.longitudes, self.name_offsets = views
+        self.names_offset = _aligned(offset)
+        self.cell_meters = self.cell_size * METERS_PER_DEGREE
+        self.max_rings = max(1, math.ceil(max_distance / (self.cell_meters * 0.5)))
+
+    def _candidates(self, row, col, rings):
+        """Point index ranges of the cells within `rings` cells of (row, col)."""
+        # Each row of cells is one contiguous id range, so one pair of binary searches per row
+        first = (row - rings + CELL_OFFSET) * CELL_STRIDE + col + CELL_OFFSET
+        lo_ids = np.arange(first - rings, first - rings + (2 * rings + 1) * CELL_STRIDE, CELL_STRIDE)
+        lo = np.searchsorted(self.cell_ids, lo_ids, side='left')
+        hi = np.searchsorted(self.cell_ids, lo_ids + 2 * rings, side='right')
+        return [(int(self.cell_starts[a]), int(self.cell_starts[b])) for a, b in zip(lo.tolist(), hi.tolist()) if b > a]
+
+    def name(self, i):
+        start = self.names_offset + int(self.name_offsets[i])
+        return self.map[start:self.names_offset + int(self.name_offsets[i + 1])].decode('utf-8')
+
+    def nearest(self, latitude, longitude):
+        """
+        Nearest indexed name to a position.
+        Returns:
+            tuple: (name, distance in meters), or None if nothing is within max_distance.
+        """
+        row = math.floor(latitude / self.cell_size)
+        col = math.floor(longitude / self.cell_size)
+        lon_scale = math.cos(math.radians(latitude))
+        rings = 1
+        while rings <= self.max_rings:
+            best, best_distance = None, math.inf
+            for start, end in self._candidates(row, col, rings):
+                dy = self.latitudes[start:end] - latitude
+                dx = (self.longitudes[start:end] - longitude) * lon_scale
+                squared = dy * dy + dx * dx
+                i = int(np.argmin(squared))
+                distance = math.sqrt(float(squared[i])) * METERS_PER_DEGREE
+                if distance < best_distance:
+                    best, best_distance = start + i, distance
+            # A point in the searched square is only certainly the nearest if it is
+            # closer than the square's inner radius, otherwise widen the search
+            covered = rings * self.cell_meters * lon_scale
+            if best is not None and best_distance <= covered:
+                break
+            rings = max(rings + 1, math.ceil(best_distance / (self.cell_meters * lon_scale))) if best is not None else rings * 2
+        if best is None or best_distance > self.max_distance:
+            return None
+        return self.name(best), best_distance
+
+    def lookup(self, latitude, longitude):
+        """Address string for ReverseGeocoder, or None."""
+        result = self.nearest(latitude, longitude)
+        return result[0] if result else None
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def close(self):
+        # Views must be dropped before the map can close
+        self.cell_ids = self.cell_starts = self.latitudes = self.longitudes = self.name_offsets = None
+        self.map.close()
+        self.file.close()
+
+
+def load_offline_geocoder(path=INDEX_FILE, **kwargs):
+    """OfflineGeocoder for `path`, or None if no index has been built."""
+    if not os.path.exists(path):
+        print(f"No offline geocoding index at {path}, addresses need the network")
+        return None
+    try:
+        geocoder = OfflineGeocoder(path, **kwargs)
+    except (OSError, ValueError) as e:
+        print(f"Error loading offline geocoding index: {e}")
+        return None
+    print(f"Offline geocoding index loaded: {len(geocoder)} places")
+    return geocoder
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Offline reverse geocoding index")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="Build an index from a lat,lon,name CSV")
+    build.add_argument('csv')
+    build.add_argument('index', nargs='?', default=INDEX_FILE)
+    build.add_argument('--cell-size', type=float, default=0.005, help="Grid cell size in degrees")
+    query = commands.add_parser('query', help="Look up a position and time the query")
+    query.add_argument('index')
+    query.add_argument('lat', type=float)
+    query.add_argument('lon', type=float)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        points, cells = build_index_from_csv(args.csv, args.index, args.cell_size)
+        print(f"Indexed {points} places in {cells} cells -> {args.index}")
+        return
+
+    start = time.perf_counter()
+    geocoder = OfflineGeocoder(args.index)
+    opened = time.perf_counter() - start
+    print(geocoder.nearest(args.lat, args.lon))
+    runs = 10000
+    start = time.perf_counter()
+    for _ in range(runs):
+        geocoder.nearest(args.lat, args.lon)
+    print(f"Opened in {opened * 1000:.2f} ms, {(time.perf_counter() - start) / runs * 1e6:.1f} us per query")
+    geocoder.close()
+
+
+if __name__ == '__main__':
+    main()
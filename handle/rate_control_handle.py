@@ -0,0 +1,100 @@
+# Thesis/handle/rate_control_handle.py
+import time
+import threading
+
+
+class AdaptiveRateController:
+    """
+    Stretches routine telemetry intervals when the link degrades.
+    The link level comes from the connection monitor's RTT and loss. It drops
+    at once when the link gets worse and only recovers after the better level
+    has been seen `recover_after` times in a row, so a flapping modem does not
+    flip rates back and forth. Event payloads (accidents, state changes) do
+    not go through this controller and are always sent right away.
+    """
+
+    GOOD = "GOOD"
+    DEGRADED = "DEGRADED"
+    POOR = "POOR"
+    LEVELS = [GOOD, DEGRADED, POOR]
+
+    # Normal interval in seconds of each interval-driven sensor type
+    BASE_INTERVALS = {
+        'accelerometer': 4.0,
+        'temperature': 5.0,
+        'gps': 1.0,
+    }
+    # Interval multiplier applied at each link level
+    MULTIPLIERS = {GOOD: 1, DEGRADED: 3, POOR: 10}
+
+    def __init__(self, stats_provider, base_intervals=None, degraded_rtt_ms=400, poor_rtt_ms=1500,
+                 degraded_loss=0.1, poor_loss=0.4, evaluate_every=5.0, recover_after=3):
+        """
+        Parameters:
+            stats_provider (callable): Returns a dict with 'up', 'loss' and 'rtt_avg_ms'
+                (connection_internet_handle.get_link_stats).
+            base_intervals (dict): Overrides for BASE_INTERVALS.
+            evaluate_every (float): Minimum seconds between link evaluations.
+            recover_after (int): Consecutive better evaluations needed to restore rates.
+        """
+        self.stats_provider = stats_provider
+        self.base_intervals = dict(self.BASE_INTERVALS, **(base_intervals or {}))
+        self.degraded_rtt_ms = degraded_rtt_ms
+        self.poor_rtt_ms = poor_rtt_ms
+        self.degraded_loss = degraded_loss
+        self.poor_loss = poor_loss
+        self.evaluate_every = evaluate_every
+        self.recover_after = recover_after
+        self.level = self.GOOD
+        self.better_count = 0
+        self.last_evaluation = 0
+        self.lock = threading.Lock()
+
+    def classify(self, stats):
+        """Map link stats to a level. A link that is down counts as POOR."""
+        if not stats.get('up'):
+            return self.POOR
+        loss = stats.get('loss') or 0
+        rtt = stats.get('rtt_avg_ms') or 0
+        if loss >= self.poor_loss or rtt >= self.poor_rtt_ms:
+            return self.POOR
+        if loss >= self.degraded_loss or rtt >= self.degraded_rtt_ms:
+            return self.DEGRADED
+        return self.GOOD
+
+    def update(self):
+        """Re-evaluate the link level, at most once every `evaluate_every` seconds."""
+        now = time.time()
+        with self.lock:
+            if now - self.last_evaluation < self.evaluate_every:
+                return self.level
+            self.last_evaluation = now
+        try:
+            observed = self.classify(self.stats_provider())
+        except Exception as e:
+            print(f"Error reading link stats: {e}")
+            return self.level
+
+        with self.lock:
+            current = self.LEVELS.index(self.level)
+            target = self.LEVELS.index(observed)
+            if target > current:
+                new_level = observed  # Back off immediately
+                self.better_count = 0
+            elif target < current:
+                self.better_count += 1
+                if self.better_count < self.recover_after:
+                    return self.level
+                new_level = self.LEVELS[current - 1]  # Recover one level at a time
+                self.better_count = 0
+            else:
+                self.better_count = 0
+                return self.level
+            previous, self.level = self.level, new_level
+        print(f"Link quality {previous} -> {new_level}, telemetry interval x{self.MULTIPLIERS[new_level]}")
+        return new_level
+
+    def interval(self, sensor_type):
+        """Current interval in seconds for an interval-driven sensor type."""
+        level = self.update()
+        return self.base_intervals[sensor_type] * self.MULTIPLIERS[level]
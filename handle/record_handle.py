@@ -1,37 +1,358 @@
 import cv2
+import numpy as np
 import time
+import queue
+import signal
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
 from datetime import datetime
 import os
 
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+
+def jpeg_size(jpeg):
+    """(width, height) from the SOF marker of a JPEG, or None."""
+    i = 2
+    while i + 9 < len(jpeg):
+        if jpeg[i] != 0xFF:
+            return None
+        marker = jpeg[i + 1]
+        if marker == 0xFF:  # Fill byte before a marker
+            i += 1
+            continue
+        length = struct.unpack_from('>H', jpeg, i + 2)[0]
+        # SOF0..SOF15 except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack_from('>HH', jpeg, i + 5)
+            return width, height
+        i += 2 + length
+    return None
+
+
+class MJPEGAviWriter:
+    """
+    Motion-JPEG AVI writer that stores already encoded JPEG frames as they are.
+    This is the container cv2.VideoWriter produces with the MJPG fourcc, so
+    clips play the same, but frames from the encoded pre-trigger ring go to disk
+    without a decode and re-encode.
+    """
+
+    def __init__(self, path, fps, width, height):
+        self.path = path
+        self.fps = int(fps)
+        self.width = width
+        self.height = height
+        self.file = open(path, 'wb')
+        self.index = []  # (offset from 'movi', size)
+        self.max_frame = 0
+        self._write_header()
+
+    def _write_header(self):
+        f = self.file
+        f.write(b'RIFF\0\0\0\0AVI ')
+        f.write(b'LIST' + struct.pack('<I', 4 + 64 + 12 + 64 + 48) + b'hdrl')
+        self.avih_offset = f.tell() + 8
+        f.write(b'avih' + struct.pack('<I', 56) + bytes(56))
+        f.write(b'LIST' + struct.pack('<I', 4 + 64 + 48) + b'strl')
+        self.strh_offset = f.tell() + 8
+        f.write(b'strh' + struct.pack('<I', 56) + bytes(56))
+        f.write(b'strf' + struct.pack('<I', 40) + struct.pack(
+            '<IiiHH4sIiiII', 40, self.width, self.height, 1, 24, b'MJPG',
+            self.width * self.height * 3, 0, 0, 0, 0))
+        self.movi_offset = f.tell()
+        f.write(b'LIST\0\0\0\0movi')
+        self._patch_headers()
+
+    def _patch_headers(self):
+        frames = len(self.index)
+        self.file.seek(self.avih_offset)
+        self.file.write(struct.pack('<14I', int(1e6 / self.fps), self.max_frame * self.fps, 0, AVIF_HASINDEX,
+                                    frames, 0, 1, self.max_frame, self.width, self.height, 0, 0, 0, 0))
+        self.file.seek(self.strh_offset)
+        self.file.write(struct.pack('<4s4sIHHIIIIIIIi4h', b'vids', b'MJPG', 0, 0, 0, 0, 1, self.fps, 0,
+                                    frames, self.max_frame, 0xFFFFFFFF, 0, 0, 0, self.width, self.height))
+        self.file.seek(0, os.SEEK_END)
+
+    def write(self, jpeg):
+        offset = self.file.tell() - (self.movi_offset + 8)
+        self.file.write(b'00dc' + struct.pack('<I', len(jpeg)))
+        self.file.write(jpeg)
+        if len(jpeg) % 2:
+            self.file.write(b'\0')
+        self.index.append((offset, len(jpeg)))
+        self.max_frame = max(self.max_frame, len(jpeg))
+
+    def release(self):
+        f = self.file
+        movi_end = f.tell()
+        f.write(b'idx1' + struct.pack('<I', 16 * len(self.index)))
+        f.write(b''.join(struct.pack('<4sIII', b'00dc', AVIIF_KEYFRAME, offset, size)
+                         for offset, size in self.index))
+        end = f.tell()
+        f.seek(4)
+        f.write(struct.pack('<I', end - 8))
+        f.seek(self.movi_offset + 4)
+        f.write(struct.pack('<I', movi_end - self.movi_offset - 8))
+        self._patch_headers()
+        f.close()
+
+
+def _attach_shared_memory(name):
+    try:
+        # The parent owns the block, the child must not unlink it when it exits
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        return shared_memory.SharedMemory(name=name)
+
+
+def _writer_main(shm_name, slot_size, commands, free_slots, results, parent_pid):
+    """Writer process: copy frames from shared memory slots into the open clip."""
+    # The fork inherits the application's handlers, which would run its cleanup and os._exit
+    # here. Ctrl+C reaches the whole process group, the parent stops this process through close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    shm = _attach_shared_memory(shm_name)
+    writer = None
+    frames = 0
+    try:
+        while True:
+            try:
+                command = commands.get(timeout=1.0)
+            except queue.Empty:
+                if os.getppid() != parent_pid:
+                    break  # Parent died without close(), finalise and exit
+                continue
+            if command is None:
+                break
+            kind = command[0]
+            try:
+                if kind == 'frame':
+                    _, slot, length = command
+                    try:
+                        if writer:
+                            start = slot * slot_size
+                            writer.write(shm.buf[start:start + length])
+                            frames += 1
+                    finally:
+                        free_slots.put(slot)
+                elif kind == 'frame_bytes':
+                    _, slot, jpeg = command
+                    try:
+                        if writer:
+                            writer.write(jpeg)
+                            frames += 1
+                    finally:
+                        free_slots.put(slot)
+                elif kind == 'start':
+                    _, _, path, fps, width, height = command
+                    if writer:
+                        writer.release()
+                    writer = MJPEGAviWriter(path, fps, width, height)
+                    frames = 0
+                elif kind == 'stop':
+                    path = writer.path if writer else None
+                    if writer:
+                        writer.release()
+                        writer = None
+                    results.put(('finalized', command[1], path, frames))  # Tagged with the clip id of stop()
+            except Exception as e:
+                results.put(('error', f"{kind}: {e}"))
+    finally:
+        if writer:
+            writer.release()
+        shm.close()
+
+
+class VideoWriterProcess:
+    """
+    Clip writer running in its own process, so disk writes never compete with
+    capture for the GIL.
+    Frames (already JPEG encoded) are copied into a fixed pool of shared memory
+    slots and only the slot number goes through the command queue. The pool
+    bounds the backlog: when every slot is in flight, write() waits for the
+    writer and that wait is counted as backpressure. With at most `slots` frames
+    pending, finalising a clip after stop() takes a bounded time. Frames too
+    large for a slot go through the queue but still hold a slot while in flight.
+    """
+
+    def __init__(self, slots=64, slot_size=512 * 1024):
+        """
+        Parameters:
+            slots (int): Frames that can be in flight to the writer.
+            slot_size (int): Bytes per slot, larger frames go through the queue instead.
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+        # Forked, not spawned, so the child does not re-import the application; create
+        # it before other threads start (see main_handle)
+        context = multiprocessing.get_context('fork')
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self.commands = context.Queue()
+        self.free_slots = context.Queue()
+        self.results = context.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+        self.process = context.Process(target=_writer_main, daemon=True,
+                                       args=(self.shm.name, slot_size, self.commands, self.free_slots, self.results,
+                                             os.getpid()))
+        self.process.start()
+        self.in_flight = 0
+        self.clip_id = 0  # Pairs each stop() with its own clip's result
+        self.closed = False
+        self.metrics = {'frames': 0, 'bytes': 0, 'oversize': 0, 'dropped': 0, 'blocked': 0,
+                        'block_time': 0.0, 'max_in_flight': 0, 'clips': 0, 'late_clips': 0, 'errors': 0,
+                        'last_finalize_time': None, 'max_finalize_time': 0.0}
+
+    def start(self, path, fps, width, height):
+        self.clip_id += 1
+        self.commands.put(('start', self.clip_id, path, fps, width, height))
+
+    def write(self, jpeg, timeout=2.0):
+        """Queue one JPEG frame. Returns False if the writer stayed full for `timeout` seconds."""
+        try:
+            slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            self.metrics['blocked'] += 1
+            start = time.time()
+            try:
+                slot = self.free_slots.get(timeout=timeout)
+            except queue.Empty:
+                self.metrics['dropped'] += 1
+                return False
+            finally:
+                self.metrics['block_time'] += time.time() - start
+        if len(jpeg) > self.slot_size:
+            # The slot is only held as a token so the frame counts against the in-flight bound
+            self.metrics['oversize'] += 1
+            self.commands.put(('frame_bytes', slot, bytes(jpeg)))
+        else:
+            offset = slot * self.slot_size
+            self.shm.buf[offset:offset + len(jpeg)] = jpeg
+            self.commands.put(('frame', slot, len(jpeg)))
+        try:
+            self.in_flight = self.slots - self.free_slots.qsize()
+            self.metrics['max_in_flight'] = max(self.metrics['max_in_flight'], self.in_flight)
+        except NotImplementedError:  # qsize() is missing on macOS
+            pass
+        self.metrics['frames'] += 1
+        self.metrics['bytes'] += len(jpeg)
+        return True
+
+    def stop(self, timeout=5.0):
+        """
+        Finalise the current clip and wait up to `timeout` seconds for it.
+        Returns:
+            tuple: (path, frames written), or None if the writer did not finish in time.
+        """
+        start = time.time()
+        clip_id = self.clip_id
+        self.commands.put(('stop', clip_id))
+        deadline = start + timeout
+        while True:
+            try:
+                result = self.results.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                print(f"Video writer did not finalise within {timeout:.1f}s, it keeps writing in the background")
+                return None
+            if result[0] == 'error':
+                self.metrics['errors'] += 1
+                print(f"Video writer error: {result[1]}")
+                continue
+            _, result_clip_id, path, frames = result
+            if result_clip_id != clip_id:
+                # Result of an earlier clip whose stop() timed out
+                self.metrics['late_clips'] += 1
+                print(f"Video writer finalised an earlier clip late, {frames} frames: {path}")
+                continue
+            elapsed = time.time() - start
+            self.metrics['clips'] += 1
+            self.metrics['last_finalize_time'] = elapsed
+            self.metrics['max_finalize_time'] = max(self.metrics['max_finalize_time'], elapsed)
+            return path, frames
+
+    def stats(self):
+        metrics = dict(self.metrics)
+        try:
+            metrics['in_flight'] = self.slots - self.free_slots.qsize()
+        except NotImplementedError:
+            metrics['in_flight'] = self.in_flight
+        metrics['alive'] = self.process.is_alive()
+        return metrics
+
+    def close(self, timeout=5.0):
+        if self.closed:
+            return
+        self.closed = True
+        self.commands.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()  # SIGTERM is ignored by the writer
+        self.shm.close()
+        self.shm.unlink()
+
+
 class RecordHandler:
-    def __init__(self, fps=20):
+    def __init__(self, fps=20, jpeg_quality=80, finalize_timeout=5.0):
         base_dir = os.path.dirname(os.path.abspath(__file__))  # Path of current script
         self.output_dir = os.path.join(base_dir, "record_video")
         self.fps = fps
-        self.fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-        self.writer = None
+        self.jpeg_quality = jpeg_quality
+        self.finalize_timeout = finalize_timeout
+        self.writer = VideoWriterProcess()
         self.recording = False
         os.makedirs(self.output_dir, exist_ok=True)
 
     def start_recording(self, frame):
+        """Open a new clip sized from the first frame, a BGR array or JPEG bytes."""
         if not self.recording:
-            h, w = frame.shape[:2]
+            if isinstance(frame, (bytes, bytearray, memoryview)):
+                size = jpeg_size(frame)
+                if size is None:
+                    # No SOF marker found in the header, let OpenCV decode the frame instead
+                    image = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR)
+                    if image is None:
+                        print("Cannot start recording, the first frame is not a valid JPEG")
+                        return False
+                    size = image.shape[1], image.shape[0]
+                w, h = size
+            else:
+                h, w = frame.shape[:2]
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             output_path = os.path.join(self.output_dir, f'output_{timestamp}.avi')
-            self.writer = cv2.VideoWriter(output_path, self.fourcc, self.fps, (w, h))
+            self.writer.start(output_path, self.fps, w, h)
             self.recording = True
             print(f"Started recording to {output_path}")
+        return True
+
+    def add_jpeg_to_record(self, jpeg):
+        """Append an already encoded JPEG frame, no re-encoding."""
+        if self.recording:
+            return self.writer.write(jpeg)
+        return False
 
     def add_frame_to_record(self, frame):
-        if self.recording and self.writer:
-            self.writer.write(frame)
+        if self.recording:
+            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            return self.writer.write(buffer.tobytes())
+        return False
 
     def stop_recording(self):
-        if self.recording and self.writer:
-            self.writer.release()
-            self.writer = None
+        if self.recording:
             self.recording = False
-            print("Recording stopped")
+            result = self.writer.stop(self.finalize_timeout)
+            if result:
+                print(f"Recording stopped, {result[1]} frames finalised in "
+                      f"{self.writer.metrics['last_finalize_time']:.2f}s: {result[0]}")
 
     def is_recording(self):
         return self.recording
+
+    def stats(self):
+        return self.writer.stats()
+
+    def close(self):
+        self.stop_recording()
+        self.writer.close()
@@ -6,13 +6,17 @@ import threading
 import traceback
 import binascii
 
-import board
-import RPi.GPIO as GPIO
-from busio import I2C
-from digitalio import DigitalInOut
-from adafruit_pn532.i2c import PN532_I2C
+try:
+    import board
+    import RPi.GPIO as GPIO
+    from busio import I2C
+    from digitalio import DigitalInOut
+    from adafruit_pn532.i2c import PN532_I2C
+except (ImportError, RuntimeError, NotImplementedError):
+    GPIO = None  # Not on the Pi, only usable when replaying a sensor log
 
 from handle.tft_handle import TFTHandler
+from sensors.backend import get_backend
 import paho.mqtt.client as paho
 
 class RFIDHandler:
@@ -32,11 +36,16 @@ class RFIDHandler:
         # Use the passed MQTT client instance
         self.mqtt_client = mqtt_client
 
-        # Initialize GPIO
-        self.setup_gpio()
+        # No GPIO or reader hardware when replaying a sensor log
+        self.backend = get_backend()
+        self.hardware = not self.backend.replaying
+        if self.hardware:
+            # Initialize GPIO
+            self.setup_gpio()
 
-        # Initialize PN532 hardware
-        self.initialize_pn532()
+            # Initialize PN532 hardware
+            self.initialize_pn532()
+        self.read_card = self.backend.source('rfid', lambda: self.pn532.read_passive_target(timeout=0.5))
 
         # Path to user data file
         self.user_data_file = os.path.join(os.path.dirname(__file__), self.USER_DATA_FILENAME)
@@ -98,7 +107,7 @@ class RFIDHandler:
     def read_rfid(self):
         """Continuously read RFID cards and handle user data."""
         while not self.stop_event.is_set():
-            uid = self.pn532.read_passive_target(timeout=0.5)
+            uid = self.read_card()
 
             if uid is None:
                 self.handle_no_card_detected()
@@ -136,23 +145,23 @@ class RFIDHandler:
 
                 # Publish user info to MQTT
                 payload = self.mqtt_client.create_payload_user_info(self.data)
-                ret = self.mqtt_client.client.publish("v1/devices/me/telemetry", payload)
-                print("Pushing data from RFID done" if ret.rc == paho.MQTT_ERR_SUCCESS 
-                      else f"Failed with error code: {ret.rc}")
+                print("Pushing data from RFID queued" if self.mqtt_client.publish(payload, "rfid")
+                      else "Failed to queue RFID data")
             else:
                 self.data = {'name': "None", 'phone_number': "None"}
                 self.tft_handler.display_user_info(self.data)
                 # Publish user info to MQTT
                 payload = self.mqtt_client.create_payload_user_info(self.data)
-                ret = self.mqtt_client.client.publish("v1/devices/me/telemetry", payload)
-                print("Pushing data from RFID done" if ret.rc == paho.MQTT_ERR_SUCCESS 
-                      else f"Failed with error code: {ret.rc}")
+                print("Pushing data from RFID queued" if self.mqtt_client.publish(payload, "rfid")
+                      else "Failed to queue RFID data")
                 print("No user information found for this card.")
 
             self.last_uid = uid_hex
 
     def ring_buzzer(self, duration=0.1):
         """Activate the buzzer for a specified duration."""
+        if not self.hardware:
+            return
         GPIO.output(self.BUZZER_PIN, GPIO.HIGH)
         time.sleep(duration)
         GPIO.output(self.BUZZER_PIN, GPIO.LOW)
@@ -165,4 +174,5 @@ class RFIDHandler:
 
     def cleanup(self):
         """Clean up GPIO settings."""
-        GPIO.cleanup()
+        if self.hardware:
+            GPIO.cleanup()
@@ -0,0 +1,217 @@
+# Thesis/handle/segment_log_handle.py
+import os
+import json
+import mmap
+import threading
+from collections import deque
+
+
+class SegmentedLog:
+    """Append-only write-ahead log split into fixed-size segment files.
+
+    Each record is written once as a single JSON line. Consumers acknowledge
+    records in FIFO order, or by position in any order with ack_positions().
+    The acknowledged position is kept in a small checkpoint file that only
+    moves past records that are all acknowledged, and segments are deleted
+    once every record in them has been acknowledged. Appending and acknowledging cost the same no matter
+    how many records are waiting.
+    """
+
+    SEGMENT_PREFIX = "segment_"
+    SEGMENT_SUFFIX = ".log"
+    CHECKPOINT_FILENAME = "checkpoint.json"
+
+    def __init__(self, directory, segment_max_bytes=64 * 1024, fsync=False):
+        """
+        Parameters:
+            directory (str): Folder holding the segment and checkpoint files.
+            segment_max_bytes (int): Size at which the active segment is sealed.
+            fsync (bool): Force every append to disk (slower, wears the SD card).
+        """
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+        self.checkpoint_file = os.path.join(directory, self.CHECKPOINT_FILENAME)
+        self.lock = threading.RLock()  # re-entrant so ack() can run while replay() is iterating
+        os.makedirs(directory, exist_ok=True)
+
+        self.checkpoint = self._load_checkpoint()  # (segment, offset) of the last acked byte
+        self.segments = self._list_segments()
+        self._pending = deque()  # (segment, end_offset) of every unacked record, oldest first
+        self._delivered = set()  # Pending positions acknowledged out of order
+        self.replay_stats = {'records': 0, 'skipped': 0, 'bytes': 0}
+
+        # Always write into a fresh segment so a torn tail from a previous run is never appended to
+        self.active_segment = (self.segments[-1] + 1) if self.segments else 1
+        self.active_size = 0
+        self._writer = None
+        self._open_active_segment()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{self.SEGMENT_PREFIX}{segment:08d}{self.SEGMENT_SUFFIX}")
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX):
+                try:
+                    segments.append(int(name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(segments)
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_file, 'r') as f:
+                data = json.load(f)
+                return data['segment'], data['offset']
+        except FileNotFoundError:
+            return 0, 0
+        except (ValueError, KeyError) as e:
+            print(f"Invalid log checkpoint, replaying from the start: {e}")
+            return 0, 0
+
+    def _save_checkpoint(self):
+        """Atomically replace the checkpoint file."""
+        segment, offset = self.checkpoint
+        tmp_file = self.checkpoint_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({'segment': segment, 'offset': offset}, f)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def _open_active_segment(self):
+        if self._writer:
+            self._writer.close()
+        self._writer = open(self._segment_path(self.active_segment), 'ab')
+        self.active_size = self._writer.tell()
+        if self.active_segment not in self.segments:
+            self.segments.append(self.active_segment)
+
+    def _roll_segment(self):
+        """Seal the active segment and start the next one."""
+        self.active_segment += 1
+        self._open_active_segment()
+
+    def seal(self):
+        """Close the active segment so its records become visible to replay()."""
+        with self.lock:
+            if self.active_size:
+                self._roll_segment()
+
+    def append(self, record):
+        """Append one record to the log and return its (segment, end_offset)."""
+        line = (json.dumps(record, separators=(',', ':')) + "\n").encode('utf-8')
+        with self.lock:
+            if self.active_size and self.active_size + len(line) > self.segment_max_bytes:
+                self._roll_segment()
+            self._writer.write(line)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            self.active_size += len(line)
+            position = (self.active_segment, self.active_size)
+            self._pending.append(position)
+            return position
+
+    def replay(self):
+        """
+        Yield (position, record) for every unacknowledged record, oldest first, and track it as pending.
+        Segments are memory-mapped and scanned once. Lines that do not decode,
+        including a torn record at the end of a segment, are skipped.
+        """
+        with self.lock:
+            self._pending.clear()
+            self._delivered.clear()
+            self.replay_stats = {'records': 0, 'skipped': 0, 'bytes': 0}
+            checkpoint_segment, checkpoint_offset = self.checkpoint
+            for segment in list(self.segments):
+                if segment < checkpoint_segment or segment == self.active_segment:
+                    continue
+                start = checkpoint_offset if segment == checkpoint_segment else 0
+                with open(self._segment_path(segment), 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if size <= start:
+                        continue
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        offset = start
+                        while offset < size:
+                            end = mm.find(b"\n", offset)
+                            if end == -1:
+                                # Torn tail from a power cut in the middle of a write
+                                self.replay_stats['skipped'] += 1
+                                break
+                            end += 1
+                            try:
+                                record = json.loads(mm[offset:end])
+                            except ValueError:
+                                self.replay_stats['skipped'] += 1
+                                offset = end
+                                continue
+                            self.replay_stats['bytes'] += end - offset
+                            self.replay_stats['records'] += 1
+                            offset = end
+                            self._pending.append((segment, offset))
+                            yield (segment, offset), record
+
+    def ack(self, count=1):
+        """Mark the oldest `count` pending records as delivered."""
+        with self.lock:
+            position = None
+            for _ in range(min(count, len(self._pending))):
+                position = self._pending.popleft()
+                self._delivered.discard(position)
+            self._advance(position)
+
+    def ack_positions(self, positions):
+        """
+        Mark the records at `positions` (as returned by append/replay) as delivered,
+        in any order. The checkpoint moves past the oldest records only once every
+        record before them is delivered too, so a crash never skips an unsent one.
+        """
+        with self.lock:
+            self._delivered.update(positions)
+            position = None
+            while self._pending and self._pending[0] in self._delivered:
+                position = self._pending.popleft()
+                self._delivered.discard(position)
+            self._advance(position)
+
+    def _advance(self, position):
+        if position is None:
+            return
+        self.checkpoint = position
+        self._save_checkpoint()
+        self._delete_drained_segments()
+
+    def ack_all(self):
+        """Mark every pending record as delivered."""
+        with self.lock:
+            if not self._pending:
+                return
+            self.checkpoint = self._pending[-1]
+            self._pending.clear()
+            self._delivered.clear()
+            self._save_checkpoint()
+            self._delete_drained_segments()
+
+    def _delete_drained_segments(self):
+        """Remove sealed segments that hold no pending record."""
+        head_segment = self._pending[0][0] if self._pending else self.active_segment
+        while self.segments and self.segments[0] < head_segment:
+            segment = self.segments.pop(0)
+            try:
+                os.remove(self._segment_path(segment))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Error deleting log segment {segment}: {e}")
+
+    def pending_count(self):
+        with self.lock:
+            return len(self._pending)
+
+    def close(self):
+        with self.lock:
+            if self._writer:
+                self._writer.close()
+                self._writer = None
@@ -4,103 +4,273 @@ import time
 import math
 import json
 import queue
+from collections import deque
 import paho.mqtt.client as paho
 import os
 from datetime import datetime
-from geopy.geocoders import Nominatim
-from unidecode import unidecode
 
 from sensors.BNO055.BNO055_lib import BNO055Sensor 
 from sensors.Temp_DS18B20.DS18B20 import read_temp
 # from sensors.GPS.gps_simulator import GPSSimulator # Simulate GPS
 from sensors.GPS.GPS_lib import GPSModule
+from handle.segment_log_handle import SegmentedLog
+from handle.deadband_handle import DeadbandFilter
+from handle.rate_control_handle import AdaptiveRateController
+from handle.motion_fusion_handle import MotionFusion
+from handle.geocode_handle import ReverseGeocoder
+from handle.offline_geocode_handle import load_offline_geocoder
+from sensors.backend import get_backend
 
-class SensorBuffer:
-    def __init__(self, max_size=1000):
+def entry_ts(entry):
+    """Return the capture time of a buffered entry in epoch milliseconds."""
+    if 'ts' in entry:
+        return entry['ts']
+    # Entries cached before 'ts' was stored only carry the ISO timestamp
+    return int(datetime.fromisoformat(entry['timestamp']).timestamp() * 1000)
+
+class BufferLane:
+    """One priority lane of the store-and-forward buffer, with its own queue and log."""
+
+    DROP_OLDEST = "drop_oldest"  # Evict the oldest entry to make room
+    DROP_NEWEST = "drop_newest"  # Keep what is buffered and refuse the new entry
+
+    def __init__(self, name, max_size, eviction, cache_dir, segment_max_bytes):
+        self.name = name
+        self.eviction = eviction
         self.buffer = queue.Queue(maxsize=max_size)
-        # Set the absolute path for the cache file
-        self.cache_file = os.path.join(os.path.dirname(os.path.dirname(__file__)), 
-                                     "handle", "sensor_cache.json")
-        self._ensure_cache_directory()
+        self.log = SegmentedLog(os.path.join(cache_dir, name), segment_max_bytes=segment_max_bytes)
+        self.dropped = 0
+        self.recovery_stats = {'records': 0, 'skipped': 0, 'bytes': 0, 'dropped': 0, 'seconds': 0.0}
+
+    def _make_room(self):
+        """Apply the eviction policy to a full lane. Return False if the new entry must be refused."""
+        if not self.buffer.full():
+            return True
+        self.dropped += 1
+        if self.eviction == self.DROP_NEWEST:
+            return False
+        # Remove oldest entry if lane is full, it is dropped from the log as well
+        position, _ = self.buffer.get()
+        self.log.ack_positions([position])
+        return True
+
+    def add(self, entry):
+        """Queue and log an entry, applying the lane eviction policy. Return False if it was dropped."""
+        if not self._make_room():
+            return False
+        position = self.log.append(entry)
+        self.buffer.put((position, entry))
+        return True
+
+    def requeue(self, position, entry):
+        """Queue again an entry whose publish failed. It is still pending in the log, so it is not logged twice."""
+        if not self._make_room():
+            self.log.ack_positions([position])
+            return False
+        self.buffer.put((position, entry))
+        return True
+
+    def restore(self):
+        """
+        Stream the lane log into the queue in a single pass. Each entry keeps its
+        original timestamp and only the entries allowed by the eviction policy are kept.
+        """
+        start_time = time.perf_counter()
+        restored = deque()
+        dropped_positions = []
+        for position, entry in self.log.replay():
+            restored.append((position, entry))
+            if self.buffer.maxsize and len(restored) > self.buffer.maxsize:
+                # Entries that no longer fit are removed from the log, not left pending
+                dropped = restored.pop() if self.eviction == self.DROP_NEWEST else restored.popleft()
+                dropped_positions.append(dropped[0])
+        if dropped_positions:
+            self.log.ack_positions(dropped_positions)
+        dropped = len(dropped_positions)
+        while not self.buffer.full() and restored:
+            self.buffer.put_nowait(restored.popleft())
+
+        self.dropped += dropped
+        self.recovery_stats = dict(self.log.replay_stats,
+                                   dropped=dropped,
+                                   seconds=time.perf_counter() - start_time)
+        return self.recovery_stats
+
+    def drain(self):
+        """Return every queued (log position, entry). They stay pending in the log until acknowledged."""
+        entries = []
+        while not self.buffer.empty():
+            entries.append(self.buffer.get())
+        return entries
+
+    def stats(self):
+        return {
+            'depth': self.buffer.qsize(),
+            'capacity': self.buffer.maxsize,
+            'dropped': self.dropped,
+            'eviction': self.eviction
+        }
+
+
+class SensorBuffer:
+    # Lanes in drain order: name -> (capacity, eviction policy)
+    LANES = {
+        # Critical events are rare, a long outage must not refuse the newest accident in favour of old ones
+        'critical': (1000, BufferLane.DROP_OLDEST),
+        'normal': (500, BufferLane.DROP_OLDEST),
+        'routine': (300, BufferLane.DROP_OLDEST),
+    }
+    # Lane of each sensor type, anything not listed goes to DEFAULT_LANE
+    SENSOR_LANES = {
+        'accelerometer_detect': 'critical',
+        'vehicle_state_change': 'critical',
+        'accident': 'critical',
+        'accelerometer': 'normal',
+        'gps': 'normal',
+        'temperature': 'routine',
+    }
+    DEFAULT_LANE = 'normal'
+
+    def __init__(self, lanes=None, segment_max_bytes=64 * 1024):
+        # Set the absolute path for the write-ahead log directory
+        self.cache_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 
+                                     "handle", "sensor_cache")
+        self.legacy_cache_file = os.path.join(os.path.dirname(self.cache_dir), "sensor_cache.json")
         self.buffer_lock = threading.Lock()  # Add thread safety
-        
-    def _ensure_cache_directory(self):
-        """Ensure the cache directory exists"""
-        cache_dir = os.path.dirname(self.cache_file)
-        os.makedirs(cache_dir, exist_ok=True)
+        self.recovery_stats = {'records': 0, 'skipped': 0, 'bytes': 0, 'dropped': 0, 'seconds': 0.0}
+        # Entries are appended once to each lane's segment files instead of rewriting the whole cache
+        self.lanes = {
+            name: BufferLane(name, max_size, eviction, self.cache_dir, segment_max_bytes)
+            for name, (max_size, eviction) in (lanes or self.LANES).items()
+        }
+
+    def _lane_for(self, sensor_type):
+        lane = self.SENSOR_LANES.get(sensor_type, self.DEFAULT_LANE)
+        return self.lanes.get(lane) or self.lanes[self.DEFAULT_LANE]
 
-    def add_data(self, sensor_type, data):
+    def _make_entry(self, sensor_type, data, ts=None):
+        if ts is None:
+            ts = int(time.time() * 1000)
+        return {
+            'timestamp': datetime.fromtimestamp(ts / 1000).isoformat(),
+            'ts': ts,
+            'sensor_type': sensor_type,
+            'data': data
+        }
+
+    def add_data(self, sensor_type, data, ts=None):
+        """Buffer a telemetry payload. `ts` (epoch ms) keeps the original capture time when re-buffering."""
         try:
-            entry = {
-                'timestamp': datetime.now().isoformat(),
-                'sensor_type': sensor_type,
-                'data': data
-            }
+            entry = self._make_entry(sensor_type, data, ts)
+            lane = self._lane_for(sensor_type)
             with self.buffer_lock:
-                if self.buffer.full():
-                    # Remove oldest entry if buffer is full
-                    self.buffer.get()
-                self.buffer.put(entry)
-                print(f"Buffered data: {entry}")
-                self._save_to_cache()
+                added = lane.add(entry)
+            if added:
+                print(f"Buffered data in {lane.name} lane: {entry}")
+            else:
+                print(f"{lane.name} lane full, dropped: {entry}")
         except Exception as e:
             print(f"Error adding data to buffer: {e}")
 
-    def _save_to_cache(self):
+    def load_cache(self):
+        """Restore entries that were buffered but not delivered before the last shutdown."""
+        start_time = time.perf_counter()
         try:
+            self._import_legacy_cache()
+            totals = {'records': 0, 'skipped': 0, 'bytes': 0, 'dropped': 0}
             with self.buffer_lock:
-                # Convert queue to list for serialization while preserving order
-                cache_data = []
-                temp_buffer = queue.Queue()
-                
-                while not self.buffer.empty():
-                    item = self.buffer.get()
-                    cache_data.append(item)
-                    temp_buffer.put(item)
-                
-                # Restore the buffer
-                while not temp_buffer.empty():
-                    self.buffer.put(temp_buffer.get())
-
-            # Write to file with proper formatting
-            with open(self.cache_file, 'w') as f:
-                json.dump(cache_data, f, indent=2)
-                print(f"Cache saved to {self.cache_file}") 
-        except Exception as e:
-            print(f"Error saving to cache: {e}")
+                for lane in self.lanes.values():
+                    lane_stats = lane.restore()
+                    for key in totals:
+                        totals[key] += lane_stats[key]
 
-    def load_cache(self):
-        try:
-            if os.path.exists(self.cache_file):
-                with open(self.cache_file, 'r') as f:
-                    cache_data = json.load(f)
-                    print(f"Loaded cache: {cache_data}")
-                    # Sort data by timestamp before loading
-                    cache_data.sort(key=lambda x: x['timestamp'])
-                    for entry in cache_data:
-                        self.add_data(entry['sensor_type'], entry['data'])
+            self.recovery_stats = dict(totals, seconds=time.perf_counter() - start_time)
+            if self.recovery_stats['records']:
+                depths = ", ".join(f"{name}={lane.buffer.qsize()}" for name, lane in self.lanes.items())
+                print(f"Loaded cached entries from {self.cache_dir} ({depths}) "
+                      f"in {self.recovery_stats['seconds'] * 1000:.1f} ms "
+                      f"(skipped {self.recovery_stats['skipped']} corrupted, dropped {self.recovery_stats['dropped']})")
             else:
-                print("No cache file found, starting with empty buffer")
+                print("No cached entries found, starting with empty buffer")
         except Exception as e:
             print(f"Error loading cache: {e}")
 
+    def _import_legacy_cache(self):
+        """Move entries from the old single-file JSON cache into the lane logs, once."""
+        if not os.path.exists(self.legacy_cache_file):
+            return
+        try:
+            with open(self.legacy_cache_file, 'r') as f:
+                cache_data = json.load(f)
+            for entry in cache_data:
+                self._lane_for(entry.get('sensor_type')).log.append(entry)
+            for lane in self.lanes.values():
+                lane.log.seal()
+        except Exception as e:
+            # Keep the file for inspection instead of destroying entries that may still be recoverable
+            print(f"Error importing legacy cache: {e}")
+            os.replace(self.legacy_cache_file, self.legacy_cache_file + ".bad")
+            return
+        # The old format is never written again
+        os.remove(self.legacy_cache_file)
+        print(f"Imported {len(cache_data)} entries from {self.legacy_cache_file}")
+
+    def persist(self, sensor_type, data, ts=None):
+        """
+        Log an entry that is being published right away, without queueing it for the backlog.
+        Returns its (lane name, log position, entry) item for ack_delivered() or requeue().
+        """
+        entry = self._make_entry(sensor_type, data, ts)
+        lane = self._lane_for(sensor_type)
+        with self.buffer_lock:
+            position = lane.log.append(entry)
+        return lane.name, position, entry
+
     def get_pending_data(self):
+        """
+        Drain every lane, critical entries first, as (lane name, log position, entry) items.
+        The entries stay in the log until ack_delivered(), so a crash while they are
+        being published loses nothing.
+        """
         pending_data = []
         with self.buffer_lock:
-            while not self.buffer.empty():
-                pending_data.append(self.buffer.get())
+            for lane in self.lanes.values():
+                pending_data.extend((lane.name, position, entry) for position, entry in lane.drain())
         return pending_data
+
+    def ack_delivered(self, items):
+        """Remove drained items from the log once the broker has acknowledged them."""
+        positions = {}
+        for lane_name, position, _ in items:
+            positions.setdefault(lane_name, []).append(position)
+        with self.buffer_lock:
+            for lane_name, lane_positions in positions.items():
+                self.lanes[lane_name].log.ack_positions(lane_positions)
+
+    def requeue(self, items):
+        """Put drained items whose publish failed back in their lanes."""
+        with self.buffer_lock:
+            for lane_name, position, entry in items:
+                self.lanes[lane_name].requeue(position, entry)
+
+    def lane_stats(self):
+        """Return depth, capacity and drop count of every lane."""
+        with self.buffer_lock:
+            return {name: lane.stats() for name, lane in self.lanes.items()}
     
     def clear_cache(self):
-        """Clear the cache file and buffer"""
+        """Clear the cache logs and buffers"""
         with self.buffer_lock:
-            while not self.buffer.empty():
-                self.buffer.get()
-            if os.path.exists(self.cache_file):
+            for lane in self.lanes.values():
+                lane.drain()
                 try:
-                    os.remove(self.cache_file)
+                    lane.log.ack_all()
                 except Exception as e:
-                    print(f"Error clearing cache file: {e}")
+                    print(f"Error clearing {lane.name} cache log: {e}")
+
+    def close(self):
+        for lane in self.lanes.values():
+            lane.log.close()
 
 
 class SensorHandler:
@@ -114,10 +284,6 @@ class SensorHandler:
         self.running = True  # Flag to control sensor reading loops
         self.last_send_time = time.time()  # Last telemetry send time
         
-        # Velocity components
-        self.vx, self.vy, self.vz = 0, 0, 0
-        self.velocity = 0 
-        
         # Accelerometer thresholds for accident detection
         # self.ACC_X_THRESHOLD = 15
         # self.ACC_Y_THRESHOLD = 7
@@ -129,67 +295,117 @@ class SensorHandler:
         
         self.connection_handler = connection_handler
         self.sensor_buffer = SensorBuffer()
+        self.drain_batch_size = 50  # Buffered entries per ThingsBoard timeseries message
+        self.deadband = DeadbandFilter(max_silence=60)  # Report-by-exception before publish/buffer
+        # Routine publish intervals stretch when RTT/loss on the link get worse
+        self.rate_controller = AdaptiveRateController(self.connection_handler.get_link_stats)
+        self.mqtt_client.pipeline.on_failure = self._rebuffer_message
+        self.mqtt_client.pipeline.on_success = self._ack_message
+        # Drain the backlog as soon as the broker connection comes back
+        self.drain_event = threading.Event()
+        self.mqtt_client.supervisor.add_listener(on_connected=self.drain_event.set)
         self.sensor_buffer.load_cache()
 
         # Start data publishing thread
         self.publisher_thread = threading.Thread(target=self._publish_buffered_data, daemon=True)
         self.publisher_thread.start()
         
-        self.acc_threshold = 0.1  # Ignore very small accelerations below 0.1 m/s²
-        self.velocity_decay = 0.95  # Reduce velocity by 5% each iteration
-        self.zero_velocity_threshold = 0.1  # Threshold to reset velocity to zero
-        self.acc_window_size = 5 # Keep track of last 5 acceleration readings
-        self.acc_window = {'x': [], 'y': [], 'z': []} # Store acceleration history
-        
-        self.accel_thread = threading.Thread(target=self.bno055.read_accelerometer_thread, daemon=True)
-        self.linear_accel_thread = threading.Thread(target=self.bno055.read_linear_accelerometer_thread, daemon=True)
-        self.accel_thread.start()
-        self.linear_accel_thread.start()
+        # One burst read of every BNO055 vector per sample
+        self.imu_thread = threading.Thread(target=self.bno055.read_sensor_thread, daemon=True)
+        self.imu_thread.start()
         
         # self.gps = GPSSimulator()
         self.gps = GPSModule()
+        # Cached, asynchronous address lookups, answered from the local index until the network replies
+        self.geocoder = ReverseGeocoder(min_distance=50, offline=load_offline_geocoder())
+        self.address_no_accent = self.geocoder.get_address()
+        self.read_temp = get_backend().source('temperature', read_temp)
         self.gps_thread = threading.Thread(target=self.read_gps, daemon=True)
         self.gps_thread.start()
 
+        # Velocity and heading from IMU and GPS together, the only writer of the speed estimate
+        self.motion_fusion = MotionFusion(self.bno055, self.gps)
+        self.motion_fusion.start()
+
+    def get_motion(self):
+        """Latest fused MotionEstimate (speed in m/s, heading in degrees)."""
+        return self.motion_fusion.get_estimate()
+
+    def get_velocity(self):
+        """Fused speed in km/h."""
+        return self.motion_fusion.get_estimate().speed * 3.6
+
+    @property
+    def velocity(self):
+        """Fused speed in km/h, read-only. Kept for the camera and motion state handlers."""
+        return self.get_velocity()
+
     def _publish_data(self, payload, sensor_type, priority=False):
         """Attempt to publish data or buffer it if connection is lost"""
-        if self.connection_handler.get_connection_status():
-            ret = self.mqtt_client.client.publish("v1/devices/me/telemetry", payload)
-            if ret.rc == paho.MQTT_ERR_SUCCESS:
-                print(f"{sensor_type} data published successfully")
+        # Unchanged routine telemetry is neither sent nor buffered, events always go through
+        if not priority and self.sensor_buffer.SENSOR_LANES.get(sensor_type) != 'critical':
+            payload = self.deadband.filter(sensor_type, payload)
+            if payload is None:
+                print(f"{sensor_type} data unchanged, skipped")
                 return True
-            else:
-                print(f"Failed to publish {sensor_type} data. Error code: {ret.rc}")
-                self.sensor_buffer.add_data(sensor_type, payload)
-                return False
+        if self.connection_handler.get_connection_status() and self.mqtt_client.is_connected():
+            # Publish result arrives asynchronously, undelivered messages come back through _rebuffer_message
+            return self.mqtt_client.publish(payload, sensor_type)
         else:
             print(f"No connection. Buffering {sensor_type} data...")
             self.sensor_buffer.add_data(sensor_type, payload)
             return False
 
+    def publish_event(self, payload, sensor_type):
+        """
+        Publish a critical event. It is written to its lane log first and only acknowledged
+        there on PUBACK, so an accident survives an outage followed by a power cut.
+        Returns:
+            bool: True if it was handed to the publish pipeline, False if it waits in the buffer.
+        """
+        try:
+            item = self.sensor_buffer.persist(sensor_type, payload)
+        except Exception as e:
+            print(f"Error logging {sensor_type} event: {e}")
+            return self.mqtt_client.publish(payload, sensor_type)
+        if self.connection_handler.get_connection_status() and self.mqtt_client.is_connected():
+            # Failure puts the item back in its lane through _rebuffer_message
+            return self.mqtt_client.pipeline.submit(payload, sensor_type, ts=item[2]['ts'], entries=[item])
+        print(f"No connection. Buffering {sensor_type} event...")
+        self.sensor_buffer.requeue([item])
+        return False
+
+    def _rebuffer_message(self, message):
+        """Put a message the publish pipeline could not deliver back in the durable buffer"""
+        if message['entries']:
+            # Backlog batch, its entries are still in the log and only go back in their lanes
+            self.sensor_buffer.requeue(message['entries'])
+        else:
+            self.sensor_buffer.add_data(message['sensor_type'], message['payload'], message['ts'])
+
+    def _ack_message(self, message):
+        """Drop a delivered backlog batch from the durable buffer."""
+        if message['entries']:
+            self.sensor_buffer.ack_delivered(message['entries'])
+
     def _publish_buffered_data(self):
-        """Continuously attempt to publish buffered data when connection is available"""
+        """Continuously publish buffered data in timestamped batches when connection is available"""
         while self.running:
-            if self.connection_handler.get_connection_status():
+            if self.connection_handler.get_connection_status() and self.mqtt_client.is_connected():
                 pending_data = self.sensor_buffer.get_pending_data()
-                for entry in pending_data:
-                    ret = self.mqtt_client.client.publish("v1/devices/me/telemetry", entry['data'])
-                    if ret.rc == paho.MQTT_ERR_SUCCESS:
-                        print(f"Published buffered {entry['sensor_type']} data from {entry['timestamp']}")
-                    else:
-                        print(f"Re-buffering failed data: {entry}")
-                        # Put back in buffer if publish fails
-                        self.sensor_buffer.add_data(entry['sensor_type'], entry['data'])
-            time.sleep(5)  # Check every 5 seconds
+                for start in range(0, len(pending_data), self.drain_batch_size):
+                    batch = pending_data[start:start + self.drain_batch_size]
+                    payload = self.mqtt_client.create_payload_telemetry_batch(
+                        [(entry_ts(entry), entry['data']) for _, _, entry in batch])
+                    # Acked from the log on PUBACK by _ack_message, put back in the lanes on failure
+                    self.mqtt_client.pipeline.submit(payload, "backlog", entries=batch)
+                    print(f"Queued {len(batch)} buffered entries from {batch[0][2]['timestamp']} to {batch[-1][2]['timestamp']}")
+            # Check every 5 seconds, or right away after a reconnect
+            self.drain_event.wait(5)
+            self.drain_event.clear()
             
-    def moving_average(self, values):
-        """Takes a list of values and returns their average. It helps smooth out noisy acceleration readings."""
-        if not values:
-            return 0
-        return sum(values) / len(values)
-
     def read_accelerometer(self):
-        """Read accelerometer data, update velocity, and publish telemetry."""
+        """Read accelerometer data and publish telemetry with the fused velocity."""
         last_publish_time = time.time()  # Track the last publish time
         while self.running:
             ax, ay, az = self.bno055.accel_data
@@ -198,95 +414,19 @@ class SensorHandler:
             print("Accelerometer:", ax, ay, az)
             print("Linear Accelerometer:", lax, lay, laz)
 
-            # Store recent acceleration readings
-            self.acc_window['x'].append(lax)
-            self.acc_window['y'].append(lay)
-            self.acc_window['z'].append(laz)
-            
-            # Keep only the last 5 readings
-            if len(self.acc_window['x']) > self.acc_window_size:
-                self.acc_window['x'].pop(0)
-                self.acc_window['y'].pop(0)
-                self.acc_window['z'].pop(0)
-                
-            # Calculate average acceleration from recent readings
-            smooth_ax = self.moving_average(self.acc_window['x'])
-            smooth_ay = self.moving_average(self.acc_window['y'])
-            smooth_az = self.moving_average(self.acc_window['z'])
-            
             self.current_time = time.time()
-            dt = self.current_time - self.last_send_time
-            self.last_send_time = self.current_time
-            
-            # If acceleration is very small, treat it as zero
-            smooth_ax = 0 if abs(smooth_ax) < self.acc_threshold else smooth_ax
-            smooth_ay = 0 if abs(smooth_ay) < self.acc_threshold else smooth_ay
-            smooth_az = 0 if abs(smooth_az) < self.acc_threshold else smooth_az
-
-            # Update velocity
-            # self.vx += round(lax, 8) * dt
-            # self.vy += round(lay, 8) * dt
-            # self.vz += round(laz, 8) * dt
-            
-            # Update velocity with decay
-            self.vx = (self.vx + smooth_ax * dt) * self.velocity_decay
-            self.vy = (self.vy + smooth_ay * dt) * self.velocity_decay
-            self.vz = (self.vz + smooth_az * dt) * self.velocity_decay
-
-            # Reset velocity if it's very small
-            if abs(self.vx) < self.zero_velocity_threshold:
-                self.vx = 0
-            if abs(self.vy) < self.zero_velocity_threshold:
-                self.vy = 0
-            if abs(self.vz) < self.zero_velocity_threshold:
-                self.vz = 0
-                
-            ######################## Example ########################
-            """
-            Let's say sensor reads these accelerations:
-            Reading 1: 0.03 m/s²
-            Reading 2: -0.02 m/s²
-            Reading 3: 0.04 m/s²
-            Reading 4: 0.01 m/s²
-            Reading 5: -0.03 m/s²
-            The moving average would be: (0.03 - 0.02 + 0.04 + 0.01 - 0.03) / 5 = 0.006 m/s²
-            Since 0.006 is less than threshold (0.1), it gets set to 0
-            This prevents tiny readings from affecting the velocity.
-            """
-            
-            """ 
-            WITHOUT DECAY
-            Starting velocity = 0 m/s
-            Reading tiny acceleration = 0.01 m/s²
-
-            After 1 second: v = 0 + 0.01 = 0.01 m/s
-            After 2 seconds: v = 0.01 + 0.01 = 0.02 m/s
-            After 3 seconds: v = 0.02 + 0.01 = 0.03 m/s
-            ...keeps increasing forever
-            
-            WITH DECAY
-            Starting velocity = 0 m/s
-            Reading tiny acceleration = 0.01 m/s²
-
-            After 1 second: v = (0 + 0.01) * 0.95 = 0.0095 m/s
-            After 2 seconds: v = (0.0095 + 0.01) * 0.95 = 0.0185 m/s
-            After 3 seconds: v = (0.0185 + 0.01) * 0.95 = 0.027 m/s
-            Eventually stabilizes instead of increasing forever
-            """
-            ######################## End Example ########################
-            
-            self.velocity = math.sqrt(self.vx**2 + self.vy**2 + self.vz**2) * 3.6  # Convert to km/h
-            print("Velocity real is:", self.velocity)
+            velocity = self.get_velocity()
+            print("Velocity real is:", velocity)
 
             # Check for potential accidents
             if self.acc_detect_accident >= self.ACC_THRESHOLD:
-                payload = self.mqtt_client.create_payload_motion_data(ax, ay, az, self.velocity, status, lax)
+                payload = self.mqtt_client.create_payload_motion_data(ax, ay, az, velocity, status, lax)
                 self._publish_data(payload, "accelerometer_detect")
 
             # Publish telemetry data every ... seconds
-            if self.current_time - last_publish_time >= 4:
+            if self.current_time - last_publish_time >= self.rate_controller.interval('accelerometer'):
                 status = "Normal"  # Replace with your status logic
-                payload = self.mqtt_client.create_payload_motion_data(ax, ay, az, self.velocity, status, lax)
+                payload = self.mqtt_client.create_payload_motion_data(ax, ay, az, velocity, status, lax)
                 self._publish_data(payload, "accelerometer")
                 # Update the last publish time
                 last_publish_time = self.current_time
@@ -298,7 +438,7 @@ class SensorHandler:
         """Continuously read temperature data and publish it."""
         while self.running:
             try:
-                temp_c, temp_f = read_temp()  # Use the imported function
+                temp_c, temp_f = self.read_temp()  # DS18B20, or the recorded log
                 print(f'Temperature: {temp_c:.2f} °C, {temp_f:.2f} °F')
                 
                 # MQTT publish payload for temperature
@@ -313,7 +453,8 @@ class SensorHandler:
             except Exception as e:
                 print(f"Error reading temperature: {e}")
             
-            threading.Event().wait(5)  # Wait 5 seconds before reading again
+            # Wait 5 seconds before reading again, longer while the link is degraded
+            threading.Event().wait(self.rate_controller.interval('temperature'))
 
 
     def read_gps(self):
@@ -321,44 +462,52 @@ class SensorHandler:
         try:
             self.gps.start()
             print("GPS Reader started. Reading data...")
-            geolocator = Nominatim(user_agent="geoapi")
-            while self.running:
+            last_publish_time = 0
+            last_stats_time = time.time()
+            # Wake on each new fix instead of polling, None means no fix within the timeout
+            for fix in self.gps.fixes(timeout=2):
+                if not self.running:
+                    break
                 try:
-                    self.velocity = self.gps.get_velocity()
-                    self.latitude, self.longitude = self.gps.get_location()
-                    if self.latitude is not None and self.longitude is not None:
-                        # location = geolocator.reverse((latitude, longitude), language="en") 
-                        geolocator = Nominatim(user_agent="geoapi", timeout=10)
-                        locat = geolocator.reverse((self.latitude, self.longitude), language="en")
-                        address = locat.address
-                        self.address_no_accent = unidecode(address)
-                        # location = geolocator.reverse((latitude, longitude), language="en")  
+                    if fix is not None:
+                        self.latitude, self.longitude = fix.latitude, fix.longitude
+                        # Never blocks: cached tile, unchanged position, or looked up in the background
+                        self.address_no_accent = self.geocoder.update(self.latitude, self.longitude)
                         print("Lagitude: ", self.latitude, "Longitude: ", self.longitude)
                         print(self.address_no_accent)
                         payload = self.mqtt_client.create_payload_gps(self.longitude, self.latitude)
                         # ret = self.mqtt_client.publish(payload)  # Publish GPS data
                         # print("GPS data published successfully" if ret.rc == paho.MQTT_ERR_SUCCESS 
                         #         else f"Failed with error code: {ret.rc}")
-                        self._publish_data(payload, "gps")
+                        # Every fix updates the position, publishing slows down on a degraded link
+                        if time.time() - last_publish_time >= self.rate_controller.interval('gps'):
+                            self._publish_data(payload, "gps")
+                            last_publish_time = time.time()
                         print(f"GPS - Latitude: {self.latitude}, Longitude: {self.longitude}")
                     else: 
                         print("Waiting for location...")
-                    if self.velocity is not None:
-                        print(f"Current Velocity: {self.velocity:.2f} m/s")
+                    if time.time() - last_stats_time >= 300:
+                        stats = self.geocoder.stats()
+                        print(f"Geocoding: hit rate {stats['hit_rate'] or 0:.0%}, {stats['lookups']} lookups "
+                              f"for {stats['updates']} fixes, {stats['offline']} offline, {stats['cached_tiles']} tiles cached")
+                        last_stats_time = time.time()
+                    motion = self.get_motion()
+                    if motion.gps_fixes:
+                        print(f"Current Velocity: {motion.speed:.2f} m/s, heading {motion.heading:.0f}°")
                     else:
                         print("Waiting for velocity data...")
                 except Exception as e:
                     print(f"Error reading GPS: {e}")
-                threading.Event().wait(1)
         except KeyboardInterrupt:
             print("KeyboardInterrupt detected. Stopping GPS reader...")
 
     def cleanup(self):
         """Clean up and stop sensors."""
         self.running = False
-        self.bno055.stop_threads()  # Stop accelerometer threads
-        self.accel_thread.join(timeout=1)
-        self.linear_accel_thread.join(timeout=1)
+        self.motion_fusion.stop()
+        self.geocoder.close()  # Persist the address cache
+        self.bno055.stop_threads()  # Stop IMU sampler thread
+        self.imu_thread.join(timeout=1)
         
         if hasattr(self, 'gps'):
             self.gps.stop()  # Ensure the GPS is stopped properly
@@ -367,4 +516,5 @@ class SensorHandler:
             print("Cleaned up GPS resources.")
             
         self.publisher_thread.join(timeout=1)
+        self.sensor_buffer.close()
         print("Sensor handler cleaned up")
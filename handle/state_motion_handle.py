@@ -64,7 +64,9 @@ class MotionStateHandler:
             try:
                 gps_location = (self.sensor_handler.latitude, self.sensor_handler.longitude)
                 velocity = self.sensor_handler.velocity
-                acceleration = self.sensor_handler.bno055.linear_accel_data
+                bno055 = self.sensor_handler.bno055
+                # Linear acceleration is only meaningful once the BNO055 fusion is calibrated
+                acceleration = bno055.linear_accel_data if bno055.is_trusted() else None
 
                 self._update_buffers(gps_location, velocity, acceleration)
                 self._update_movement_status()
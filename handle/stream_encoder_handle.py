@@ -0,0 +1,175 @@
+# Thesis/handle/stream_encoder_handle.py
+import threading
+import time
+
+import cv2
+
+
+class StreamEncoder:
+    """
+    Viewer-driven JPEG encoding for the MJPEG stream.
+    Viewers subscribe with a (quality, scale) profile. Each captured frame is
+    encoded once per profile that has at least one subscriber, however many
+    viewers share it, and not at all when nobody is watching. The profile that
+    matches the capture loop's own JPEG reuses those bytes instead of encoding.
+
+    Frames are broadcast: viewers block in wait() until a frame newer than the
+    last one they sent exists. Only the newest frame per profile is kept, so a
+    slow viewer skips frames without holding back anyone else.
+    """
+
+    def __init__(self, base_quality=80, min_quality=10, max_quality=95, min_scale=0.1):
+        """
+        Parameters:
+            base_quality (int): Quality of the JPEG the capture loop already produces.
+        """
+        self.base_quality = base_quality
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.min_scale = min_scale
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.running = True
+        self.sequence = 0  # Captured frame number
+        self.profiles = {}  # (quality, scale) -> subscriber count
+        self.latest = {}  # (quality, scale) -> (sequence, JPEG bytes, publish time)
+        self.viewers = {}  # viewer id -> per-viewer delivery stats
+        self.metrics = {'frames': 0, 'frames_without_viewers': 0, 'encodes': 0, 'reused': 0}
+        # Capture loop CPU per frame, split by whether anyone was watching: [seconds, frames]
+        self.cpu = {'with_viewers': [0.0, 0], 'without_viewers': [0.0, 0]}
+
+    def profile(self, quality=None, scale=None):
+        """Normalise client settings into a profile key, so equal settings share one encode."""
+        quality = self.base_quality if quality is None else min(max(int(quality), self.min_quality), self.max_quality)
+        scale = 1.0 if scale is None else min(max(float(scale), self.min_scale), 1.0)
+        return quality, round(scale, 2)
+
+    def subscribe(self, profile):
+        with self.lock:
+            self.profiles[profile] = self.profiles.get(profile, 0) + 1
+
+    def unsubscribe(self, profile):
+        with self.lock:
+            count = self.profiles.get(profile, 0) - 1
+            if count > 0:
+                self.profiles[profile] = count
+            else:
+                self.profiles.pop(profile, None)
+                self.latest.pop(profile, None)
+
+    def subscriber_count(self):
+        with self.lock:
+            return sum(self.profiles.values())
+
+    def publish(self, frame, base_jpeg):
+        """
+        Encode `frame` for every subscribed profile.
+        Returns:
+            int: Number of profiles served, 0 when there are no viewers.
+        """
+        with self.lock:
+            profiles = list(self.profiles)
+            self.sequence += 1
+            sequence = self.sequence
+        self.metrics['frames'] += 1
+        if not profiles:
+            self.metrics['frames_without_viewers'] += 1
+            return 0
+        for quality, scale in profiles:
+            if quality == self.base_quality and scale == 1.0:
+                jpeg = base_jpeg
+                self.metrics['reused'] += 1
+            elif frame is None:
+                continue  # Only the base JPEG exists yet
+            else:
+                image = frame
+                if scale < 1.0:
+                    image = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+                self.metrics['encodes'] += 1
+            with self.condition:
+                if (quality, scale) in self.profiles:
+                    self.latest[(quality, scale)] = (sequence, jpeg, time.time())
+                    self.condition.notify_all()
+        return len(profiles)
+
+    def get(self, profile):
+        """Newest JPEG for a profile without waiting, or None."""
+        with self.lock:
+            latest = self.latest.get(profile)
+        return latest[1] if latest else None
+
+    def wait(self, profile, last_sequence, timeout=1.0):
+        """
+        Block until the profile has a frame newer than `last_sequence`.
+        Returns:
+            tuple: (sequence, jpeg, publish time), or None on timeout or close.
+        """
+        def newer():
+            latest = self.latest.get(profile)
+            return not self.running or (latest is not None and latest[0] > last_sequence)
+        with self.condition:
+            if not self.condition.wait_for(newer, timeout) or not self.running:
+                return None
+            return self.latest[profile]
+
+    def add_viewer(self, viewer_id, profile):
+        self.subscribe(profile)
+        viewer = {'profile': profile, 'connected': time.time(), 'frames': 0, 'dropped': 0,
+                  'fps': None, 'lag_ms': None, 'max_lag_ms': 0.0, 'last_sent': None}
+        with self.lock:
+            self.viewers[viewer_id] = viewer
+        return viewer
+
+    def remove_viewer(self, viewer_id):
+        with self.lock:
+            viewer = self.viewers.pop(viewer_id, None)
+        if viewer is not None:
+            self.unsubscribe(viewer['profile'])
+
+    def delivered(self, viewer, sequence, last_sequence, published, alpha=0.1):
+        """
+        Record that a viewer finished sending a frame.
+        Lag is publish-to-sent time, fps and lag are exponential moving averages.
+        """
+        now = time.time()
+        lag = (now - published) * 1000
+        if last_sequence:
+            viewer['dropped'] += sequence - last_sequence - 1
+        if viewer['last_sent'] is not None and now > viewer['last_sent']:
+            fps = 1 / (now - viewer['last_sent'])
+            viewer['fps'] = fps if viewer['fps'] is None else viewer['fps'] + alpha * (fps - viewer['fps'])
+        viewer['lag_ms'] = lag if viewer['lag_ms'] is None else viewer['lag_ms'] + alpha * (lag - viewer['lag_ms'])
+        viewer['max_lag_ms'] = max(viewer['max_lag_ms'], lag)
+        viewer['frames'] += 1
+        viewer['last_sent'] = now
+
+    def viewer_stats(self):
+        now = time.time()
+        with self.lock:
+            viewers = {viewer_id: dict(viewer) for viewer_id, viewer in self.viewers.items()}
+        for viewer in viewers.values():
+            quality, scale = viewer.pop('profile')
+            viewer['profile'] = f"q{quality}@{scale}"
+            viewer['connected_s'] = now - viewer.pop('connected')
+            viewer.pop('last_sent')
+        return viewers
+
+    def close(self):
+        """Wake every waiting viewer so its stream can end."""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def record_cpu(self, seconds, served):
+        bucket = self.cpu['with_viewers' if served else 'without_viewers']
+        bucket[0] += seconds
+        bucket[1] += 1
+
+    def stats(self):
+        metrics = dict(self.metrics)
+        with self.lock:
+            metrics['profiles'] = {f"q{quality}@{scale}": count for (quality, scale), count in self.profiles.items()}
+        for key, (seconds, frames) in self.cpu.items():
+            metrics[f'cpu_ms_per_frame_{key}'] = seconds / frames * 1000 if frames else None
+        return metrics
@@ -1,4 +1,7 @@
-from sensors.Nokia_5110_LCD.tft_display import draw_tft
+try:
+    from sensors.Nokia_5110_LCD.tft_display import draw_tft
+except (ImportError, RuntimeError, NotImplementedError):
+    draw_tft = None  # No display attached (e.g. replaying a sensor log on a dev box)
 
 class TFTHandler:
     def __init__(self):
@@ -10,6 +13,9 @@ class TFTHandler:
         name = data.get('name', 'None User')
         phone_number = data.get('phone_number', 'None')
         
+        if draw_tft is None:
+            print(f"Display: {name} / {phone_number}")
+            return
         # Call the draw_tft function from tft_display to update the display
         draw_tft(str(name), str(phone_number))
 
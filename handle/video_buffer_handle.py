@@ -0,0 +1,70 @@
+# Thesis/handle/video_buffer_handle.py
+import threading
+import time
+from collections import deque
+
+
+class EncodedFrameRing:
+    """
+    Pre-trigger video ring of encoded (JPEG) frames.
+    Bounded by bytes and by age instead of by frame count: a 640x480 JPEG is
+    around 30-60 KB against 921 KB for the raw BGR frame, so 20 s of video fits
+    in a few tens of MB. The oldest frames are dropped first when either limit
+    is reached.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_age=20.0):
+        """
+        Parameters:
+            max_bytes (int): Byte budget for the stored frames.
+            max_age (float): Seconds of video to keep before the newest frame.
+        """
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.frames = deque()  # (timestamp, jpeg bytes), oldest first
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.metrics = {'appended': 0, 'evicted_budget': 0, 'evicted_age': 0}
+
+    def append(self, jpeg, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            self.frames.append((timestamp, jpeg))
+            self.bytes += len(jpeg)
+            self.metrics['appended'] += 1
+            while self.frames and timestamp - self.frames[0][0] > self.max_age:
+                self.bytes -= len(self.frames.popleft()[1])
+                self.metrics['evicted_age'] += 1
+            while self.bytes > self.max_bytes and len(self.frames) > 1:
+                self.bytes -= len(self.frames.popleft()[1])
+                self.metrics['evicted_budget'] += 1
+
+    def snapshot(self):
+        """List of (timestamp, jpeg) currently held, oldest first. The bytes are shared, not copied."""
+        with self.lock:
+            return list(self.frames)
+
+    def latest(self):
+        with self.lock:
+            return self.frames[-1] if self.frames else None
+
+    def duration(self):
+        with self.lock:
+            return self.frames[-1][0] - self.frames[0][0] if len(self.frames) > 1 else 0.0
+
+    def stats(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics['frames'] = len(self.frames)
+            metrics['bytes'] = self.bytes
+            metrics['avg_frame_bytes'] = self.bytes / len(self.frames) if self.frames else None
+        metrics['duration'] = self.duration()
+        return metrics
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self.frames)
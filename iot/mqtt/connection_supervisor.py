@@ -0,0 +1,183 @@
+# Thesis/iot/mqtt/connection_supervisor.py
+import time
+import random
+import threading
+from collections import deque
+
+import paho.mqtt.client as paho
+
+
+class ConnectionSupervisor:
+	"""
+	Keeps the paho client connected to the broker.
+	The supervisor thread runs the paho network loop itself. While the broker is
+	unreachable it retries with jittered exponential backoff instead of giving up,
+	and listeners are told about every connect and disconnect so they can
+	re-subscribe or drain their backlog.
+
+	States: DISCONNECTED -> CONNECTING -> CONNECTED, and BACKOFF between failed attempts.
+	"""
+
+	DISCONNECTED = "DISCONNECTED"
+	CONNECTING = "CONNECTING"
+	CONNECTED = "CONNECTED"
+	BACKOFF = "BACKOFF"
+
+	def __init__(self, client, broker, port, keepalive=60, connection_handler=None,
+				 base_delay=1.0, max_delay=120.0, connect_timeout=15.0):
+		"""
+		Parameters:
+			client (paho.Client): Client to supervise. Its on_connect/on_disconnect must call
+				handle_connect/handle_disconnect.
+			connection_handler: Object with get_connection_status(), attempts wait while it reports offline.
+			base_delay, max_delay (float): Backoff bounds in seconds.
+			connect_timeout (float): Time allowed for the CONNACK after the socket connects.
+		"""
+		self.client = client
+		self.broker = broker
+		self.port = port
+		self.keepalive = keepalive
+		self.connection_handler = connection_handler
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.connect_timeout = connect_timeout
+
+		self.state = self.DISCONNECTED
+		self.state_lock = threading.Lock()
+		self.stop_event = threading.Event()
+		self.on_connected = []     # Callables run after every successful (re)connect
+		self.on_disconnected = []  # Callables run when an established connection drops
+
+		self.failures = 0  # Consecutive failed attempts, drives the backoff
+		self.attempt_started = None
+		self.disconnected_since = time.time()
+		self.ever_connected = False
+		self.metrics = {'attempts': 0, 'connects': 0, 'reconnects': 0, 'disconnects': 0}
+		self.reconnect_times = deque(maxlen=50)  # Seconds from losing the link to being back
+
+		self.thread = threading.Thread(target=self._run, daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def add_listener(self, on_connected=None, on_disconnected=None):
+		if on_connected:
+			self.on_connected.append(on_connected)
+		if on_disconnected:
+			self.on_disconnected.append(on_disconnected)
+
+	def is_connected(self):
+		return self.state == self.CONNECTED
+
+	def _set_state(self, state):
+		with self.state_lock:
+			previous, self.state = self.state, state
+		if previous != state:
+			print(f"MQTT connection: {previous} -> {state}")
+		return previous
+
+	def backoff_delay(self):
+		"""Capped exponential backoff, jittered to a random value between half and all of it."""
+		delay = min(self.max_delay, self.base_delay * (2 ** min(self.failures, 16)))
+		return random.uniform(delay / 2, delay)
+
+	def _run(self):
+		while not self.stop_event.is_set():
+			if self.state in (self.DISCONNECTED, self.BACKOFF):
+				self._attempt_connect()
+				continue
+
+			was_connecting = self.state == self.CONNECTING
+			rc = self.client.loop(timeout=1.0)
+			if self.stop_event.is_set():
+				break
+			if rc != paho.MQTT_ERR_SUCCESS:
+				if was_connecting:
+					self._fail_attempt()
+				else:
+					# Make sure a dropped socket is noticed even if on_disconnect did not run
+					self.handle_disconnect(self.client, None, rc)
+			elif self.state == self.CONNECTING and time.time() - self.attempt_started > self.connect_timeout:
+				print("MQTT connection: no CONNACK from broker")
+				self._fail_attempt()
+
+	def _attempt_connect(self):
+		if self.connection_handler is not None and not self.connection_handler.get_connection_status():
+			self.stop_event.wait(1)
+			return
+		self._set_state(self.CONNECTING)
+		self.metrics['attempts'] += 1
+		self.attempt_started = time.time()
+		try:
+			self.client.connect(self.broker, self.port, keepalive=self.keepalive)
+		except Exception as e:
+			print(f"Could not connect to MQTT Broker {self.broker}:{self.port}. Error: {e}")
+			self._fail_attempt()
+
+	def _fail_attempt(self):
+		self.failures += 1
+		try:
+			self.client.disconnect()
+		except Exception:
+			pass
+		self._set_state(self.BACKOFF)
+		delay = self.backoff_delay()
+		print(f"MQTT reconnect attempt {self.failures} failed, retrying in {delay:.1f}s")
+		self.stop_event.wait(delay)
+
+	def handle_connect(self, client, userdata, flags, rc):
+		"""To be called from the client's on_connect callback."""
+		if rc != 0:
+			print(f"Failed to connect, return code {rc}")
+			self._fail_attempt()
+			return
+		self._set_state(self.CONNECTED)
+		self.failures = 0
+		self.metrics['connects'] += 1
+		if self.ever_connected:
+			self.metrics['reconnects'] += 1
+			self.reconnect_times.append(time.time() - self.disconnected_since)
+		self.ever_connected = True
+		for callback in self.on_connected:
+			try:
+				callback()
+			except Exception as e:
+				print(f"Error in on_connected listener: {e}")
+
+	def handle_disconnect(self, client, userdata, rc):
+		"""To be called from the client's on_disconnect callback."""
+		if self.stop_event.is_set():
+			self._set_state(self.DISCONNECTED)
+			return
+		previous = self._set_state(self.DISCONNECTED)
+		if previous != self.CONNECTED:
+			return
+		self.metrics['disconnects'] += 1
+		self.disconnected_since = time.time()
+		print(f"Disconnected from MQTT Broker, code {rc}")
+		for callback in self.on_disconnected:
+			try:
+				callback()
+			except Exception as e:
+				print(f"Error in on_disconnected listener: {e}")
+
+	def stats(self):
+		"""Return state, attempt/reconnect counters and time-to-reconnect figures (s)."""
+		times = list(self.reconnect_times)
+		return dict(
+			self.metrics,
+			state=self.state,
+			last_time_to_reconnect=times[-1] if times else None,
+			avg_time_to_reconnect=sum(times) / len(times) if times else None,
+			max_time_to_reconnect=max(times) if times else None,
+		)
+
+	def stop(self, timeout=2):
+		self.stop_event.set()
+		try:
+			self.client.disconnect()
+		except Exception:
+			pass
+		if self.thread.is_alive():
+			self.thread.join(timeout=timeout)
+		self._set_state(self.DISCONNECTED)
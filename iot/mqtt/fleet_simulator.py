@@ -0,0 +1,149 @@
+# Thesis/iot/mqtt/fleet_simulator.py
+# Load generator: N simulated cars pushing telemetry to a broker to size the ThingsBoard deployment.
+# Example: python -m iot.mqtt.fleet_simulator --broker 127.0.0.1 --cars 50 --rate 2 --duration 60
+import argparse
+import heapq
+import random
+import time
+
+from iot.mqtt.publish import MQTTClient, PORT
+from sensors.GPS.gps_simulator import GPSSimulator
+
+START_LAT = 10.771835   # Ho Chi Minh City
+START_LON = 106.658297
+
+
+class SimulatedCar:
+	"""One vehicle: its own MQTT client, a GPSSimulator and synthetic IMU readings."""
+
+	def __init__(self, index, broker, port, token_prefix):
+		self.index = index
+		self.token = f"{token_prefix}{index}"
+		self.mqtt_client = MQTTClient(self.token, broker=broker, port=port,
+									  type_car="Simulated", license_plates=f"SIM-{index:05d}",
+									  client_id=f"fleet-sim-{index}")
+		# Spread the cars a few km around the start point
+		self.gps = GPSSimulator(START_LAT + random.uniform(-0.02, 0.02), START_LON + random.uniform(-0.02, 0.02))
+		self.gps.set_speed(random.uniform(20, 70))
+		self.gps.set_heading(random.uniform(0, 360))
+		self.gps.start()
+
+	def read_imu(self):
+		"""Road vibration around gravity, with an occasional hard brake."""
+		lax = random.gauss(0, 0.3)
+		if random.random() < 0.01:
+			lax -= random.uniform(3, 8)
+		ay = random.gauss(0, 0.3)
+		az = 9.81 + random.gauss(0, 0.2)
+		return lax, ay, az, lax
+
+	def publish_sample(self):
+		"""Queue one motion and one GPS payload, returns the number of messages."""
+		ax, ay, az, lax = self.read_imu()
+		speed = self.gps.speed + random.gauss(0, 1)
+		latitude, longitude = self.gps.get_current_location()
+		if random.random() < 0.05:
+			self.gps.set_heading(self.gps.heading + random.uniform(-45, 45))
+		self.mqtt_client.publish(self.mqtt_client.create_payload_motion_data(ax, ay, az, speed, "Normal", lax), "accelerometer")
+		self.mqtt_client.publish(self.mqtt_client.create_payload_gps(longitude, latitude), "gps")
+		return 2
+
+	def stop(self):
+		self.gps.stop()
+		self.mqtt_client.stop()
+
+
+def percentile(sorted_values, fraction):
+	if not sorted_values:
+		return None
+	return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def run_fleet(broker, port=PORT, cars=10, rate=1.0, duration=60, token_prefix="SIM_CAR_", report_every=10):
+	"""
+	Run the fleet and print a summary.
+	Parameters:
+		cars (int): Number of simulated vehicles.
+		rate (float): Samples per second per car (each sample is 2 messages).
+		duration (float): Test length in seconds.
+	Returns:
+		dict: Messages per second, latency percentiles (ms) and client CPU cost.
+	"""
+	fleet = [SimulatedCar(i, broker, port, token_prefix) for i in range(cars)]
+	# Let the clients finish connecting
+	deadline = time.time() + 10
+	while time.time() < deadline and not all(car.mqtt_client.is_connected() for car in fleet):
+		time.sleep(0.1)
+
+	interval = 1.0 / rate
+	start = time.time()
+	# Stagger cars across the first interval so they do not publish in lockstep
+	schedule = [(start + interval * i / cars, i) for i in range(cars)]
+	heapq.heapify(schedule)
+	produced = 0
+	cpu_start = time.process_time()
+	next_report = start + report_every
+
+	try:
+		while schedule:
+			due, i = heapq.heappop(schedule)
+			now = time.time()
+			if due - start >= duration:
+				break
+			if due > now:
+				time.sleep(due - now)
+			produced += fleet[i].publish_sample()
+			heapq.heappush(schedule, (due + interval, i))
+			if now >= next_report:
+				acked = sum(car.mqtt_client.pipeline.counters['acked'] for car in fleet)
+				print(f"[{now - start:5.1f}s] produced {produced}, acked {acked}")
+				next_report += report_every
+	except KeyboardInterrupt:
+		print("Fleet simulation interrupted")
+
+	time.sleep(2)  # Give the last PUBACKs time to arrive
+	elapsed = time.time() - start
+	cpu = time.process_time() - cpu_start
+
+	latencies = []
+	totals = {'submitted': 0, 'acked': 0, 'failed': 0}
+	for car in fleet:
+		stats = car.mqtt_client.pipeline.stats()
+		for key in totals:
+			totals[key] += stats[key]
+		with car.mqtt_client.pipeline.lock:
+			latencies.extend(car.mqtt_client.pipeline.latencies)
+		car.stop()
+	latencies.sort()
+
+	report = dict(
+		totals,
+		cars=cars,
+		seconds=elapsed,
+		messages_per_second=totals['acked'] / elapsed if elapsed else 0.0,
+		latency_p50_ms=percentile(latencies, 0.50),
+		latency_p95_ms=percentile(latencies, 0.95),
+		latency_p99_ms=percentile(latencies, 0.99),
+		cpu_seconds=cpu,
+		cpu_percent=100 * cpu / elapsed if elapsed else 0.0,
+		cpu_ms_per_message=1000 * cpu / totals['acked'] if totals['acked'] else None,
+	)
+	for key, value in report.items():
+		print(f"{key:>20}: {value:.3f}" if isinstance(value, float) else f"{key:>20}: {value}")
+	return report
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Simulate a fleet of cars publishing telemetry to an MQTT broker")
+	parser.add_argument("--broker", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=PORT)
+	parser.add_argument("--cars", type=int, default=10)
+	parser.add_argument("--rate", type=float, default=1.0, help="samples per second per car")
+	parser.add_argument("--duration", type=float, default=60, help="seconds")
+	parser.add_argument("--token-prefix", default="SIM_CAR_", help="device tokens are <prefix><index>")
+	args = parser.parse_args()
+	run_fleet(args.broker, args.port, args.cars, args.rate, args.duration, args.token_prefix)
+
+
+if __name__ == "__main__":
+	main()
@@ -3,9 +3,14 @@ import time
 import json
 import os
 import subprocess
+import queue
+import threading
 import paho.mqtt.client as paho
+from collections import deque
 from datetime import datetime
 
+from iot.mqtt.connection_supervisor import ConnectionSupervisor
+
 # Constants
 ACCESS_TOKENS = {
 	'CAR1': 'CAR1_TOKEN',  # Mercedes
@@ -13,6 +18,13 @@ ACCESS_TOKENS = {
 	'CAR3': 'CAR3_TOKEN',  # Tesla
 }
 
+# Vehicle identity per token: (car type, license plates)
+VEHICLES = {
+	ACCESS_TOKENS['CAR1']: ('Mercedes', "59Y1-66699"),
+	ACCESS_TOKENS['CAR2']: ('Toyota', "74D1-14515"),
+	ACCESS_TOKENS['CAR3']: ('Tesla', "60D-12345"),
+}
+
 BROKER = '192.168.1.12'
 PORT = 1883
 INTERVAL = 3
@@ -37,54 +49,256 @@ INTERVAL = 3
 # PORT = 443  # Serveo supports SSL
 # INTERVAL = 3
 
-class MQTTClient:
-	_instance = None  # Singleton instance
-
-	def __new__(cls, token, connection_handler):
-		if cls._instance is None:
-			cls._instance = super(MQTTClient, cls).__new__(cls)
-			cls._instance.client = paho.Client()
-			cls._instance.connection_handler = connection_handler  # Store connection handler
-			cls._instance.init_client(token)
-		return cls._instance
+TELEMETRY_TOPIC = "v1/devices/me/telemetry"
+
+class PublishPipeline:
+	"""
+	Single writer that owns every publish on the paho client.
+	Producers hand messages over with submit(), which never blocks. QoS1 messages
+	stay in a bounded inflight window until their PUBACK arrives through
+	handle_publish(). Acknowledged messages are passed to on_success.
+
+	Once paho has accepted a QoS1 message, paho owns its retries: it keeps the
+	message while the link is down and resends it on reconnect, so such a message
+	is never handed back as well, which would deliver it twice. A message without
+	a PUBACK after ack_timeout is reported as stale and gives its window slot back,
+	a late PUBACK still completes it. Messages paho refused are passed to
+	on_failure so they can go back to the durable buffer.
+
+	client.publish() is called without holding self.lock: paho takes its own
+	message mutex there, and its network thread holds that mutex while calling
+	on_publish -> handle_publish(), which needs self.lock.
+	"""
+
+	def __init__(self, client, max_queue=1000, max_inflight=20, qos=1, ack_timeout=30, on_failure=None,
+				 on_success=None):
+		self.client = client
+		self.qos = qos
+		self.ack_timeout = ack_timeout
+		self.on_failure = on_failure  # Called with the message dict of every undelivered message
+		self.on_success = on_success  # Called with the message dict of every acknowledged message
+		self.queue = queue.Queue(maxsize=max_queue)
+		self.inflight = {}  # mid -> message
+		self.expired = {}  # mid -> message past ack_timeout, paho still resends it, no window slot
+		self.early_acks = {}  # mid -> time of a PUBACK that arrived before publish() returned
+		self.inflight_slots = threading.Semaphore(max_inflight)
+		self.lock = threading.RLock()
+		self.latencies = deque(maxlen=500)  # Submit to PUBACK, in seconds
+		self.ack_times = deque(maxlen=500)
+		self.counters = {'submitted': 0, 'acked': 0, 'failed': 0, 'stale': 0}
+		self.running = True
+		self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+		self.writer_thread.start()
+
+	def submit(self, payload, sensor_type, topic=TELEMETRY_TOPIC, ts=None, entries=None):
+		"""
+		Queue a message for publishing without blocking.
+		Parameters:
+			payload (str): JSON payload.
+			sensor_type (str): Source of the data, used when the message is re-buffered.
+			ts (int): Capture time in epoch ms, defaults to now.
+			entries (list): Buffered entries carried by a backlog batch, acknowledged or handed back with it.
+		Returns:
+			bool: False if the queue was full and the message went to on_failure instead.
+		"""
+		message = {
+			'topic': topic,
+			'payload': payload,
+			'sensor_type': sensor_type,
+			'ts': ts if ts is not None else int(time.time() * 1000),
+			'entries': entries,
+			'submitted': time.time()
+		}
+		with self.lock:
+			self.counters['submitted'] += 1
+		try:
+			self.queue.put_nowait(message)
+			return True
+		except queue.Full:
+			print(f"Publish queue full, {sensor_type} message handed back")
+			self._fail(message)
+			return False
+
+	def _writer_loop(self):
+		while self.running:
+			self._expire_inflight()
+			try:
+				message = self.queue.get(timeout=0.5)
+			except queue.Empty:
+				continue
+
+			# Wait for room in the inflight window, still expiring lost acks meanwhile
+			while not self.inflight_slots.acquire(timeout=0.5):
+				self._expire_inflight()
+				if not self.running:
+					self._fail(message)
+					return
+
+			try:
+				ret = self.client.publish(message['topic'], message['payload'], qos=self.qos)
+				rc = ret.rc
+			except Exception as e:
+				print(f"Error publishing {message['sensor_type']} data: {e}")
+				rc = None
+			if rc == paho.MQTT_ERR_SUCCESS or (rc == paho.MQTT_ERR_NO_CONN and self.qos > 0):
+				# Without a link paho still keeps a QoS1 message and sends it on reconnect
+				message['sent'] = time.time()
+				if self.qos == 0:
+					self._complete(message)
+					continue
+				with self.lock:
+					acked = self.early_acks.pop(ret.mid, None) is not None
+					if not acked:
+						self.inflight[ret.mid] = message
+				if acked:
+					self._complete(message)
+				continue
+			self.inflight_slots.release()
+			print(f"Failed to publish {message['sensor_type']} data. Error code: {rc}")
+			self._fail(message)
+
+	def handle_publish(self, mid):
+		"""Complete the inflight message acknowledged by the broker."""
+		if self.qos == 0:
+			return  # Completed as soon as publish() returned
+		holds_slot = True
+		with self.lock:
+			message = self.inflight.pop(mid, None)
+			if message is None:
+				message = self.expired.pop(mid, None)
+				holds_slot = False
+			if message is None:
+				# The writer has not registered this mid yet, it completes the message itself
+				self.early_acks[mid] = time.time()
+				return
+		self._complete(message, holds_slot)
+
+	def _complete(self, message, holds_slot=True):
+		now = time.time()
+		with self.lock:
+			self.counters['acked'] += 1
+			self.latencies.append(now - message['submitted'])
+			self.ack_times.append(now)
+		if holds_slot:
+			self.inflight_slots.release()
+		if self.on_success:
+			try:
+				self.on_success(message)
+			except Exception as e:
+				print(f"Error handling delivered message: {e}")
+
+	def _expire_inflight(self):
+		"""
+		Free the window slot of messages still waiting for a PUBACK after ack_timeout,
+		so a long outage cannot fill the window. paho keeps retrying them.
+		"""
+		now = time.time()
+		with self.lock:
+			stale = [mid for mid, message in self.inflight.items() if now - message['sent'] > self.ack_timeout]
+			for mid in stale:
+				self.expired[mid] = self.inflight.pop(mid)
+				self.counters['stale'] += 1
+			stale = [self.expired[mid]['sensor_type'] for mid in stale]
+			# A PUBACK for a mid that was never registered (publish() raised) is forgotten
+			for mid in [mid for mid, acked_at in self.early_acks.items() if now - acked_at > self.ack_timeout]:
+				del self.early_acks[mid]
+		for sensor_type in stale:
+			self.inflight_slots.release()
+			print(f"No PUBACK for {sensor_type} data within {self.ack_timeout}s, left to paho to resend")
+
+	def _fail(self, message):
+		with self.lock:
+			self.counters['failed'] += 1
+		if self.on_failure:
+			try:
+				self.on_failure(message)
+			except Exception as e:
+				print(f"Error handing back failed message: {e}")
+
+	def stats(self):
+		"""Return counters, queue depth, inflight size, throughput (msg/s) and latency percentiles (ms)."""
+		with self.lock:
+			latencies = sorted(self.latencies)
+			ack_times = list(self.ack_times)
+			stats = dict(self.counters, queued=self.queue.qsize(), inflight=len(self.inflight),
+						 expired=len(self.expired))
+		if len(ack_times) > 1 and ack_times[-1] > ack_times[0]:
+			stats['throughput'] = (len(ack_times) - 1) / (ack_times[-1] - ack_times[0])
+		else:
+			stats['throughput'] = 0.0
+		for name, fraction in (('latency_p50_ms', 0.5), ('latency_p95_ms', 0.95), ('latency_p99_ms', 0.99)):
+			stats[name] = latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000 if latencies else None
+		return stats
+
+	def stop(self, timeout=1):
+		self.running = False
+		self.writer_thread.join(timeout=timeout)
+		# Anything still waiting goes back to the buffer
+		while not self.queue.empty():
+			self._fail(self.queue.get_nowait())
+		# Unacknowledged messages die with paho's session, so the buffer takes them back
+		with self.lock:
+			messages = list(self.inflight.values()) + list(self.expired.values())
+			self.inflight.clear()
+			self.expired.clear()
+		for message in messages:
+			self._fail(message)
 
-	def init_client(self, token):
+class MQTTClient:
+	def __init__(self, token, connection_handler=None, broker=BROKER, port=PORT,
+				 type_car=None, license_plates=None, client_id=""):
+		"""
+		Parameters:
+			token (str): ThingsBoard device access token.
+			connection_handler: Module or object with get_connection_status(), None to always try to connect.
+			broker (str), port (int): MQTT broker address.
+			type_car (str), license_plates (str): Vehicle identity, looked up in VEHICLES by token if not given.
+			client_id (str): MQTT client id, empty lets paho generate a unique one.
+		"""
+		self.client = paho.Client(client_id=client_id)
+		self.connection_handler = connection_handler  # Store connection handler
+		self.broker = broker
+		self.port = port
+		self.pipeline = PublishPipeline(self.client)  # Only writer of the paho client
+		self.init_client(token, type_car, license_plates)
+
+	def init_client(self, token, type_car=None, license_plates=None):
 		self.client.on_message = self.on_message
 		self.client.on_publish = self.on_publish
 		self.client.on_connect = self.on_connect
-		# self.client.on_disconnect = self.on_disconnect  # Add on_disconnect callback
+		self.client.on_disconnect = self.on_disconnect
 		self.client.username_pw_set(token)
 
 		# Set car type and license plates based on the token
-		if token == ACCESS_TOKENS['CAR1']:
-			self.type_car = 'Mercedes'
-			self.license_plates = "59Y1-66699"
-		elif token == ACCESS_TOKENS['CAR2']:
-			self.type_car = 'Toyota'
-			self.license_plates = "74D1-14515"
-		elif token == ACCESS_TOKENS['CAR3']:
-			self.type_car = 'Tesla'
-			self.license_plates = "60D-12345"
+		known_type, known_plates = VEHICLES.get(token, (None, None))
+		self.type_car = type_car or known_type
+		self.license_plates = license_plates or known_plates
 
-		try:
-			if self.connection_handler.get_connection_status():
-				self.client.connect(BROKER, PORT, keepalive=60)
-				self.client.loop_start()
-			else:
-				print("No internet connection. Cannot connect to MQTT Broker.")
-		except Exception as e:
-			print(f"Could not connect to MQTT Broker. Error: {e}. Check your ThingsBoard IP.")
-			exit()
-
-	def on_publish(self, client, userdata, result):
-		print("Data published to ThingsBoard")
+		# Connects in the background and keeps retrying with backoff, never exits the process
+		self.supervisor = ConnectionSupervisor(self.client, self.broker, self.port, keepalive=60,
+											   connection_handler=self.connection_handler)
+		self.supervisor.start()
+
+	def is_connected(self):
+		return self.supervisor.is_connected()
+
+	def stop(self):
+		"""Stop publishing and disconnect from the broker."""
+		self.pipeline.stop()
+		self.supervisor.stop()
+
+	def on_publish(self, client, userdata, mid):
+		self.pipeline.handle_publish(mid)
 
 	def on_connect(self, client, userdata, flags, rc):
 		if rc == 0:
 			print("Connected to MQTT Broker!")
+			# Subscriptions do not survive a reconnect with a clean session
 			client.subscribe('v1/devices/me/rpc/response/+')
-		else:
-			print(f"Failed to connect, return code {rc}\n")
+		self.supervisor.handle_connect(client, userdata, flags, rc)
+
+	def on_disconnect(self, client, userdata, rc):
+		self.supervisor.handle_disconnect(client, userdata, rc)
 
 	def on_message(self, client, userdata, msg):
 		print("Received response from ThingsBoard")
@@ -107,13 +321,9 @@ class MQTTClient:
 		}
 		return json.dumps(payload)
 
-	def publish(self, payload):
-		ret = self.client.publish("v1/devices/me/telemetry", payload)
-		if ret.rc == paho.MQTT_ERR_SUCCESS:
-			print("Publish success")
-		else:
-			print(f"Publish failed with error code: {ret.rc}")
-		return ret  # Ensure to return the result
+	def publish(self, payload, sensor_type="telemetry"):
+		"""Queue a telemetry payload on the publish pipeline, returns False if it could not be queued."""
+		return self.pipeline.submit(payload, sensor_type)
 
 	def send_data(self):
 		user = self.get_rfid_user()
@@ -134,8 +344,7 @@ class MQTTClient:
 
 		except KeyboardInterrupt:
 			print("Disconnecting from MQTT Broker...")
-			self.client.disconnect()
-			self.client.loop_stop()
+			self.stop()
 			print("Disconnected")
 
 	def get_rfid_user(self):
@@ -176,6 +385,13 @@ class MQTTClient:
 			'Status': status
 		})
 
+	def create_payload_telemetry_batch(self, samples):
+		"""Build a ThingsBoard timeseries array from (ts in epoch ms, JSON payload) pairs, oldest first."""
+		return json.dumps([
+			{'ts': ts, 'values': json.loads(data)}
+			for ts, data in sorted(samples, key=lambda sample: sample[0])
+		])
+
 	def create_payload_user_info(self, user):
 		return json.dumps({
 			'Name': user['name'],
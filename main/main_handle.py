@@ -9,22 +9,29 @@ from handle.record_handle import RecordHandler
 from sensors.MQ3_ADS1115.MQ3_ADS115 import MQ3Sensor
 from iot.mqtt.publish import MQTTClient
 import handle.connection_internet_handle as conn_handle 
+from sensors.backend import get_backend
 
 def main():
+    # The video writer process is forked, so start it before any other thread exists
+    record_handler = RecordHandler()
+
+    # BLACKBOX_SENSOR_MODE=record|replay switches every sensor to the log backend
+    sensor_backend = get_backend()
+    print(f"Sensor backend: {sensor_backend.mode}")
+
     connection_monitor_thread = threading.Thread(target=conn_handle.monitor_connection, daemon=True)
     connection_monitor_thread.start()
-    
-    # Wait for the connection to stabilize
-    while not conn_handle.get_connection_status():
-        print("Waiting for internet connection...")
-        time.sleep(1)
-        
+
+    # No waiting for the network: everything starts offline, data is buffered and
+    # the connection supervisor connects in the background with backoff
     # Initialize sensor, MQTT, RFID, and TFT handlers
     # mqtt_client = MQTTClient('CAR2_TOKEN')  # Initialize MQTT client with token
     mqtt_client = MQTTClient('CAR2_TOKEN', conn_handle)  # Initialize MQTT client with token and connection handler
+    # Broker connect/disconnect events update the connectivity monitor right away
+    mqtt_client.supervisor.add_listener(on_connected=conn_handle.report_broker_connected,
+                                        on_disconnected=conn_handle.report_broker_disconnected)
     sensor_handler = SensorHandler(mqtt_client, conn_handle)  # Initialize sensor handler
     rfid_handler = RFIDHandler(mqtt_client)  # Initialize RFID handler
-    record_handler = RecordHandler()
     video_streamer = initialize_camera(mqtt_client, record_handler, sensor_handler)
     motion_state_handler = MotionStateHandler(sensor_handler)
     mq3_sensor = MQ3Sensor(adc_channel=0, gain=1, vcc=5.0)
@@ -65,11 +72,12 @@ def main():
     except KeyboardInterrupt:
         # Handle manual shutdown (Ctrl+C)
         print("Shutting down...")
-        mqtt_client.client.disconnect()  # Disconnect MQTT client
+        mqtt_client.stop()  # Stop publishing and disconnect MQTT client
         sensor_handler.running = False
         sensor_handler.cleanup()  # Clean up sensor resources
         rfid_handler.stop_reading()  # Stop RFID reading thread
         video_streamer.stop()
+        record_handler.close()  # Finalise any clip and stop the writer process
         mq3_sensor.stop_reading()
         
         # Clean up resources for each handler
@@ -80,6 +88,7 @@ def main():
         video_thread.join() # Ensure video thread completes
         acc_thread.join()
         mq3_thread.join()
+        sensor_backend.close()  # Flush the recorded sensor log
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -6,6 +6,16 @@ import numpy as np
 import sys
 import math
 import threading
+import json
+import os
+from collections import namedtuple
+
+from sensors.BNO055.imu_buffer import IMURingBuffer
+from sensors.backend import get_backend
+
+# One coherent reading of every output vector, taken in a single bus transaction
+IMUSample = namedtuple('IMUSample', ['timestamp', 'accel', 'mag', 'gyro', 'euler',
+                                     'quaternion', 'linear_accel', 'gravity'])
 
 class BNO055Sensor:
     BNO055_ADDRESS = 0x29
@@ -13,22 +23,60 @@ class BNO055Sensor:
     BNO055_PWR_MODE = 0x3E
     BNO055_SYS_TRIGGER = 0x3F
     BNO055_TEMP = 0x34
+    BNO055_CALIB_STAT = 0x35
+
+    # Calibration profile: accel/mag/gyro offsets and accel/mag radius, 0x55-0x6A
+    BNO055_CALIB_DATA_START = 0x55
+    BNO055_CALIB_DATA_LENGTH = 22
+    CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibration.json')
+    CALIBRATION_CHECK_PERIOD = 1.0  # Seconds between calibration status reads
 
     # Acceleration and Linear Acceleration register addresses
     BNO055_ACCEL_DATA_X_LSB = 0x08
     BNO055_LINEAR_ACCEL_DATA_X_LSB = 0x28
+
+    # Contiguous data block from ACC_DATA_X_LSB (0x08) to GRV_DATA_Z_MSB (0x33)
+    BNO055_DATA_BLOCK_START = 0x08
+    BNO055_DATA_BLOCK_LENGTH = 0x34 - 0x08
+    # LSB scale of the 22 int16 words in the block (m/s², uT, dps, degrees, unit quaternion)
+    DATA_BLOCK_SCALES = np.array(
+        [1 / 100.0] * 3 +        # accel
+        [1 / 16.0] * 3 +         # mag
+        [1 / 16.0] * 3 +         # gyro
+        [1 / 16.0] * 3 +         # euler: heading, roll, pitch
+        [1 / (1 << 14)] * 4 +    # quaternion: w, x, y, z
+        [1 / 100.0] * 3 +        # linear accel
+        [1 / 100.0] * 3          # gravity
+    )
     
     OPR_MODE_CONFIG = 0x00
     OPR_MODE_NDOF = 0x0C
 
-    def __init__(self, bus_num=1):
-        self.bus = smbus2.SMBus(bus_num)
+    def __init__(self, bus_num=1, calibration_file=CALIBRATION_FILE):
+        self.backend = get_backend()
+        # When replaying a recorded log there is no I2C bus to open
+        self.bus = None if self.backend.replaying else smbus2.SMBus(bus_num)
+        self.read_data_block = self.backend.source('imu', self.read_data_block)
         self.accel_data = [0, 0, 0]
         self.linear_accel_data = [0, 0, 0]
+        self.latest_sample = None
+        # Full-rate history for detectors and filters, 60 s at 100 Hz
+        self.sample_period = 0.01
+        self.ring = IMURingBuffer(seconds=60, rate_hz=100)
         self.lock = threading.Lock()
         self.running = True  # Add a running attribute to control threads
 
-        self.initialize_sensor()
+        # Calibration: restored profile, status and time until the fusion output is trusted
+        self.calibration_file = calibration_file
+        self.calibration_restored = False
+        self.calibration_saved = False
+        self.calibration_status = (0, 0, 0, 0)
+        self.time_to_trusted = None
+        self.last_calibration_check = 0
+        self.start_time = time.time()
+
+        if not self.backend.replaying:
+            self.initialize_sensor()
 
     def write_byte_data(self, reg, value):
         self.bus.write_byte_data(self.BNO055_ADDRESS, reg, value)
@@ -42,8 +90,93 @@ class BNO055Sensor:
     def initialize_sensor(self):
         self.write_byte_data(self.BNO055_OPR_MODE, self.OPR_MODE_CONFIG)
         time.sleep(0.03)
+        # Offsets can only be written in config mode, before fusion starts
+        self.calibration_restored = self.restore_calibration()
+        self.write_byte_data(self.BNO055_OPR_MODE, self.OPR_MODE_NDOF)
+        time.sleep(0.03)
+        self.start_time = time.time()
+
+    def get_calibration_status(self):
+        """Return (sys, gyro, accel, mag) calibration levels, 3 = fully calibrated."""
+        cal_status = self.read_byte_data(self.BNO055_CALIB_STAT)
+        return (cal_status >> 6) & 0x03, (cal_status >> 4) & 0x03, (cal_status >> 2) & 0x03, cal_status & 0x03
+
+    def get_calibration(self):
+        """Read the 22-byte calibration profile. Briefly pauses fusion (config mode)."""
+        self.write_byte_data(self.BNO055_OPR_MODE, self.OPR_MODE_CONFIG)
+        time.sleep(0.03)
+        data = self.read_i2c_block_data(self.BNO055_CALIB_DATA_START, self.BNO055_CALIB_DATA_LENGTH)
         self.write_byte_data(self.BNO055_OPR_MODE, self.OPR_MODE_NDOF)
         time.sleep(0.03)
+        return list(data)
+
+    def set_calibration(self, data):
+        """Write a 22-byte calibration profile. The sensor must be in config mode."""
+        if data is None or len(data) != self.BNO055_CALIB_DATA_LENGTH:
+            raise ValueError('Expected a list of 22 bytes for calibration data.')
+        self.bus.write_i2c_block_data(self.BNO055_ADDRESS, self.BNO055_CALIB_DATA_START, list(data))
+
+    def restore_calibration(self):
+        """Load the saved profile into the sensor. Returns True if one was applied."""
+        try:
+            with open(self.calibration_file, 'r') as f:
+                profile = json.load(f)
+            self.set_calibration(profile['offsets'])
+            print(f"BNO055 calibration restored from {self.calibration_file}")
+            return True
+        except FileNotFoundError:
+            print("No saved BNO055 calibration, calibrating from scratch")
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Error restoring BNO055 calibration: {e}")
+        return False
+
+    def save_calibration(self):
+        """Read the current profile from the sensor and store it for the next boot."""
+        profile = {'offsets': self.get_calibration(), 'saved_at': time.time()}
+        tmp_file = self.calibration_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(profile, f)
+        os.replace(tmp_file, self.calibration_file)
+        print(f"BNO055 calibration saved to {self.calibration_file}")
+
+    def check_calibration(self):
+        """
+        Sampler thread only. Track the calibration status, note when readings become
+        trusted and save the profile the first time the sensor is fully calibrated.
+        Linear acceleration only depends on the accelerometer and gyroscope, so those
+        alone decide trust: the magnetometer rarely reaches 3 inside a car.
+        """
+        now = time.time()
+        if self.backend.replaying or now - self.last_calibration_check < self.CALIBRATION_CHECK_PERIOD:
+            return
+        self.last_calibration_check = now
+        self.calibration_status = self.get_calibration_status()
+        _, gyro, accel, _ = self.calibration_status
+        if gyro < 3 or accel < 3:
+            return
+        if self.time_to_trusted is None:
+            self.time_to_trusted = now - self.start_time
+            source = "restored profile" if self.calibration_restored else "cold start"
+            print(f"BNO055 accel and gyro calibrated after {self.time_to_trusted:.1f}s ({source})")
+        # The saved profile holds magnetometer offsets too, wait for a full calibration
+        if not self.calibration_saved and min(self.calibration_status) >= 3:
+            self.calibration_saved = True  # Once per boot, reading the profile pauses fusion
+            try:
+                self.save_calibration()
+            except OSError as e:
+                print(f"Error saving BNO055 calibration: {e}")
+
+    def is_trusted(self):
+        """True once the accelerometer and gyroscope behind linear acceleration are calibrated."""
+        return self.backend.replaying or self.time_to_trusted is not None
+
+    def calibration_stats(self):
+        return {
+            'status': self.calibration_status,
+            'restored': self.calibration_restored,
+            'saved': self.calibration_saved,
+            'time_to_trusted': self.time_to_trusted,
+        }
 
     def read_accelerometer_data(self):
         accel_data = self.read_i2c_block_data(self.BNO055_ACCEL_DATA_X_LSB, 6)
@@ -71,6 +204,58 @@ class BNO055Sensor:
 
         return linear_accel_x / 100, linear_accel_y / 100, linear_accel_z / 100
 
+    def read_data_block(self):
+        """Read accel through gravity (0x08-0x33) in one combined I2C transaction."""
+        write = smbus2.i2c_msg.write(self.BNO055_ADDRESS, [self.BNO055_DATA_BLOCK_START])
+        read = smbus2.i2c_msg.read(self.BNO055_ADDRESS, self.BNO055_DATA_BLOCK_LENGTH)
+        self.bus.i2c_rdwr(write, read)
+        return bytes(read)
+
+    def decode_data_block(self, raw, timestamp):
+        """Unpack the 44-byte block as little-endian int16 and scale every channel at once."""
+        return self.sample_from_values(np.frombuffer(raw, dtype='<i2') * self.DATA_BLOCK_SCALES, timestamp)
+
+    def sample_from_values(self, values, timestamp):
+        """Split a 22-value row (imu_buffer.CHANNELS layout) into an IMUSample."""
+        return IMUSample(
+            timestamp=timestamp,
+            accel=values[0:3],
+            mag=values[3:6],
+            gyro=values[6:9],
+            euler=values[9:12],
+            quaternion=values[12:16],
+            linear_accel=values[16:19],
+            gravity=values[19:22],
+        )
+
+    def read_sample(self):
+        """Read and decode one data block, None when a replayed log has no IMU readings."""
+        timestamp = time.time()
+        raw = self.read_data_block()
+        return self.decode_data_block(raw, timestamp) if raw is not None else None
+
+    def read_sensor_thread(self):
+        """Single sampler: one burst read per period replaces the accel and linear accel threads."""
+        while self.running:
+            try:
+                sample = self.read_sample()
+                if sample is None:
+                    time.sleep(self.sample_period)
+                    continue
+                self.ring.append(sample.timestamp, np.concatenate(sample[1:]))
+                with self.lock:
+                    self.latest_sample = sample
+                    self.accel_data = sample.accel.tolist()
+                    self.linear_accel_data = sample.linear_accel.tolist()
+                self.check_calibration()
+            except OSError as e:
+                print(f"BNO055 read error: {e}")
+            time.sleep(self.sample_period)
+
+    def get_latest_sample(self):
+        with self.lock:
+            return self.latest_sample
+
     def read_accelerometer_thread(self):
         while self.running:
             accel_x, accel_y, accel_z = self.read_accelerometer_data()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Thesis/sensors/BNO055/imu_buffer.py
+import numpy as np
+
+# Column layout of a sample row, same order as the BNO055 data block
+CHANNELS = {
+    'accel': slice(0, 3),
+    'mag': slice(3, 6),
+    'gyro': slice(6, 9),
+    'euler': slice(9, 12),
+    'quaternion': slice(12, 16),
+    'linear_accel': slice(16, 19),
+    'gravity': slice(19, 22),
+}
+NUM_CHANNELS = 22
+
+
+class IMURingBuffer:
+    """
+    Preallocated ring of timestamped IMU samples for one writer and many readers.
+
+    Every sample is written twice, at i and i + capacity, so the last `capacity`
+    samples always sit in one contiguous block. Window queries therefore return
+    NumPy views without copying. The writer publishes a sample by bumping `count`
+    after the row is written, so readers need no lock. A view stays valid until
+    the writer laps it (capacity / rate seconds); readers that keep data longer
+    than that must copy it.
+    """
+
+    def __init__(self, seconds=60, rate_hz=100, channels=NUM_CHANNELS):
+        self.capacity = int(seconds * rate_hz)
+        self.timestamps = np.zeros(2 * self.capacity, dtype=np.float64)
+        self.data = np.zeros((2 * self.capacity, channels), dtype=np.float32)
+        self.count = 0  # Total samples ever written, also the sequence number of the next one
+
+    def append(self, timestamp, values):
+        """Writer only. Store one sample row."""
+        i = self.count % self.capacity
+        self.timestamps[i] = self.timestamps[i + self.capacity] = timestamp
+        self.data[i] = self.data[i + self.capacity] = values
+        self.count += 1
+
+    def _span(self, first_seq, end_seq):
+        """Contiguous slice of the mirrored arrays holding sequences [first_seq, end_seq)."""
+        # The oldest row is the next one the writer overwrites, so it is never handed out
+        first_seq = max(first_seq, end_seq - self.capacity + 1, 0)
+        if first_seq >= end_seq:
+            return slice(0, 0)
+        # Start in the first copy so the block never runs past the end of the second one
+        start = first_seq % self.capacity
+        return slice(start, start + (end_seq - first_seq))
+
+    def latest(self, n):
+        """Views (timestamps, data) of the newest n samples, oldest first."""
+        end_seq = self.count
+        span = self._span(end_seq - n, end_seq)
+        return self.timestamps[span], self.data[span]
+
+    def since(self, seq):
+        """
+        Views of every sample written from sequence number `seq` on, plus the
+        sequence number to pass next time. Samples already overwritten are skipped.
+        """
+        end_seq = self.count
+        span = self._span(seq, end_seq)
+        return self.timestamps[span], self.data[span], end_seq
+
+    def window(self, start_time, end_time=None):
+        """Views of the samples with start_time <= timestamp < end_time (end defaults to now)."""
+        timestamps, data = self.latest(self.capacity)
+        lo = np.searchsorted(timestamps, start_time, side='left')
+        hi = len(timestamps) if end_time is None else np.searchsorted(timestamps, end_time, side='left')
+        return timestamps[lo:hi], data[lo:hi]
+
+    def channel(self, data, name):
+        """Column view of one vector (e.g. 'linear_accel') from a data view."""
+        return data[:, CHANNELS[name]]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Thesis/sensors/BNO055/kalman_benchmark.py
+# Compares the old per-value KalmanFilterN loop with KalmanFilterBank.
+#
+#   python -m sensors.BNO055.kalman_benchmark --samples 60000 --channels 6
+#   python -m sensors.BNO055.kalman_benchmark --log sensor_log.bbl   # recorded IMU data
+import time
+import argparse
+import numpy as np
+
+from sensors.kalman import KalmanFilterBank
+
+
+class ScalarKalmanFilter:
+    """The former KalmanFilter1..6, one instance per channel."""
+
+    def __init__(self, process_variance, measurement_variance):
+        self.process_variance = process_variance
+        self.measurement_variance = measurement_variance
+        self.estimated_measurement = 0
+        self.error_covariance = 1
+        self.kalman_gain = 1
+
+    def update(self, measurement):
+        self.error_covariance = self.error_covariance + self.process_variance
+        self.kalman_gain = self.error_covariance / (self.error_covariance + self.measurement_variance)
+        self.estimated_measurement += self.kalman_gain * (measurement - self.estimated_measurement)
+        self.error_covariance = (1 - self.kalman_gain) * self.error_covariance
+        return self.estimated_measurement
+
+
+def load_recorded_imu(path):
+    """Accel, gyro (and the rest of the data block) rows from a recorded sensor log."""
+    from sensors.backend import SensorLogReader
+    reader = SensorLogReader(path)
+    try:
+        raw = b''.join(reader.payload('imu', i) for i in range(len(reader.index['imu'])))
+    finally:
+        reader.close()
+    from sensors.BNO055.BNO055_lib import BNO055Sensor
+    return np.frombuffer(raw, dtype='<i2').reshape(-1, 22) * BNO055Sensor.DATA_BLOCK_SCALES
+
+
+def timed(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run(data, process_variance=1e-5, measurement_variance=1e-2, repeat=3):
+    samples, channels = data.shape
+
+    def scalar_loop():
+        filters = [ScalarKalmanFilter(process_variance, measurement_variance) for _ in range(channels)]
+        return np.array([[f.update(value) for f, value in zip(filters, row)] for row in data.tolist()])
+
+    def bank_per_sample():
+        bank = KalmanFilterBank(channels, process_variance, measurement_variance)
+        return np.array([bank.update(row) for row in data.tolist()])  # Drivers pass plain floats
+
+    def bank_batch():
+        return KalmanFilterBank(channels, process_variance, measurement_variance).filter(data)
+
+    reference_time, reference = timed(scalar_loop, repeat)
+    print(f"{samples} samples x {channels} channels")
+    print(f"  {'per-value scalar filters':28s} {reference_time * 1000:9.1f} ms   {samples / reference_time:12.0f} samples/s")
+    for name, func in [('bank, one update per sample', bank_per_sample), ('bank, whole array', bank_batch)]:
+        elapsed, result = timed(func, repeat)
+        error = np.abs(result - reference).max()
+        print(f"  {name:28s} {elapsed * 1000:9.1f} ms   {samples / elapsed:12.0f} samples/s"
+              f"   x{reference_time / elapsed:6.1f}   max diff {error:.1e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Kalman filter bank against per-value filters")
+    parser.add_argument('--samples', type=int, default=60000, help="Synthetic samples (10 min at 100 Hz)")
+    parser.add_argument('--channels', type=int, default=6)
+    parser.add_argument('--log', help="Use the IMU data of a recorded sensor log instead")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.log:
+        data = load_recorded_imu(args.log)
+    else:
+        rng = np.random.default_rng(0)
+        data = np.cumsum(rng.normal(0, 0.05, (args.samples, args.channels)), axis=0) + rng.normal(0, 0.3, (args.samples, args.channels))
+    run(data, repeat=args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,9 +7,18 @@ import threading
 import math
 import os
 import subprocess
+from collections import namedtuple
 from geopy.geocoders import Nominatim
 from unidecode import unidecode
 
+from sensors.backend import get_backend
+from sensors.GPS.nmea_parser import NMEAParser, RMC, GGA, VTG, GSA
+
+# One fix per RMC sentence: position in degrees, ground speed in m/s, course in degrees,
+# plus HDOP and satellites in use from the latest GGA/GSA (None if not reported)
+GPSFix = namedtuple('GPSFix', ['timestamp', 'latitude', 'longitude', 'speed', 'course', 'hdop', 'satellites'],
+                    defaults=(None, None))
+
 class GPSModule:
     def __init__(self, gps_port="/dev/ttyUSB1", setup_port="/dev/ttyUSB2", baudrate=115200):
         """
@@ -30,15 +39,21 @@ class GPSModule:
         self.prev_longitude = None
         self.velocity = None  # Store current velocity in m/s
         self._stop_event = threading.Event()
-        self.buffer = ""  # Buffer to store data read from serial
-        self.buffer_lock = threading.Lock()  # Lock to manage buffer access
+        self.parser = NMEAParser()  # Raw serial bytes -> typed sentences
         self._gps_read_thread = threading.Thread(target=self._read_from_serial)
-        self._gps_process_thread = threading.Thread(target=self._process_gps_data)
         self.coordinates_buffer = []  # Buffer to store coordinates with timestamp
         self.velocity = 0.0 
         self.coordinates_lock = threading.Lock()  # Lock for coordinates buffer
         self.avg_velocity = None  # Average velocity
-        self._velocity_thread = threading.Thread(target=self._calculate_velocity)
+        self.fix = None  # Latest GPSFix, replaced as a whole so readers need no lock
+        self.fix_count = 0  # Fixes received so far, lets waiters tell a new fix from the last one
+        self.fix_condition = threading.Condition()
+        self.subscribers = []  # Callables run with each new fix, on the reader thread
+        self.hdop = None
+        self.satellites = None
+        self.fix_quality = None  # GGA fix quality, 0 = no fix
+        self.fix_type = None  # GSA fix type, 1 = none, 2 = 2D, 3 = 3D
+        self.backend = get_backend()
         
     def kill_process_using_tty(self, tty_device):
         """
@@ -116,21 +131,7 @@ class GPSModule:
         Open the GPS port for reading data.
         """
         try:
-            # Kill any existing processes
-            os.system(f"sudo fuser -k {self.gps_port}")
-            time.sleep(1)
-            
-            self.ser1 = serial.Serial(
-                port=self.gps_port,
-                baudrate=self.baudrate,
-                bytesize=serial.EIGHTBITS,
-                parity=serial.PARITY_NONE,
-                stopbits=serial.STOPBITS_ONE,
-                timeout=1,  
-                xonxoff=False,
-                rtscts=False,
-                dsrdtr=False
-            )
+            self.ser1 = self.backend.serial('gps', self._open_serial)
             
             self.ser1.reset_input_buffer()
             self.ser1.reset_output_buffer()
@@ -141,6 +142,24 @@ class GPSModule:
             print(f"Error opening {self.gps_port}: {e}")
             raise
 
+    def _open_serial(self):
+        """Free and open the real GPS serial port."""
+        # Kill any existing processes
+        os.system(f"sudo fuser -k {self.gps_port}")
+        time.sleep(1)
+        
+        return serial.Serial(
+            port=self.gps_port,
+            baudrate=self.baudrate,
+            bytesize=serial.EIGHTBITS,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE,
+            timeout=1,  
+            xonxoff=False,
+            rtscts=False,
+            dsrdtr=False
+        )
+
     def close_gps_port(self):
         """
         Close the GPS port if it is open.
@@ -167,15 +186,12 @@ class GPSModule:
     
         while not self._stop_event.is_set():
             try:
-                
-                if self.ser1.in_waiting:
-                    data = self.ser1.readline().decode("utf-8", errors="ignore")
-                    if data: 
-                        #print(data.strip())
-                        with self.buffer_lock:
-                            self.buffer += data
-                else:
-                    time.sleep(0.1) 
+                # Whatever is waiting, or block up to the port timeout for the next byte
+                data = self.ser1.read(self.ser1.in_waiting or 1)
+                if data:
+                    timestamp = time.time()
+                    for sentence in self.parser.feed(data):
+                        self._handle_sentence(sentence, timestamp)
                     
             except serial.SerialException as e:
                 print(f"SerialException: {e}")
@@ -193,92 +209,120 @@ class GPSModule:
                 print(f"Unexpected error in _read_from_serial: {e}")
                 
 
-    def _process_gps_data(self):
+    def _handle_sentence(self, sentence, timestamp):
         """
-        Process GPS data from buffer and store coordinates with timestamp
+        Update the GPS state from one parsed sentence, as soon as it is complete.
+        GGA and GSA carry fix quality, every valid RMC produces a new fix.
         """
-        while not self._stop_event.is_set():
-            with self.buffer_lock:
-                lines = self.buffer.split("\n")
-                self.buffer = lines.pop()
-                # print(lines)
-
-            for line in lines:
-                line = line.strip()
-                if line.startswith("$GPRMC"):
-                    data = line.split(",")
-                    if not data[3] or not data[5]:
-                        continue
-
-                    try:
-                        latitude = float(data[3])
-                        longitude = float(data[5])
-                        timestamp = time.time()
-                    except ValueError:
-                        continue
-
-                    # Convert coordinates to decimal degrees
-                    latitude_direction = data[4]
-                    longitude_direction = data[6]
-
-                    if latitude_direction == "S":
-                        latitude = -latitude
-                    if longitude_direction == "W":
-                        longitude = -longitude
-
-                    latitude = int(latitude / 100) + (latitude / 100 - int(latitude / 100)) * 100 / 60
-                    longitude = int(longitude / 100) + (longitude / 100 - int(longitude / 100)) * 100 / 60
-
-                    self.latitude = latitude
-                    self.longitude = longitude
-
-                    # Store coordinates and timestamp in buffer
-                    with self.coordinates_lock:
-                        self.coordinates_buffer.append((latitude, longitude, timestamp))
+        if isinstance(sentence, RMC):
+            if not sentence.valid or sentence.latitude is None or sentence.longitude is None:
+                return
+            self.latitude = sentence.latitude
+            self.longitude = sentence.longitude
 
-            time.sleep(1)
-    def _calculate_velocity(self):
+            # Store coordinates and timestamp in buffer
+            with self.coordinates_lock:
+                self.coordinates_buffer.append((sentence.latitude, sentence.longitude, timestamp))
+            self._calculate_velocity(timestamp)
+
+            self._publish_fix(GPSFix(timestamp, sentence.latitude, sentence.longitude, sentence.speed,
+                                     sentence.course, self.hdop, self.satellites))
+        elif isinstance(sentence, GGA):
+            self.fix_quality = sentence.fix_quality
+            self.satellites = sentence.satellites
+            if sentence.hdop is not None:
+                self.hdop = sentence.hdop
+        elif isinstance(sentence, GSA):
+            self.fix_type = sentence.fix_type
+            if sentence.hdop is not None:
+                self.hdop = sentence.hdop
+        elif isinstance(sentence, VTG) and self.fix is not None:
+            # VTG follows the RMC of the same epoch, fill in what RMC left out
+            if self.fix.speed is None or self.fix.course is None:
+                self.fix = self.fix._replace(speed=self.fix.speed if self.fix.speed is not None else sentence.speed,
+                                             course=self.fix.course if self.fix.course is not None else sentence.course)
+
+    def _calculate_velocity(self, current_time):
         """
         Calculate average velocity using only start and end points within the time window.
+        Runs on every new fix.
         """
-        while not self._stop_event.is_set():
+        with self.coordinates_lock:
+            # Get points within the time window
+            valid_points = [point for point in self.coordinates_buffer 
+                        if current_time - point[2] <= 2]  #2 is value we need calculate vel in that time
             
-            with self.coordinates_lock:
-                if len(self.coordinates_buffer) < 2:
-                    time.sleep(1)
-                    continue
-                
-                # Get points within the time window
-                current_time = time.time()
-                valid_points = [point for point in self.coordinates_buffer 
-                            if current_time - point[2] <= 2]  #2 is value we need calculate vel in that time
-                
-                # Clean up old points
-                self.coordinates_buffer = valid_points
-                
-                if len(valid_points) < 2:
-                    time.sleep(1)
-                    continue
-
-                # Get start and end points
-                start_point = valid_points[0]
-                end_point = valid_points[-1]
-                
-                # Calculate distance between start and end points
-                distance = haversine(start_point[1], start_point[0], 
-                                end_point[1], end_point[0])
-                
-                # Calculate time difference
-                time_elapsed = end_point[2] - start_point[2]
-                
-                # Calculate velocity
-                if time_elapsed > 0:
-                    self.velocity = distance / time_elapsed  # velocity in m/s
-                else:
-                    self.velocity = 0
+            # Clean up old points
+            self.coordinates_buffer = valid_points
+            
+            if len(valid_points) < 2:
+                return
 
-            time.sleep(1)  # Wait before next calculation
+            # Get start and end points
+            start_point = valid_points[0]
+            end_point = valid_points[-1]
             
+        # Calculate distance between start and end points
+        distance = haversine(start_point[1], start_point[0], 
+                        end_point[1], end_point[0])
+        
+        # Calculate time difference
+        time_elapsed = end_point[2] - start_point[2]
+        
+        # Calculate velocity
+        if time_elapsed > 0:
+            self.velocity = distance / time_elapsed  # velocity in m/s
+        else:
+            self.velocity = 0
+
+    def _publish_fix(self, fix):
+        """Make a new fix visible: wake waiters and run subscriber callbacks."""
+        with self.fix_condition:
+            self.fix = fix
+            self.fix_count += 1
+            self.fix_condition.notify_all()
+        for callback in list(self.subscribers):
+            try:
+                callback(fix)
+            except Exception as e:
+                print(f"Error in GPS fix subscriber: {e}")
+
+    def subscribe(self, callback):
+        """
+        Register callback(fix) to run on every new GPSFix.
+        Callbacks run on the GPS reader thread and must return quickly.
+        """
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def wait_for_fix(self, last_count=None, timeout=None):
+        """
+        Block until a fix newer than `last_count` (default: the current one) arrives.
+        Returns:
+            tuple: (fix, fix_count), or (None, last_count) on timeout or stop.
+        """
+        with self.fix_condition:
+            if last_count is None:
+                last_count = self.fix_count
+            if self.fix_condition.wait_for(lambda: self.fix_count != last_count or self._stop_event.is_set(), timeout) \
+                    and self.fix_count != last_count:
+                return self.fix, self.fix_count
+        return None, last_count
+
+    def fixes(self, timeout=None):
+        """
+        Iterate over new fixes as they arrive. A slow consumer gets the latest fix,
+        not a backlog. Yields None whenever `timeout` seconds pass without a fix,
+        so the loop can check its own stop flag. Ends when the module is stopped.
+        """
+        count = self.fix_count
+        while not self._stop_event.is_set():
+            fix, count = self.wait_for_fix(count, timeout)
+            if fix is not None or not self._stop_event.is_set():
+                yield fix
 
     def get_velocity(self):
         """
@@ -291,26 +335,31 @@ class GPSModule:
         
         return self.latitude, self.longitude
 
+    def get_fix(self):
+        """
+        Retrieve the latest fix.
+        Returns:
+            GPSFix: Timestamped position, speed and course, or None before the first fix.
+        """
+        return self.fix
+
     def start(self):
         """
         Start the GPS reader and begin reading data.
         """
-        self.setup()
+        if not self.backend.replaying:  # A replayed log needs no modem setup
+            self.setup()
         self._gps_read_thread.daemon = True  # Ensure threads terminate with the main program
-        self._gps_process_thread.daemon = True
-        self._velocity_thread.daemon = True
         self._gps_read_thread.start()
-        self._gps_process_thread.start()
-        self._velocity_thread.start()
 
     def stop(self):
         """
         Stop all threads and terminate the GPS reader.
         """
         self._stop_event.set()
+        with self.fix_condition:
+            self.fix_condition.notify_all()  # Release wait_for_fix / fixes() consumers
         self._gps_read_thread.join()
-        self._gps_process_thread.join()
-        self._velocity_thread.join()
         
     def destroy(self):
         """
@@ -0,0 +1,164 @@
+# Thesis/sensors/GPS/nmea_parser.py
+# Incremental NMEA 0183 parser: feed it raw serial bytes, get typed sentences back.
+import calendar
+from collections import namedtuple
+
+KNOTS_TO_MS = 0.514444
+KMH_TO_MS = 1 / 3.6
+
+# Speeds in m/s, courses in degrees true, positions in decimal degrees. Missing fields are None.
+RMC = namedtuple('RMC', ['talker', 'time_utc', 'valid', 'latitude', 'longitude', 'speed', 'course', 'date', 'utc'])
+GGA = namedtuple('GGA', ['talker', 'time_utc', 'latitude', 'longitude', 'fix_quality', 'satellites', 'hdop', 'altitude'])
+VTG = namedtuple('VTG', ['talker', 'course', 'speed'])
+GSA = namedtuple('GSA', ['talker', 'mode', 'fix_type', 'satellite_ids', 'pdop', 'hdop', 'vdop'])
+
+MAX_SENTENCE_LENGTH = 82  # Including $ and CRLF, per NMEA 0183
+
+
+def _float(field):
+    return float(field) if field else None
+
+
+def _int(field):
+    return int(field) if field else None
+
+
+def _coordinate(value, hemisphere):
+    """Convert ddmm.mmmm / dddmm.mmmm plus N/S/E/W to signed decimal degrees."""
+    if not value:
+        return None
+    degrees, minutes = divmod(float(value), 100)
+    coordinate = degrees + minutes / 60
+    return -coordinate if hemisphere in ('S', 'W') else coordinate
+
+
+def _utc(date, time_utc):
+    """Epoch seconds from RMC ddmmyy and hhmmss.ss fields."""
+    if len(date) != 6 or len(time_utc) < 6:
+        return None
+    day, month, year = int(date[0:2]), int(date[2:4]), int(date[4:6])
+    year += 2000 if year < 80 else 1900
+    seconds = float(time_utc[4:])
+    return calendar.timegm((year, month, day, int(time_utc[0:2]), int(time_utc[2:4]), 0)) + seconds
+
+
+def checksum(body):
+    """XOR of every byte between '$' and '*'."""
+    value = 0
+    for byte in body:
+        value ^= byte
+    return value
+
+
+def parse_rmc(talker, f):
+    return RMC(talker, f[1] or None, f[2] == 'A', _coordinate(f[3], f[4]), _coordinate(f[5], f[6]),
+               _float(f[7]) * KNOTS_TO_MS if f[7] else None, _float(f[8]), f[9] or None, _utc(f[9], f[1]))
+
+
+def parse_gga(talker, f):
+    return GGA(talker, f[1] or None, _coordinate(f[2], f[3]), _coordinate(f[4], f[5]),
+               _int(f[6]), _int(f[7]), _float(f[8]), _float(f[9]))
+
+
+def parse_vtg(talker, f):
+    if f[7]:
+        speed = float(f[7]) * KMH_TO_MS
+    else:
+        speed = float(f[5]) * KNOTS_TO_MS if f[5] else None
+    return VTG(talker, _float(f[1]), speed)
+
+
+def parse_gsa(talker, f):
+    return GSA(talker, f[1] or None, _int(f[2]), [int(prn) for prn in f[3:15] if prn],
+               _float(f[15]), _float(f[16]), _float(f[17]))
+
+
+# Sentence type -> (minimum field count, parser)
+PARSERS = {
+    'RMC': (10, parse_rmc),
+    'GGA': (10, parse_gga),
+    'VTG': (9, parse_vtg),
+    'GSA': (18, parse_gsa),
+}
+
+
+class NMEAParser:
+    """
+    Streaming NMEA parser.
+    Bytes can arrive in any chunking; each sentence is parsed as soon as its line
+    ends. Sentences with a bad or missing checksum are dropped, and a partial
+    line never grows past one maximum-length sentence, so line noise cannot
+    build up memory.
+    """
+
+    def __init__(self, require_checksum=True):
+        self.require_checksum = require_checksum
+        self.buffer = bytearray()
+        self.stats = {'sentences': 0, 'parsed': 0, 'checksum_errors': 0, 'malformed': 0,
+                      'ignored': 0, 'overflows': 0}
+
+    def feed(self, data):
+        """Add raw bytes. Returns the sentences completed by them, in order."""
+        self.buffer += data
+        if b'\n' not in data:
+            if len(self.buffer) > MAX_SENTENCE_LENGTH:
+                self._overflow()
+            return []
+        *lines, rest = self.buffer.split(b'\n')
+        self.buffer = rest
+        if len(self.buffer) > MAX_SENTENCE_LENGTH:
+            self._overflow()
+        sentences = []
+        for line in lines:
+            sentence = self.parse_line(line)
+            if sentence is not None:
+                sentences.append(sentence)
+        return sentences
+
+    def _overflow(self):
+        # Keep a sentence that may have just started, drop the noise before it
+        start = self.buffer.rfind(b'$')
+        self.buffer = self.buffer[start:] if 0 <= start and len(self.buffer) - start <= MAX_SENTENCE_LENGTH else bytearray()
+        self.stats['overflows'] += 1
+
+    def parse_line(self, line):
+        """Parse one line (bytes, without the newline). Returns a sentence tuple or None."""
+        start = line.rfind(b'$')
+        if start < 0:
+            return None
+        line = line[start + 1:].rstrip(b'\r\n ')
+        self.stats['sentences'] += 1
+
+        star = line.rfind(b'*')
+        if star >= 0:
+            try:
+                expected = int(line[star + 1:star + 3], 16)
+            except ValueError:
+                expected = -1
+            body = line[:star]
+            if checksum(body) != expected:
+                self.stats['checksum_errors'] += 1
+                return None
+        elif self.require_checksum:
+            self.stats['checksum_errors'] += 1
+            return None
+        else:
+            body = line
+
+        fields = body.decode('ascii', errors='replace').split(',')
+        address = fields[0]
+        entry = PARSERS.get(address[-3:])
+        if entry is None:
+            self.stats['ignored'] += 1
+            return None
+        min_fields, parser = entry
+        if len(fields) < min_fields:
+            self.stats['malformed'] += 1
+            return None
+        try:
+            sentence = parser(address[:-3], fields)
+        except (ValueError, IndexError):
+            self.stats['malformed'] += 1
+            return None
+        self.stats['parsed'] += 1
+        return sentence
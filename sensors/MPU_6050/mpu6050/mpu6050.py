@@ -1,9 +1,4 @@
-from Kalman import KalmanFilter1 
-from Kalman import KalmanFilter2
-from Kalman import KalmanFilter3
-from Kalman import KalmanFilter4
-from Kalman import KalmanFilter5
-from Kalman import KalmanFilter6
+from Kalman import KalmanFilterBank
 import smbus
 import time
 import numpy as np
@@ -14,13 +9,9 @@ import math
 import sys 
 from mpu6050lib import mpu6050
 
-#set up Kalman filter
-kalman_filter_1 = KalmanFilter1(process_variance=1e-5, measurement_variance=1e-2)
-kalman_filter_2 = KalmanFilter2(process_variance=1e-5, measurement_variance=1e-2)
-kalman_filter_3 = KalmanFilter3(process_variance=1e-5, measurement_variance=1e-2)
-kalman_filter_4 = KalmanFilter4(process_variance=1e-5, measurement_variance=1e-2)
-kalman_filter_5 = KalmanFilter5(process_variance=1e-5, measurement_variance=1e-2)
-kalman_filter_6 = KalmanFilter6(process_variance=1e-5, measurement_variance=1e-2)
+#set up Kalman filters, one bank per 3-axis sensor
+gyro_kalman = KalmanFilterBank(3, process_variance=1e-5, measurement_variance=1e-2)
+accel_kalman = KalmanFilterBank(3, process_variance=1e-5, measurement_variance=1e-2)
 
 def accel_cal(cal_size):
     print("-" * 50)
@@ -58,9 +49,7 @@ def gyro_filter():
 
     _, _, _, w_x, w_y, w_z = mpu6050_conv()
     
-    filtered_x = kalman_filter_1.update(w_x)
-    filtered_y = kalman_filter_2.update(w_y)
-    filtered_z = kalman_filter_3.update(w_z)
+    filtered_x, filtered_y, filtered_z = gyro_kalman.update((w_x, w_y, w_z))
     return filtered_x, filtered_y, filtered_z
     
 def gyro_calib(cal_size):
@@ -112,9 +101,7 @@ def accel_fit(x_input, m_x, b):
 def get_accel():
     
     ax, ay, az, _, _, _ = mpu6050_conv()
-    filtered_accx = ax#kalman_filter_4.update(ax)
-    filtered_accy = ay#kalman_filter_5.update(ay)
-    filtered_accz = az#kalman_filter_6.update(az)
+    filtered_accx, filtered_accy, filtered_accz = ax, ay, az  # accel_kalman.update((ax, ay, az))
     
     return filtered_accx, filtered_accy, filtered_accz
 
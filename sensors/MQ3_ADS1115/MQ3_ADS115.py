@@ -1,11 +1,15 @@
 #Thesis/sensors/MQ3_ADS1115/MQ3_ADS115.py
 import time
 import threading
-import busio
-import board
-import Adafruit_ADS1x15 as ADS
-import Adafruit_GPIO.I2C as I2C
+try:
+    import busio
+    import board
+    import Adafruit_ADS1x15 as ADS
+    import Adafruit_GPIO.I2C as I2C
+except (ImportError, RuntimeError, NotImplementedError):
+    ADS = None  # Not on the Pi, only usable when replaying a sensor log
 from .alcohol_concentration_interpolator import AlcoholConcentrationInterpolator
+from sensors.backend import get_backend
 
 
 class MQ3Sensor:
@@ -18,9 +22,13 @@ class MQ3Sensor:
             gain (int): Gain setting for ADS1115, use 1 for 0-4.096V (default: 1).
             vcc (float): Supply voltage to the MQ3 sensor (default: 5.0V).
         """
-        I2C.require_repeated_start()
-        i2c = busio.I2C(board.SCL, board.SDA)
-        self.adc = ADS.ADS1115(busnum=1)
+        backend = get_backend()
+        self.adc = None
+        if not backend.replaying:
+            I2C.require_repeated_start()
+            i2c = busio.I2C(board.SCL, board.SDA)
+            self.adc = ADS.ADS1115(busnum=1)
+        self.read_adc = backend.source('alcohol', lambda: self.adc.read_adc(self.adc_channel, gain=self.gain))
         self.adc_channel = adc_channel
         self.gain = gain
         self.vcc = vcc
@@ -29,7 +37,9 @@ class MQ3Sensor:
 
     def read_sensor(self):
             # Read ADC value from ADS1115
-            adc_value = self.adc.read_adc(self.adc_channel, gain=self.gain)
+            adc_value = self.read_adc()
+            if adc_value is None:
+                return None, None, None  # Nothing recorded for this channel when replaying
             
             # Convert ADC value to voltage (ADC 16 bit, 2^15 = 32768)
             voltage = adc_value * (5 / 32768.0)
@@ -6,19 +6,25 @@ import os
 import glob
 import time
  
-os.system('modprobe w1-gpio')
-os.system('modprobe w1-therm')
- 
 base_dir = '/sys/bus/w1/devices/'
-device_folders = glob.glob(base_dir + '28*')
-if not device_folders:
-    raise RuntimeError("No DS18B20 sensor found!")
-device_folder = device_folders[0]
-device_file = device_folder + '/w1_slave'
+device_file = None
+
+
+def find_device_file():
+	# Looked up on first read so importing this module works without the sensor
+	global device_file
+	if device_file is None:
+		os.system('modprobe w1-gpio')
+		os.system('modprobe w1-therm')
+		device_folders = glob.glob(base_dir + '28*')
+		if not device_folders:
+			raise RuntimeError("No DS18B20 sensor found!")
+		device_file = device_folders[0] + '/w1_slave'
+	return device_file
 
 
 def read_temp_raw():
-	f = open(device_file, 'r')
+	f = open(find_device_file(), 'r')
 	lines = f.readlines()
 	f.close()
 	return lines
@@ -0,0 +1,418 @@
+# Thesis/sensors/backend.py
+# Pluggable source of raw sensor readings, so the pipeline can run away from the car.
+#
+#   live    read the hardware (default)
+#   record  read the hardware and tee every raw reading to a compact log
+#   replay  feed a recorded log back at real-time or accelerated speed, no hardware needed
+#
+# Selected with environment variables, e.g. on a dev box:
+#   BLACKBOX_SENSOR_MODE=replay BLACKBOX_SENSOR_LOG=drive.bbl BLACKBOX_REPLAY_SPEED=4 python -m main.main_handle
+import os
+import mmap
+import time
+import struct
+import threading
+
+MODE_LIVE = "live"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+
+DEFAULT_LOG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sensor_log.bbl")
+
+# Channel ids in the log file
+CHANNELS = {
+    'imu': 1,          # BNO055 data block, 44 raw bytes
+    'gps': 2,          # One raw NMEA line
+    'temperature': 3,  # (temp_c, temp_f)
+    'rfid': 4,         # Card UID, empty when no card
+    'alcohol': 5,      # ADS1115 ADC value
+    'camera': 6,       # JPEG encoded frame
+}
+
+# Record header: timestamp (float64), channel id (uint8), payload length (uint32)
+RECORD_HEADER = struct.Struct('<dBI')
+
+
+def encode_reading(channel, value):
+    if channel == 'temperature':
+        return b'' if value is None else struct.pack('<dd', *value)
+    if channel == 'rfid':
+        return b'' if value is None else bytes(value)
+    if channel == 'alcohol':
+        return struct.pack('<i', value)
+    if channel == 'camera':
+        import cv2
+        ret, frame = value
+        if not ret:
+            return b''
+        _, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        return jpeg.tobytes()
+    return bytes(value)
+
+
+def decode_reading(channel, payload):
+    if channel == 'temperature':
+        return struct.unpack('<dd', payload) if payload else None
+    if channel == 'rfid':
+        return bytearray(payload) if payload else None
+    if channel == 'alcohol':
+        return struct.unpack('<i', payload)[0]
+    if channel == 'camera':
+        import cv2
+        import numpy as np
+        if not payload:
+            return False, None
+        return True, cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return payload
+
+
+class SensorLogWriter:
+    """
+    Thread-safe appender of (timestamp, channel, payload) records.
+    Buffered writes are flushed every `flush_interval` seconds, so a shutdown that
+    skips close() loses at most that much of the recording.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+        self.records = 0
+        self.last_flush = time.time()
+
+    def write(self, channel, payload, timestamp=None):
+        header = RECORD_HEADER.pack(timestamp if timestamp is not None else time.time(),
+                                    CHANNELS[channel], len(payload))
+        with self.lock:
+            self.file.write(header)
+            self.file.write(payload)
+            self.records += 1
+            if time.time() - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = time.time()
+
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                self.file.close()
+
+
+class SensorLogReader:
+    """
+    Memory-maps a sensor log and indexes it per channel in one pass.
+    Payloads are only sliced out of the map when they are replayed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = {name: [] for name in CHANNELS}  # channel -> [(timestamp, offset, length)]
+        names = {channel_id: name for name, channel_id in CHANNELS.items()}
+        offset = 0
+        size = len(self.map)
+        while offset + RECORD_HEADER.size <= size:
+            timestamp, channel_id, length = RECORD_HEADER.unpack_from(self.map, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > size:
+                break  # Torn last record
+            if channel_id in names:
+                self.index[names[channel_id]].append((timestamp, offset, length))
+            offset += length
+        starts = [entries[0][0] for entries in self.index.values() if entries]
+        ends = [entries[-1][0] for entries in self.index.values() if entries]
+        self.start_time = min(starts) if starts else 0.0
+        self.end_time = max(ends) if ends else 0.0
+
+    def payload(self, channel, i):
+        _, offset, length = self.index[channel][i]
+        return self.map[offset:offset + length]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class LiveBackend:
+    """Reads the hardware directly."""
+
+    mode = MODE_LIVE
+    replaying = False
+
+    def source(self, channel, live_read):
+        """Return the callable that produces readings of `channel`."""
+        return live_read
+
+    def serial(self, channel, open_live):
+        """Return a serial-like object streaming `channel` lines."""
+        return open_live()
+
+    def video_capture(self, open_live):
+        """Return a cv2.VideoCapture-like object."""
+        return open_live()
+
+    def flush(self):
+        """Push buffered recordings to disk, safe to call from a signal handler."""
+        pass
+
+    def close(self):
+        pass
+
+
+class RecordingSerial:
+    """Serial port wrapper that tees everything read to the log."""
+
+    def __init__(self, ser, channel, writer):
+        self._ser = ser
+        self._channel = channel
+        self._writer = writer
+
+    def readline(self, *args, **kwargs):
+        line = self._ser.readline(*args, **kwargs)
+        if line:
+            self._writer.write(self._channel, line)
+        return line
+
+    def read(self, *args, **kwargs):
+        data = self._ser.read(*args, **kwargs)
+        if data:
+            self._writer.write(self._channel, data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._ser, name)
+
+
+class RecordingCapture:
+    """VideoCapture wrapper that tees every frame to the log as JPEG."""
+
+    def __init__(self, cap, writer):
+        self._cap = cap
+        self._writer = writer
+
+    def read(self):
+        result = self._cap.read()
+        self._writer.write('camera', encode_reading('camera', result))
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._cap, name)
+
+
+class RecordBackend(LiveBackend):
+    """Reads the hardware and tees every raw reading to a log."""
+
+    mode = MODE_RECORD
+
+    def __init__(self, path):
+        self.writer = SensorLogWriter(path)
+        print(f"Recording sensor readings to {path}")
+
+    def source(self, channel, live_read):
+        def read(*args, **kwargs):
+            value = live_read(*args, **kwargs)
+            self.writer.write(channel, encode_reading(channel, value))
+            return value
+        return read
+
+    def serial(self, channel, open_live):
+        return RecordingSerial(open_live(), channel, self.writer)
+
+    def video_capture(self, open_live):
+        return RecordingCapture(open_live(), self.writer)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        print(f"Recorded {self.writer.records} sensor readings")
+
+
+class ReplaySerial:
+    """Serial-like object returning recorded reads (lines or chunks) when their time comes."""
+
+    def __init__(self, backend, channel, timeout=1.0):
+        self.backend = backend
+        self.channel = channel
+        self.timeout = timeout
+        self.is_open = True
+
+    @property
+    def in_waiting(self):
+        return 1 if self.backend.next_due(self.channel) else 0
+
+    def readline(self):
+        return self.backend.next_record(self.channel, self.timeout) or b''
+
+    def read(self, size=1):
+        # One recorded read per call, whatever its size
+        return self.backend.next_record(self.channel, self.timeout) or b''
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class ReplayCapture:
+    """VideoCapture-like object returning the recorded frame for the current replay time."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def read(self):
+        payload = self.backend.latest_record('camera')
+        return decode_reading('camera', payload) if payload is not None else (False, None)
+
+    def set(self, prop, value):
+        return True
+
+    def get(self, prop):
+        return 0
+
+    def release(self):
+        self.opened = False
+
+
+class ReplayBackend:
+    """
+    Feeds a recorded log back in place of the hardware.
+    Replay time runs `speed` times faster than the wall clock. Polled sensors get
+    the newest reading that is due (reads block until the next one is due, like
+    the real device), streamed channels such as NMEA get every line in order.
+    When the log ends, readings stay on their last value, or the replay restarts
+    if `loop` is set.
+    """
+
+    mode = MODE_REPLAY
+    replaying = True
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.reader = SensorLogReader(path)
+        self.speed = speed
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.cursors = {name: 0 for name in CHANNELS}  # Next unread record per channel
+        self.wall_start = time.time()
+        self.finished = False
+        counts = ", ".join(f"{name}={len(entries)}" for name, entries in self.reader.index.items() if entries)
+        print(f"Replaying {path} at {speed}x ({self.reader.end_time - self.reader.start_time:.1f}s: {counts})")
+
+    def replay_time(self):
+        now = self.reader.start_time + (time.time() - self.wall_start) * self.speed
+        if now > self.reader.end_time:
+            if self.loop:
+                with self.lock:
+                    self.wall_start = time.time()
+                    self.cursors = {name: 0 for name in CHANNELS}
+                return self.reader.start_time
+            if not self.finished:
+                self.finished = True
+                print("Sensor replay reached the end of the log")
+        return now
+
+    def _wait_until(self, timestamp, timeout=None):
+        """Sleep until `timestamp` in replay time. Returns False if the timeout ran out first."""
+        delay = (timestamp - self.replay_time()) / self.speed
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            return False
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    def next_due(self, channel):
+        entries = self.reader.index[channel]
+        i = self.cursors[channel]
+        return i < len(entries) and entries[i][0] <= self.replay_time()
+
+    def next_record(self, channel, timeout=None):
+        """Next record of a streamed channel, waiting for it to be due."""
+        entries = self.reader.index[channel]
+        with self.lock:
+            i = self.cursors[channel]
+        if i >= len(entries):
+            time.sleep(timeout or 0)
+            return None
+        if not self._wait_until(entries[i][0], timeout):
+            return None
+        with self.lock:
+            self.cursors[channel] = i + 1
+        return self.reader.payload(channel, i)
+
+    def latest_record(self, channel):
+        """Newest due record of a polled channel, waiting for the next one if none is new."""
+        entries = self.reader.index[channel]
+        if not entries:
+            return None
+        with self.lock:
+            i = self.cursors[channel]
+        if i < len(entries):
+            self._wait_until(entries[i][0])
+        now = self.replay_time()
+        with self.lock:
+            i = self.cursors[channel]
+            while i + 1 < len(entries) and entries[i + 1][0] <= now:
+                i += 1
+            self.cursors[channel] = min(i + 1, len(entries))
+        return self.reader.payload(channel, min(i, len(entries) - 1))
+
+    def source(self, channel, live_read):
+        """Readings of a channel that was never recorded are None, like a sensor that returns nothing."""
+        if not self.reader.index[channel]:
+            print(f"No recorded {channel} readings, {channel} reads return None")
+        def read(*args, **kwargs):
+            payload = self.latest_record(channel)
+            return decode_reading(channel, payload) if payload is not None else None
+        return read
+
+    def serial(self, channel, open_live):
+        return ReplaySerial(self, channel)
+
+    def video_capture(self, open_live):
+        return ReplayCapture(self)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.reader.close()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """Return the process-wide sensor backend, created from the environment on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            mode = os.environ.get("BLACKBOX_SENSOR_MODE", MODE_LIVE).lower()
+            path = os.environ.get("BLACKBOX_SENSOR_LOG", DEFAULT_LOG_PATH)
+            if mode == MODE_RECORD:
+                _backend = RecordBackend(path)
+            elif mode == MODE_REPLAY:
+                _backend = ReplayBackend(path, speed=float(os.environ.get("BLACKBOX_REPLAY_SPEED", "1")),
+                                         loop=os.environ.get("BLACKBOX_REPLAY_LOOP", "0") == "1")
+            else:
+                _backend = LiveBackend()
+        return _backend
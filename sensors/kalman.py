@@ -0,0 +1,109 @@
+# Thesis/sensors/kalman.py
+import numpy as np
+
+
+class KalmanFilterBank:
+    """
+    N independent scalar Kalman filters (random-walk model) updated together.
+
+    Replaces the per-axis KalmanFilter1..6 copies: one update() call filters
+    every channel of a sample, and filter() runs a whole (T, N) array of
+    samples without a Python loop per sample. Both give the same estimates as
+    calling a scalar filter once per value.
+
+    The state is kept as plain float lists: a single sample of a few channels is
+    too small for NumPy to pay off, so update() never allocates arrays. filter()
+    converts once per batch.
+    """
+
+    def __init__(self, channels, process_variance=1e-5, measurement_variance=1e-2, block_size=128):
+        """
+        Parameters:
+            channels (int): Number of values filtered per sample (e.g. 3 for x, y, z).
+            process_variance, measurement_variance (float or sequence): Noise variances,
+                one value for every channel or one per channel.
+            block_size (int): Samples solved at once by filter(). Larger blocks are faster
+                but the cumulative products must stay representable as float64.
+        """
+        self.channels = channels
+        self.process_variance = np.broadcast_to(np.asarray(process_variance, dtype=np.float64), (channels,)).tolist()
+        self.measurement_variance = np.broadcast_to(np.asarray(measurement_variance, dtype=np.float64), (channels,)).tolist()
+        self.block_size = block_size
+        self.reset()
+
+    def reset(self):
+        self.estimated_measurement = [0.0] * self.channels
+        self.error_covariance = [1.0] * self.channels
+        self.kalman_gain = [1.0] * self.channels
+
+    def update(self, measurement):
+        """Filter one sample of N values. Returns the N estimates as a list."""
+        estimates = self.estimated_measurement
+        covariances = self.error_covariance
+        gains = self.kalman_gain
+        for i, value in enumerate(measurement):
+            #Prediction step
+            predicted = covariances[i] + self.process_variance[i]
+
+            #Update step
+            gain = predicted / (predicted + self.measurement_variance[i])
+            estimates[i] += gain * (value - estimates[i])
+            covariances[i] = (1 - gain) * predicted
+            gains[i] = gain
+
+        return estimates[:]
+
+    def _gains(self, steps):
+        """
+        Gains of the next `steps` updates, shape (steps, N), advancing the covariance.
+        The covariance does not depend on the measurements and settles after a few
+        hundred updates, from then on the gain is constant.
+        """
+        gains = np.empty((steps, self.channels))
+        covariance = np.array(self.error_covariance)
+        process_variance = np.array(self.process_variance)
+        measurement_variance = np.array(self.measurement_variance)
+        for t in range(steps):
+            predicted = covariance + process_variance
+            gain = predicted / (predicted + measurement_variance)
+            gains[t] = gain
+            new_covariance = (1 - gain) * predicted
+            if np.all(np.abs(new_covariance - covariance) <= 1e-15 * covariance):
+                gains[t + 1:] = gain  # Steady state
+                break
+            covariance = new_covariance
+        if steps:
+            self.error_covariance = new_covariance.tolist()
+            self.kalman_gain = gains[-1].tolist()
+        return gains
+
+    def filter(self, measurements):
+        """
+        Filter a batch of samples, shape (T, N) (or (T,) for one channel), in order.
+        Returns the estimates with the same shape and leaves the bank ready for the
+        next sample or batch.
+
+        Each step is x[t] = a[t] * x[t-1] + b[t] with a = 1 - K and b = K * z, which
+        within a block solves to x[t] = c[t] * (x0 + cumsum(b / c)[t]), c = cumprod(a).
+        """
+        z = np.asarray(measurements, dtype=np.float64)
+        shape = z.shape
+        z = z.reshape(len(z), self.channels)
+        gains = self._gains(len(z))
+        a = 1 - gains
+        b = gains * z
+        out = np.empty_like(z)
+        x = np.array(self.estimated_measurement)
+        for start in range(0, len(z), self.block_size):
+            end = min(start + self.block_size, len(z))
+            c = np.cumprod(a[start:end], axis=0)
+            if c[-1].min() > 1e-250:
+                out[start:end] = c * (x + np.cumsum(b[start:end] / c, axis=0))
+            else:
+                # Gain so close to 1 that the products underflow, step through the block
+                for t in range(start, end):
+                    x = a[t] * x + b[t]
+                    out[t] = x
+            x = out[end - 1]
+        self.estimated_measurement = x.tolist()
+        return out.reshape(shape)